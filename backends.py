@@ -0,0 +1,441 @@
+'''
+Inference backends behind OpenVino: the Inference Engine plugin, OpenCV's
+dnn module and, when installed, onnxruntime. Every backend hands back a
+network description and an executable network with the IE request
+interface (requests[i].async_infer / wait / outputs)
+'''
+
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import importlib
+import json
+import os
+import time
+import xml.etree.ElementTree as ElementTree
+
+import cv2
+import numpy as np
+
+#Status codes of InferRequest.wait
+OK, GENERAL_ERROR, RESULT_NOT_READY = 0, -1, -9
+
+#Engines are imported on first use, the Inference Engine alone takes
+#seconds to load on a Pi. None means not installed
+_modules = {}
+
+def optional_import(*names):
+    '''
+    The first of names that imports, None if none of them do
+    '''
+    if names not in _modules:
+        _modules[names] = None
+        for name in names:
+            try:
+                _modules[names] = importlib.import_module(name)
+                break
+            except ImportError:
+                continue
+    return _modules[names]
+
+def inference_engine():
+    return optional_import('armv7l.openvino.inference_engine', 'openvino.inference_engine')
+
+def onnx_runtime():
+    return optional_import('onnxruntime')
+
+
+class Port:
+    def __init__(self, shape):
+        self.shape = list(shape)
+
+class NetInfo:
+    '''
+    The parts of an IENetwork OpenVino reads: input and output names and
+    the input shape
+    '''
+    def __init__(self, input_name: str, shape, output_name: str):
+        self.inputs = {input_name: Port(shape)}
+        self.outputs = {output_name: None}
+
+class ThreadedRequest:
+    '''
+    IE style infer request over a synchronous run function. Runs are
+    serialised on one worker thread per network, so the caller can
+    preprocess the next batch while this one executes
+    '''
+    def __init__(self, executor, run, output_name: str):
+        self.executor = executor
+        self.run = run
+        self.output_name = output_name
+        self.future = None
+        self.outputs = {}
+
+    def async_infer(self, inputs):
+        #The caller reuses its input blob, take a copy like IE does
+        inputs = {name: np.array(blob) for name, blob in inputs.items()}
+        self.future = self.executor.submit(self.run, inputs)
+
+    def infer(self, inputs):
+        self.async_infer(inputs)
+        return self.wait(-1)
+
+    def wait(self, timeout):
+        if self.future is None:
+            return GENERAL_ERROR
+        if timeout == 0 and not self.future.done():
+            return RESULT_NOT_READY
+        try:
+            self.outputs = {self.output_name: self.future.result()}
+        except Exception as e:
+            print("[ALERT] Inference FAILED: ", e)
+            return GENERAL_ERROR
+        return OK
+
+class ThreadedExecNet:
+    def __init__(self, run, output_name: str, num_requests: int):
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='infer')
+        self.requests = [ThreadedRequest(self.executor, run, output_name) for _ in range(num_requests)]
+
+
+def ir_input(network_file: str):
+    '''
+    Name and NCHW shape of the first input layer of an IR xml
+    '''
+    root = ElementTree.parse(network_file).getroot()
+    for layer in root.iter('layer'):
+        if layer.get('type') in ('Input', 'Parameter'):
+            port = layer.find('output').find('port')
+            return layer.get('name'), [int(dim.text) for dim in port.findall('dim')]
+    raise Exception("No input layer in {}".format(network_file))
+
+def input_shape(config, batch_size: int = None):
+    '''
+    input_shape from the model section, else read off the IR
+    '''
+    if config.input_shape:
+        name, shape = 'data', list(config.input_shape)
+    else:
+        name, shape = ir_input(config.network_file)
+    if batch_size:
+        shape[0] = batch_size
+    return name, shape
+
+
+_hashes = {}
+
+def model_hash(config) -> str:
+    '''
+    Digest of every model file present, cache entries die with the model.
+    With a cache_dir the digest is kept there, keyed by path, size and
+    mtime, so a boot does not reread the weights
+    '''
+    paths = [path for path in (config.network_file, config.weights_file, config.onnx_file)
+             if path and os.path.exists(path)]
+    key = tuple((path, os.stat(path).st_size, os.stat(path).st_mtime_ns) for path in paths)
+    if key in _hashes:
+        return _hashes[key]
+    stored = os.path.join(os.path.expanduser(config.cache_dir), 'hashes.json') if config.cache_dir else None
+    hashes = {}
+    if stored and os.path.exists(stored):
+        try:
+            with open(stored) as f:
+                hashes = json.load(f)
+        except (OSError, ValueError):
+            hashes = {}
+    entry = hashes.get(config.network_file)
+    if entry and [tuple(item) for item in entry['files']] == list(key):
+        _hashes[key] = entry['hash']
+        return _hashes[key]
+    digest = hashlib.sha1()
+    for path in paths:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+    _hashes[key] = digest.hexdigest()[:16]
+    if stored:
+        hashes[config.network_file] = {'files': key, 'hash': _hashes[key]}
+        try:
+            os.makedirs(os.path.dirname(stored), exist_ok=True)
+            #Through a temp file, a crash must not leave half of it behind
+            with open(stored + '.tmp', 'w') as f:
+                json.dump(hashes, f)
+            os.replace(stored + '.tmp', stored)
+        except OSError as e:
+            print("[ALERT] Could not store the model hash: {}".format(e))
+    return _hashes[key]
+
+def cache_path(config, kind: str, batch_size: int = None, device: str = '') -> str:
+    '''
+    File under cache_dir for this model, or None when caching is off
+    '''
+    if not config.cache_dir:
+        return None
+    folder = os.path.expanduser(config.cache_dir)
+    os.makedirs(folder, exist_ok=True)
+    model = os.path.splitext(os.path.basename(config.network_file))[0]
+    name = '-'.join(part for part in (model, model_hash(config), device, 'b{}'.format(batch_size or 1)) if part)
+    return os.path.join(folder, name + '.' + kind)
+
+
+class Backend:
+    '''
+    One backend on one device. load() returns (NetInfo-like, ExecNet-like)
+    '''
+    name = None
+
+    def __init__(self, device: str):
+        self.device = device
+
+    def __repr__(self):
+        return '{}:{}'.format(self.name, self.device)
+
+    @staticmethod
+    def available(config) -> bool:
+        return True
+
+    def load(self, config, batch_size: int = None, num_requests: int = 2):
+        raise NotImplementedError
+
+class IEBackend(Backend):
+    name = 'ie'
+
+    @staticmethod
+    def available(config) -> bool:
+        return inference_engine() is not None
+
+    def load(self, config, batch_size: int = None, num_requests: int = 2):
+        ie = inference_engine()
+        if hasattr(ie, 'IECore'):
+            return self.load_core(ie, config, batch_size, num_requests)
+        #Releases before IECore cannot export, so nothing is cached
+        plugin = ie.IEPlugin(device=self.device)
+        net = ie.IENetwork(model=config.network_file, weights=config.weights_file)
+        if self.device == 'CPU':
+            supported_layers = plugin.get_supported_layers(net)
+            not_supported_layers = [l for l in net.layers.keys() if l not in supported_layers]
+            if len(not_supported_layers) != 0:
+                raise Exception("Some layers in the mdoel are not supported by the CPU - figure this out")
+        #One batch slot per camera when serving several sources
+        if batch_size:
+            net.batch_size = batch_size
+        self.plugin = plugin
+        return net, plugin.load(network=net, num_requests=num_requests)
+
+    def load_core(self, ie, config, batch_size: int = None, num_requests: int = 2):
+        '''
+        Imports the compiled network exported on a previous boot, which
+        skips compilation (most of the MYRIAD load time), else compiles and
+        exports it
+        '''
+        core = ie.IECore()
+        net = core.read_network(model=config.network_file, weights=config.weights_file)
+        if batch_size:
+            net.batch_size = batch_size
+        blob = cache_path(config, 'blob', batch_size, self.device)
+        if blob and os.path.exists(blob):
+            try:
+                exec_net = core.import_network(blob, self.device, num_requests=num_requests)
+                print("[LOGS] Imported compiled network {}".format(blob))
+                return net, exec_net
+            except RuntimeError as e:
+                print("[ALERT] Cached network {} is unusable: {}".format(blob, e))
+                os.remove(blob)
+        exec_net = core.load_network(net, self.device, num_requests=num_requests)
+        if blob:
+            try:
+                #Worker processes may export at once, readers only see whole files
+                temp = '{}.{}'.format(blob, os.getpid())
+                exec_net.export(temp)
+                os.replace(temp, blob)
+            except (RuntimeError, AttributeError) as e:
+                #Not every plugin can export, e.g. CPU on older releases
+                print("[LOGS] {} cannot export compiled networks: {}".format(self.device, e))
+        return net, exec_net
+
+class DnnBackend(Backend):
+    '''
+    cv2.dnn on the IR, or on path_onnx when this OpenCV build cannot read IR
+    '''
+    name = 'dnn'
+    TARGETS = {
+        'CPU': ('DNN_BACKEND_OPENCV', 'DNN_TARGET_CPU'),
+        'GPU': ('DNN_BACKEND_OPENCV', 'DNN_TARGET_OPENCL'),
+        'GPU_FP16': ('DNN_BACKEND_OPENCV', 'DNN_TARGET_OPENCL_FP16'),
+        'MYRIAD': ('DNN_BACKEND_INFERENCE_ENGINE', 'DNN_TARGET_MYRIAD'),
+    }
+
+    @staticmethod
+    def available(config) -> bool:
+        return hasattr(cv2, 'dnn')
+
+    def read(self, config):
+        try:
+            return cv2.dnn.readNet(config.network_file, config.weights_file)
+        except cv2.error:
+            if not config.onnx_file:
+                raise
+        return cv2.dnn.readNet(config.onnx_file)
+
+    def load(self, config, batch_size: int = None, num_requests: int = 2):
+        if self.device not in self.TARGETS:
+            raise Exception("cv2.dnn has no target for {}".format(self.device))
+        if self.device.startswith('GPU') and not cv2.ocl.haveOpenCL():
+            raise Exception("OpenCL is not available")
+        backend, target = (getattr(cv2.dnn, name) for name in self.TARGETS[self.device])
+        #Unsupported targets are otherwise silently run on the CPU
+        if target not in cv2.dnn.getAvailableTargets(backend):
+            raise Exception("This OpenCV build has no {} target".format(self.device))
+        net = self.read(config)
+        net.setPreferableBackend(backend)
+        net.setPreferableTarget(target)
+        input_name, shape = input_shape(config, batch_size)
+        output_name = net.getUnconnectedOutLayersNames()[0]
+
+        def run(inputs):
+            #The uint8 blobs the detector feeds IE are not accepted by every
+            #dnn engine, a float copy costs little next to the forward pass
+            net.setInput(inputs[input_name].astype(np.float32, copy=False))
+            return net.forward(output_name)
+
+        return NetInfo(input_name, shape, output_name), ThreadedExecNet(run, output_name, num_requests)
+
+class OnnxBackend(Backend):
+    '''
+    onnxruntime on path_onnx, device picks the execution provider
+    '''
+    name = 'onnx'
+    PROVIDERS = {
+        'CPU': 'CPUExecutionProvider',
+        'GPU': 'CUDAExecutionProvider',
+        'MYRIAD': 'OpenVINOExecutionProvider',
+    }
+
+    @staticmethod
+    def available(config) -> bool:
+        return bool(config.onnx_file) and onnx_runtime() is not None
+
+    def load(self, config, batch_size: int = None, num_requests: int = 2):
+        ort = onnx_runtime()
+        provider = self.PROVIDERS.get(self.device)
+        if provider not in ort.get_available_providers():
+            raise Exception("onnxruntime has no provider for {}".format(self.device))
+        session = ort.InferenceSession(config.onnx_file, providers=[provider])
+        model_input = session.get_inputs()[0]
+        output_name = session.get_outputs()[0].name
+        #Symbolic dimensions (e.g. a dynamic batch) come back as strings
+        shape = [dim if isinstance(dim, int) else 1 for dim in model_input.shape]
+        if batch_size:
+            shape[0] = batch_size
+        dtype = np.float32 if 'float' in model_input.type else np.uint8
+
+        def run(inputs):
+            blob = next(iter(inputs.values())).astype(dtype, copy=False)
+            return session.run([output_name], {model_input.name: blob})[0]
+
+        return NetInfo(model_input.name, shape, output_name), ThreadedExecNet(run, output_name, num_requests)
+
+BACKENDS = {backend.name: backend for backend in (IEBackend, DnnBackend, OnnxBackend)}
+
+
+def candidates(config) -> list:
+    '''
+    Backends to try in order of preference. default_device comes before
+    fallback_device, and auto adds the CPU paths behind the plugin
+    '''
+    names = ['ie', 'dnn', 'onnx'] if config.backend == 'auto' else [config.backend]
+    devices = [config.default_device]
+    if config.fallback_device != config.default_device:
+        devices.append(config.fallback_device)
+    found = []
+    for name in names:
+        if name not in BACKENDS:
+            raise Exception("Unknown inference backend {}".format(name))
+        backend = BACKENDS[name]
+        if not backend.available(config):
+            continue
+        for device in devices:
+            found.append(backend(device))
+        if config.backend == 'auto' and 'CPU' not in devices and name != 'ie':
+            found.append(backend('CPU'))
+    return found
+
+def benchmark(backend, net, exec_net, frames: int, normalize: bool) -> float:
+    '''
+    Median seconds per synchronous request, the first (compilation and
+    allocation) run is not counted
+    '''
+    name = next(iter(net.inputs))
+    shape = net.inputs[name].shape
+    blob = np.random.default_rng(0).integers(0, 256, shape, dtype=np.uint8)
+    if normalize:
+        blob = blob.astype(np.float32) / 255.
+    request = exec_net.requests[0]
+    times = []
+    for _ in range(max(frames, 1) + 1):
+        start = time.perf_counter()
+        #IE's infer() returns None, the status comes from wait like in OpenVino._collect
+        request.async_infer({name: blob})
+        if request.wait(-1) != OK:
+            raise Exception("warm-up inference failed")
+        times.append(time.perf_counter() - start)
+    return float(np.median(times[1:]))
+
+def release(exec_net):
+    executor = getattr(exec_net, 'executor', None)
+    if executor is not None:
+        executor.shutdown(wait=False)
+
+def load(config, batch_size: int = None, num_requests: int = 2):
+    '''
+    Returns (backend, net, exec_net). Without autotune the first candidate
+    that loads wins; with it every candidate is timed on warm-up frames and
+    the fastest is kept
+    '''
+    found = candidates(config)
+    if not found:
+        raise Exception("No inference backend available for {}".format(config.backend))
+    choice = cache_path(config, 'autotune', batch_size) if config.autotune else None
+    if choice and os.path.exists(choice):
+        #The winner of a previous boot goes first and skips the timing, if
+        #it no longer loads (e.g. the stick is gone) everything is retuned
+        with open(choice) as f:
+            tuned = json.load(f)
+        for backend in found:
+            if (backend.name, backend.device) == (tuned['backend'], tuned['device']):
+                try:
+                    net, exec_net = backend.load(config, batch_size, num_requests)
+                    print("[LOGS] Inference backend {} (autotuned earlier)".format(backend))
+                    return backend, net, exec_net
+                except Exception as e:
+                    print("[ALERT] Backend {} failed to load: {}".format(backend, e))
+    best, errors = None, []
+    for backend in found:
+        try:
+            net, exec_net = backend.load(config, batch_size, num_requests)
+        except Exception as e:
+            print("[ALERT] Backend {} failed to load: {}".format(backend, e))
+            errors.append(e)
+            continue
+        if not config.autotune:
+            print("[LOGS] Inference backend {}".format(backend))
+            return backend, net, exec_net
+        try:
+            elapsed = benchmark(backend, net, exec_net, config.warmup_frames, config.normalize)
+        except Exception as e:
+            print("[ALERT] Backend {} failed warm-up: {}".format(backend, e))
+            release(exec_net)
+            continue
+        print("[LOGS] AUTOTUNE {} {:.2f} ms per request".format(backend, 1000 * elapsed))
+        if best is None or elapsed < best[0]:
+            if best is not None:
+                release(best[3])
+            best = (elapsed, backend, net, exec_net)
+        else:
+            release(exec_net)
+    if best is None:
+        raise Exception("No inference backend could be loaded: {}".format(errors))
+    print("[LOGS] Inference backend {} (autotuned)".format(best[1]))
+    if choice:
+        with open(choice, 'w') as f:
+            json.dump({'backend': best[1].name, 'device': best[1].device, 'ms': 1000 * best[0]}, f)
+    return best[1:]
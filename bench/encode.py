@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+'''
+Encode time, bytes per frame and PSNR for a set of encoding profiles
+
+python -m bench.encode --images 'samples/*.jpg'
+python -m bench.encode --config        #the negative and human profiles from config.ini
+'''
+
+from argparse import ArgumentParser
+from dataclasses import dataclass
+import glob
+import json
+import time
+
+import cv2
+import numpy as np
+
+from encode import Encoder
+
+
+@dataclass
+class Profile:
+    '''
+    Stand-in for config.EncodingProfileConfig that needs no config.ini
+    '''
+    format: str = 'jpeg'
+    quality: int = 85
+    optimize: bool = False
+    progressive: bool = False
+    subsampling: str = '420'
+    png_compression: int = 3
+
+SWEEP = {
+    'jpeg-q100-444': Profile(quality=100, subsampling='444'),
+    'jpeg-q95': Profile(quality=95),
+    'jpeg-q85': Profile(quality=85),
+    'jpeg-q85-optimize': Profile(quality=85, optimize=True),
+    'jpeg-q85-progressive': Profile(quality=85, progressive=True),
+    'jpeg-q75': Profile(quality=75),
+    'webp-q80': Profile(format='webp', quality=80),
+    'png-3': Profile(format='png', png_compression=3),
+}
+
+def synthetic_frames(count: int, width: int, height: int):
+    '''
+    Gradients, shapes and sensor-like noise, closer to a camera frame than
+    pure noise which no codec can compress
+    '''
+    rng = np.random.default_rng(0)
+    y, x = np.mgrid[0:height, 0:width]
+    frames = []
+    for i in range(count):
+        frame = np.dstack([(x * 255 // width + 40 * i) % 256,
+                           y * 255 // height,
+                           (x + y) * 255 // (width + height)]).astype(np.uint8)
+        for _ in range(12):
+            x0, y0 = int(rng.integers(0, width)), int(rng.integers(0, height))
+            color = tuple(int(v) for v in rng.integers(0, 256, 3))
+            cv2.rectangle(frame, (x0, y0), (x0 + int(rng.integers(10, 120)), y0 + int(rng.integers(10, 120))), color, -1)
+        noise = rng.normal(0, 4, frame.shape)
+        frames.append(np.clip(frame + noise, 0, 255).astype(np.uint8))
+    return frames
+
+def measure(encoder: Encoder, frames, repeats: int) -> dict:
+    sizes, psnrs, times = [], [], []
+    for frame in frames:
+        start = time.perf_counter()
+        for _ in range(repeats):
+            buffer = encoder.encode(frame)
+        times.append((time.perf_counter() - start) / repeats)
+        sizes.append(buffer.nbytes)
+        decoded = cv2.imdecode(buffer, cv2.IMREAD_COLOR)
+        psnrs.append(cv2.PSNR(frame, decoded))
+    return {
+        'encode_ms': 1000 * float(np.mean(times)),
+        'bytes_per_frame': int(np.mean(sizes)),
+        #Lossless encodes come back as inf, which is not valid JSON
+        'psnr_db': float(min(np.mean(psnrs), 99.)),
+    }
+
+def main():
+    parser = ArgumentParser(description='Encoding profile benchmark')
+    parser.add_argument('--images', type=str, default=None,
+                        help='glob of sample frames, synthetic frames otherwise')
+    parser.add_argument('--count', type=int, default=16)
+    parser.add_argument('--width', type=int, default=640)
+    parser.add_argument('--height', type=int, default=480)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--config', action='store_true',
+                        help='benchmark the profiles from config.ini instead of the sweep')
+    args = parser.parse_args()
+
+    if args.images:
+        paths = sorted(glob.glob(args.images))[:args.count]
+        frames = [frame for frame in (cv2.imread(path) for path in paths) if frame is not None]
+        if not frames:
+            raise Exception("No readable images match {}".format(args.images))
+    else:
+        frames = synthetic_frames(args.count, args.width, args.height)
+
+    profiles = SWEEP
+    if args.config:
+        from config import EncodingConfig
+        encoding = EncodingConfig()
+        profiles = {'negative': encoding.negative, 'human': encoding.human}
+
+    report = {name: measure(Encoder(profile), frames, args.repeats) for name, profile in profiles.items()}
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
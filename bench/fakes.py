@@ -0,0 +1,314 @@
+'''
+Deterministic stand-ins for the camera, inference engine, Redis and S3 so
+the pipeline can be benchmarked on any machine
+'''
+
+from collections import defaultdict, deque
+import os
+import threading
+import time
+import types
+
+import cv2
+import numpy as np
+
+
+class SyntheticCapture:
+    '''
+    VideoCapture-like source of synthetic frames: a gradient background,
+    a moving block and sensor noise. fps=None delivers as fast as possible.
+    Like a UVC camera it delivers JPEG bytes once CAP_PROP_CONVERT_RGB is 0
+    '''
+
+    def __init__(self, width: int = 640, height: int = 480, fps: float = None, variants: int = 16):
+        self.fps = fps
+        self.variants = variants
+        self.count = 0
+        self.next_frame = time.time()
+        self.convert = True
+        self._generate(width, height)
+
+    def _generate(self, width, height):
+        rng = np.random.default_rng(0)
+        y, x = np.mgrid[0:height, 0:width]
+        background = np.dstack([x * 255 // width, y * 255 // height,
+                                (x + y) * 255 // (width + height)]).astype(np.uint8)
+        frames = []
+        for i in range(self.variants):
+            frame = background.copy()
+            x0 = (i * width // self.variants) % max(width - 60, 1)
+            cv2.rectangle(frame, (x0, height // 3), (x0 + 60, height // 3 + 120), (40, 40, 200), -1)
+            noise = rng.normal(0, 3, frame.shape)
+            frames.append(np.clip(frame + noise, 0, 255).astype(np.uint8))
+        #What the camera's own encoder would have sent
+        self.jpegs = [cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, 90])[1].reshape(1, -1)
+                      for frame in frames]
+        self.frames = frames
+        self.width, self.height = width, height
+
+    def isOpened(self):
+        return True
+
+    def set(self, prop, value):
+        if prop == cv2.CAP_PROP_FRAME_WIDTH and int(value) != self.width:
+            self._generate(int(value), self.height)
+        elif prop == cv2.CAP_PROP_FRAME_HEIGHT and int(value) != self.height:
+            self._generate(self.width, int(value))
+        elif prop == cv2.CAP_PROP_CONVERT_RGB:
+            self.convert = bool(value)
+        return True
+
+    def get(self, prop):
+        if prop == cv2.CAP_PROP_FRAME_WIDTH:
+            return float(self.width)
+        if prop == cv2.CAP_PROP_FRAME_HEIGHT:
+            return float(self.height)
+        if prop == cv2.CAP_PROP_FPS:
+            return float(self.fps or 0)
+        return 0.
+
+    def read(self, image=None):
+        if self.fps:
+            self.next_frame += 1. / self.fps
+            delay = self.next_frame - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                self.next_frame = time.time()
+        index = self.count % self.variants
+        self.count += 1
+        if not self.convert:
+            #A fresh buffer per read, like the V4L2 backend
+            return True, self.jpegs[index].copy()
+        source = self.frames[index]
+        #Copy like a decoder would, into the caller's buffer when it fits
+        if image is None or image.shape != source.shape:
+            image = np.empty_like(source)
+        np.copyto(image, source)
+        return True, image
+
+    def release(self):
+        pass
+
+
+class FakeDevice:
+    '''
+    An accelerator with a fixed latency per request and streams requests
+    executing at once, e.g. 1 for an NCS stick
+    '''
+
+    def __init__(self, latency: float, streams: int = 1):
+        self.latency = latency
+        self.free_at = [0.] * max(streams, 1)
+        self.lock = threading.Lock()
+        self.latencies = []
+
+    def schedule(self, now: float) -> float:
+        with self.lock:
+            stream = min(range(len(self.free_at)), key=self.free_at.__getitem__)
+            done = max(now, self.free_at[stream]) + self.latency
+            self.free_at[stream] = done
+            return done
+
+
+class FakeInferRequest:
+    RESULT_NOT_READY = -9
+
+    def __init__(self, net, device):
+        self.net = net
+        self.device = device
+        self.outputs = {}
+        self.started = self.done = 0.
+        #Latency is recorded once per request, callers may wait repeatedly
+        self.recorded = True
+
+    def async_infer(self, inputs):
+        self.started = time.time()
+        self.recorded = False
+        self.done = self.device.schedule(self.started)
+        self.outputs = {self.net.output_blob: self.net.respond(inputs[self.net.input_blob])}
+
+    def infer(self, inputs):
+        self.async_infer(inputs)
+        return self.wait(-1)
+
+    def wait(self, timeout):
+        remaining = self.done - time.time()
+        if remaining > 0:
+            if timeout == 0:
+                return self.RESULT_NOT_READY
+            time.sleep(remaining)
+        if not self.recorded:
+            self.recorded = True
+            self.device.latencies.append(self.done - self.started)
+        return 0
+
+
+class FakeNetwork:
+    '''
+    Mimics what OpenVino reads off an IENetwork plus deterministic outputs:
+    every human_every-th image contains one person
+    '''
+
+    def __init__(self, mode: str = 'detect', shape=(1, 3, 300, 300), human_every: int = 10):
+        self.mode = mode
+        self.input_blob = 'data'
+        self.output_blob = 'detection_out' if mode == 'detect' else 'prob'
+        self.inputs = {self.input_blob: types.SimpleNamespace(shape=list(shape))}
+        self.outputs = {self.output_blob: None}
+        self.human_every = human_every
+        self.images = 0
+
+    def respond(self, blob):
+        n = blob.shape[0]
+        humans = [(self.images + i) % self.human_every == 0 if self.human_every else False for i in range(n)]
+        self.images += n
+        if self.mode == 'classify':
+            return np.array([[0.9, 0.1] if human else [0.1, 0.9] for human in humans], dtype=np.float32)
+        rows = [[i, 1, 0.9, 0.3, 0.2, 0.5, 0.8] for i, human in enumerate(humans) if human]
+        rows.append([-1, 0, 0, 0, 0, 0, 0])
+        return np.array(rows, dtype=np.float32).reshape(1, 1, -1, 7)
+
+
+class FakeExecNet:
+    def __init__(self, net, device, num_requests: int = 2):
+        self.requests = [FakeInferRequest(net, device) for _ in range(num_requests)]
+
+
+def fake_engine(base, latency: float, streams: int = 1, human_every: int = 10, shape=(3, 300, 300)):
+    '''
+    Subclass of an OpenVino detector/classifier whose load() returns the
+    fake network instead of touching the inference engine
+    '''
+    device = FakeDevice(latency, streams)
+
+    class FakeEngine(base):
+        def load(self, config, batch_size: int = None):
+            net = FakeNetwork(config.mode, (batch_size or 1,) + tuple(shape), human_every)
+            return net, FakeExecNet(net, device, self.num_requests)
+
+    FakeEngine.device = device
+    return FakeEngine
+
+
+class FakeRedis:
+    '''
+    The handful of list commands the write queue uses, in memory
+    '''
+
+    def __init__(self):
+        self.lists = defaultdict(deque)
+        self.not_empty = threading.Condition()
+
+    def delete(self, name):
+        with self.not_empty:
+            self.lists.pop(name, None)
+
+    def lpush(self, name, value):
+        with self.not_empty:
+            self.lists[name].appendleft(value)
+            self.not_empty.notify()
+
+    def rpop(self, name):
+        with self.not_empty:
+            items = self.lists[name]
+            return items.pop() if items else None
+
+    def brpop(self, name, timeout=0):
+        with self.not_empty:
+            self.not_empty.wait_for(lambda: self.lists[name], timeout or None)
+            items = self.lists[name]
+            return (name, items.pop()) if items else None
+
+    def llen(self, name):
+        return len(self.lists[name])
+
+    def pipeline(self, transaction=True):
+        redis = self
+
+        class Pipeline:
+            def __init__(self):
+                self.calls = []
+
+            def rpop(self, name):
+                self.calls.append(name)
+
+            def execute(self):
+                return [redis.rpop(name) for name in self.calls]
+
+        return Pipeline()
+
+
+class FakeS3:
+    '''
+    S3 client stub that sleeps latency seconds per upload
+    '''
+
+    def __init__(self, latency: float = 0.05):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.objects = {}
+
+    def upload_file(self, file_path, bucket, key):
+        time.sleep(self.latency)
+        size = os.path.getsize(file_path)
+        with self.lock:
+            self.objects[key] = size
+
+    def put_object(self, Bucket, Key, Body):
+        time.sleep(self.latency)
+        with self.lock:
+            self.objects[Key] = len(Body)
+
+
+CONFIG_INI = '''
+[settings]
+model_name = {model}
+default_device = MYRIAD
+fallback_device = CPU
+width = {width}
+height = {height}
+num_requests = {num_requests}
+
+[{model}]
+path_xml = fake.xml
+path_bin = fake.bin
+human_threshold = 0.5
+non_human_threshold = 0.5
+normalize = {normalize}
+
+[outbox]
+rate = 0
+
+{extra}
+'''
+
+def make_config(workdir: str, mode: str = 'detect', width: int = 640, height: int = 480,
+                num_requests: int = 2, extra: str = ''):
+    '''
+    Writes a throwaway blackops/config tree under workdir and loads it
+    '''
+    from dataclasses import fields
+    from config import Config, EncodingConfig, EncodingProfileConfig
+
+    config_dir = os.path.join(workdir, 'blackops', 'config')
+    os.makedirs(config_dir, exist_ok=True)
+    with open(os.path.join(config_dir, 'device_config.txt'), 'w') as f:
+        f.write('bench\nlocal\nus-east-1\n')
+    with open(os.path.join(config_dir, 'aws_key.csv'), 'w') as f:
+        f.write('Access key ID,Secret access key\nBENCH,BENCH\n')
+    model = 'PERSON_DETECTION' if mode == 'detect' else 'PERSON_CLASSIFIER'
+    with open(os.path.join(config_dir, 'config.ini'), 'w') as f:
+        f.write(CONFIG_INI.format(model=model, width=width, height=height,
+                                  num_requests=num_requests, normalize='', extra=extra))
+
+    #Every section reads the same tree, whatever sections Config has
+    sections = {}
+    for section in fields(Config):
+        if section.type is EncodingConfig:
+            sections[section.name] = EncodingConfig(
+                negative=EncodingProfileConfig(SECTION="encoding.negative", BASEPATH=workdir),
+                human=EncodingProfileConfig(SECTION="encoding.human", quality=95, BASEPATH=workdir))
+        else:
+            sections[section.name] = section.type(BASEPATH=workdir)
+    return Config(**sections)
@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+'''
+End-to-end pipeline benchmark on fake backends: synthetic cameras feed the
+real MultiCamera -> BatchScheduler -> OpenVino -> process_result ->
+WriteQueue/Outbox/S3Uploader path, with the inference engine, Redis and S3
+replaced by the stand-ins in bench.fakes
+
+python -m bench.pipeline --duration 30 --cameras 2 --latency 0.03
+python -m bench.pipeline --frames 500 --fps 15 --redis --output report.json
+'''
+
+from argparse import ArgumentParser, Namespace
+import json
+import os
+import resource
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from bench.fakes import FakeRedis, FakeS3, SyntheticCapture, fake_engine, make_config
+from boto import S3Uploader
+from cam import MultiCamera
+from control import LoadController
+from detect import BatchScheduler, OpenVinoClassifierAsync, OpenVinoDetectorAsync
+from encode import Encoder
+from events import EventRecorder
+import metrics
+from motion import MotionGate
+from outbox import Outbox
+from replay import ReplayCapture
+from roi import build_tilers
+from run import bind_metrics, process_result
+from stages import Stage
+from storage import StorageManager
+from write import RedisTransport, WriteQueue
+
+
+def rss_bytes() -> int:
+    '''
+    Current resident set size, peak RSS where /proc is not available
+    '''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def percentiles(samples) -> dict:
+    if not len(samples):
+        return {}
+    values = 1000 * np.asarray(samples, dtype=np.float64)
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {'count': len(values), 'p50_ms': float(p50), 'p95_ms': float(p95),
+            'p99_ms': float(p99), 'max_ms': float(values.max())}
+
+def timed(fn, samples):
+    '''
+    Wraps fn so every call appends its duration to samples
+    '''
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            samples.append(time.perf_counter() - start)
+    return wrapper
+
+def depth_summary(samples) -> dict:
+    if not samples:
+        return {}
+    return {'mean': float(np.mean(samples)), 'max': int(max(samples)), 'last': int(samples[-1])}
+
+def run_benchmark(args) -> dict:
+    workdir = tempfile.mkdtemp(prefix='bench-pipeline-')
+    #Like run.main, fast replay processes every frame
+    policy = 'process_all' if args.video and not args.realtime else args.policy
+    extra = '[write]\nbackend = local\n[pipeline]\npolicy = {}\n'.format(policy)
+    if args.motion:
+        extra += '[motion]\nenabled = true\n'
+    if args.load:
+        extra += '[load]\nenabled = true\ninterval = {}\nlatency_budget = {}\n'.format(
+            args.load_interval, args.latency_budget)
+    if args.tiles:
+        cols, rows = args.tiles.split('x')
+        extra += '[roi]\nenabled = true\ncols = {}\nrows = {}\n'.format(cols, rows)
+        if args.roi:
+            extra += 'cam0 = {}\n'.format(args.roi)
+    if args.events:
+        extra += '[events]\nenabled = true\n'
+    if args.storage_mb:
+        extra += '[storage]\nenabled = true\nmax_mb = {}\ninterval = 0.5\ndelete_uploaded = {}\n'.format(
+            args.storage_mb, args.delete_uploaded)
+    if args.metrics:
+        extra += '[metrics]\nenabled = true\nport = 0\n'
+    config = make_config(workdir, args.mode, args.width, args.height, args.num_requests, extra)
+    #Before any component is built, they look their metrics up once
+    metrics.configure(config.Metrics)
+    bind_metrics()
+
+    if args.video:
+        captures = [ReplayCapture(args.video, args.realtime, encoded=args.mjpeg) for _ in range(args.cameras)]
+    else:
+        captures = [SyntheticCapture(args.width, args.height, args.fps) for _ in range(args.cameras)]
+    cam_args = Namespace(src=0, sources=','.join(str(i) for i in range(args.cameras)),
+                         img_width=args.width, img_height=args.height, ring_size=args.ring,
+                         mjpeg=args.mjpeg)
+    cameras = MultiCamera(cam_args, captures)
+    folders = [os.path.join(workdir, 'tmp', 'cam{}'.format(cam.id), '') for cam in cameras]
+    for folder in folders:
+        os.makedirs(folder, exist_ok=True)
+
+    s3 = FakeS3(args.upload_latency)
+    uploader = S3Uploader(config, client=s3).start()
+    outbox = Outbox(config.Outbox, uploader).start()
+    storage = None
+    if args.storage_mb:
+        storage = StorageManager(config.Storage, os.path.join(workdir, 'tmp', ''), outbox)
+        storage.scan()
+        storage.start()
+    negative_encoder = Encoder(config.Encoding.negative)
+    human_encoder = Encoder(config.Encoding.human)
+    transport = RedisTransport(config.Write.redis_name, FakeRedis()) if args.redis else None
+    write_queue = WriteQueue(config.Write, negative_encoder, transport=transport)
+    if storage is not None:
+        write_queue.listeners.append(storage.written)
+    if args.upload_negatives:
+        write_queue.listeners.append(lambda path, ok: ok and outbox.add(path, Outbox.NEGATIVE))
+    write_queue.start()
+
+    base = OpenVinoDetectorAsync if args.mode == 'detect' else OpenVinoClassifierAsync
+    engine = fake_engine(base, args.latency, args.streams, args.human_every)
+    tilers = build_tilers(config.Roi, len(cameras))
+    slots = sum(len(tiler) for tiler in tilers) if tilers else len(cameras)
+    batch_size = slots if slots > 1 else None
+    detector = engine(config.Inference, batch_size)
+    gates = [MotionGate(config.Motion) for _ in range(len(cameras))] if args.motion else None
+    pipeline = config.Pipeline
+    scheduler = BatchScheduler(cameras, detector, gates, pipeline.policy, pipeline.depth, pipeline.poll, tilers)
+    for cam in cameras:
+        cam.hold = pipeline.policy == 'process_all'
+
+    stages = {'preprocess': [], 'postprocess': [], 'persist': [], 'frame_age': []}
+    detector.preprocessor = timed(detector.preprocessor, stages['preprocess'])
+    detector.postprocess = timed(detector.postprocess, stages['postprocess'])
+    depths = {'persist_queue': [], 'write_queue': [], 'uploader_queue': [], 'outbox_in_flight': [],
+              'outbox_pending': []}
+
+    recorders = [None] * len(cameras)
+    if args.events:
+        recorders = [EventRecorder(config.Events, folders[index], human_encoder, outbox, cam.id)
+                     for index, cam in enumerate(cameras)]
+
+    #Same stage layout as run.main
+    def persist(item):
+        index, done, result = item
+        start = time.perf_counter()
+        process_result(cameras[index], done, result, outbox, write_queue, human_encoder, folders[index],
+                       recorders[index])
+        cameras[index].release(done.seq)
+        stages['persist'].append(time.perf_counter() - start)
+        stages['frame_age'].append(time.time() - done.timestamp)
+        if controller is not None:
+            controller.record(time.time() - done.timestamp)
+    persist_queue = pipeline.persist_queue
+    if pipeline.policy != 'process_all':
+        persist_queue = min(persist_queue, max(args.ring - 2, 1))
+    persister = Stage('persist', persist, persist_queue,
+                      on_drop=lambda item: cameras[item[0]].release(item[1].seq))
+    controller = None
+    if args.load:
+        controller = LoadController(config.Load, cameras, scheduler, negative_encoder,
+                                    write_queue, outbox, persister).start()
+    persister.start()
+
+    def dispatch(results):
+        for index, done, result in results:
+            persister.put((index, done, result), drop=not result and pipeline.policy != 'process_all')
+        return len(results)
+
+    rss_start = rss_bytes()
+    cameras.start()
+    start = time.time()
+    processed = last_sample = 0
+    try:
+        while time.time() - start < args.duration and (not args.frames or processed < args.frames):
+            processed += dispatch(scheduler.step(timeout=1.0))
+            if scheduler.exhausted():
+                break
+            now = time.time()
+            if now - last_sample >= args.sample_interval:
+                last_sample = now
+                depths['persist_queue'].append(len(persister))
+                depths['write_queue'].append(write_queue.get_length())
+                depths['uploader_queue'].append(uploader.queue.qsize())
+                depths['outbox_in_flight'].append(outbox.in_flight)
+                depths['outbox_pending'].append(outbox.counts().get(Outbox.PENDING, 0))
+    finally:
+        processed += dispatch(scheduler.drain())
+        persister.stop()
+        for recorder in recorders:
+            if recorder is not None:
+                recorder.close()
+        if controller is not None:
+            load = {'stride': scheduler.stride, 'scale': controller.scale,
+                    'quality': negative_encoder.quality, 'steps': len(controller.steps)}
+            controller.stop()
+        cameras.stop()
+        elapsed = time.time() - start
+        rss_end = rss_bytes()
+        write_queue.stop()
+        #Give the outbox a moment to empty so the upload numbers mean something
+        deadline = time.time() + args.settle
+        while time.time() < deadline and (outbox.in_flight or outbox.counts().get(Outbox.PENDING)):
+            time.sleep(0.1)
+        counts = outbox.counts()
+        if args.metrics:
+            with open(args.metrics, 'w') as f:
+                f.write(metrics.registry.render())
+        outbox.stop()
+        if storage is not None:
+            storage.stop()
+            stored = {'bytes': storage.bytes, 'files': len(storage.where), 'evicted': storage.evicted,
+                      'deleted': storage.deleted}
+        uploader.stop()
+
+    report = {
+        'config': vars(args),
+        'elapsed_s': elapsed,
+        'frames': processed,
+        'fps': processed / elapsed if elapsed else 0.,
+        'persist_dropped': persister.dropped,
+        'events': sum(recorder.events for recorder in recorders if recorder is not None),
+        'load': load if controller is not None else None,
+        'captured': sum(cam.seq for cam in cameras),
+        'stages': {name: percentiles(samples) for name, samples in stages.items()},
+        'infer': percentiles(engine.device.latencies),
+        'rss': {'start_bytes': rss_start, 'end_bytes': rss_end, 'growth_bytes': rss_end - rss_start},
+        'queue_depth': {name: depth_summary(samples) for name, samples in depths.items()},
+        'write_queue': write_queue.stats(),
+        'uploader': uploader.stats(),
+        'outbox': counts,
+        'storage': stored if storage is not None else None,
+        'uploaded_bytes': sum(s3.objects.values()),
+    }
+    if args.keep:
+        report['workdir'] = workdir
+    else:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return report
+
+def main():
+    parser = ArgumentParser(description='End-to-end pipeline benchmark on fake backends')
+    parser.add_argument('--duration', type=float, default=10., help='seconds to run [10]')
+    parser.add_argument('--frames', type=int, default=0, help='stop after this many frames, 0 runs for --duration')
+    parser.add_argument('--cameras', type=int, default=1)
+    parser.add_argument('--width', type=int, default=640)
+    parser.add_argument('--height', type=int, default=480)
+    parser.add_argument('--fps', type=float, default=30., help='per camera, 0 delivers as fast as possible')
+    parser.add_argument('--video', type=str, default=None,
+                        help='replay a video file, image directory or glob instead of synthetic frames')
+    parser.add_argument('--realtime', action='store_true', help='pace --video to its frame rate')
+    parser.add_argument('--ring', type=int, default=8)
+    parser.add_argument('--mjpeg', action='store_true',
+                        help='MJPEG passthrough: cameras deliver JPEG bytes, negatives are stored as is')
+    parser.add_argument('--mode', choices=('detect', 'classify'), default='detect')
+    parser.add_argument('--latency', type=float, default=0.03, help='fake device seconds per request')
+    parser.add_argument('--streams', type=int, default=1, help='requests the fake device runs at once')
+    parser.add_argument('--num_requests', type=int, default=2)
+    parser.add_argument('--human_every', type=int, default=10, help='every Nth image holds a person, 0 never')
+    parser.add_argument('--policy', choices=BatchScheduler.POLICIES, default='latest',
+                        help='which captured frames get inferred')
+    parser.add_argument('--tiles', type=str, default=None, help='tiled inference, e.g. 2x2')
+    parser.add_argument('--roi', type=str, default=None, help='camera 0 regions with --tiles, e.g. "rect 0,0.3,1,1"')
+    parser.add_argument('--events', action='store_true', help='event clips instead of per frame human uploads')
+    parser.add_argument('--storage_mb', type=float, default=0, help='disk budget of the frame folder, 0 unlimited')
+    parser.add_argument('--delete_uploaded', action='store_true', help='delete files once uploaded')
+    parser.add_argument('--motion', action='store_true', help='enable the motion gate')
+    parser.add_argument('--load', action='store_true', help='enable the load controller')
+    parser.add_argument('--load_interval', type=float, default=1.)
+    parser.add_argument('--latency_budget', type=float, default=0.2)
+    parser.add_argument('--redis', action='store_true', help='write queue over an in-memory Redis')
+    parser.add_argument('--upload_negatives', action='store_true')
+    parser.add_argument('--upload_latency', type=float, default=0.05, help='fake S3 seconds per upload')
+    parser.add_argument('--sample_interval', type=float, default=0.5)
+    parser.add_argument('--settle', type=float, default=5., help='seconds to wait for the outbox at the end')
+    parser.add_argument('--metrics', type=str, default=None,
+                        help='enable instrumentation and write the Prometheus text here at the end')
+    parser.add_argument('--keep', action='store_true', help='keep the work folder')
+    parser.add_argument('--output', type=str, default=None, help='write the JSON report here')
+    args = parser.parse_args()
+    args.fps = args.fps or None
+
+    report = json.dumps(run_benchmark(args), indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report)
+    print(report)
+
+
+if __name__ == "__main__":
+    main()
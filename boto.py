@@ -1,36 +1,126 @@
 #!/usr/bin/env python3
 
+from collections import deque
 from datetime import datetime, timezone
 from enum import Enum
 import json
-from queue import Queue
+from queue import Queue, Empty, Full
 import os
-from threading import Thread
+import socket
+from threading import Event, Lock, Thread
+import time
+from urllib.parse import urlparse
+import http.client
 
-"""
-Boto s3 libraries for session creation
-"""
-import botocore.session
-from botocore.config import Config
-import boto3
-from botocore.exceptions import ClientError
-import subprocess
+import metrics
 
 """
-Request Library for session creation
+boto3/botocore and requests take seconds to import on a Pi. They are
+imported where a client or session is first built, not at startup
 """
-import requests
-from requests.packages.urllib3.util import Retry
-from requests.adapters import HTTPAdapter
-from requests import Session, exceptions
 
 '''
-Ping to check for internet connection
+Background probe to check for internet connection
 '''
+class ConnectivityMonitor(Thread):
+    '''
+    Probes the network every interval seconds with a TCP connect (or an HTTP
+    HEAD when probe_url is set) and caches the result. is_online() never
+    blocks, a state older than ttl just wakes the probe early
+    '''
+
+    def __init__(self, config):
+        Thread.__init__(self, daemon=True)
+        self.config = config
+        self.online = False
+        self.checked = 0.
+        self.wake = Event()
+        self.thread_running = False
+        self.listeners = []
+        metrics.gauge('network_online', 'Last connectivity probe result', fn=lambda: int(self.online))
+
+    def probe(self) -> bool:
+        try:
+            if self.config.probe_url:
+                url = urlparse(self.config.probe_url)
+                connection_class = http.client.HTTPSConnection if url.scheme == 'https' \
+                    else http.client.HTTPConnection
+                conn = connection_class(url.netloc, timeout=self.config.probe_timeout)
+                try:
+                    conn.request('HEAD', url.path or '/')
+                    return conn.getresponse().status < 500
+                finally:
+                    conn.close()
+            socket.create_connection(
+                (self.config.probe_host, self.config.probe_port),
+                timeout=self.config.probe_timeout).close()
+            return True
+        except (OSError, http.client.HTTPException):
+            return False
+
+    def update(self) -> bool:
+        online = self.probe()
+        changed = online != self.online
+        self.online, self.checked = online, time.time()
+        if changed:
+            print("[LOGS] Network is {}".format('online' if online else 'offline'))
+            for listener in self.listeners:
+                listener(online)
+        return online
+
+    def start(self):
+        self.thread_running = True
+        Thread.start(self)
+        return self
+
+    def run(self):
+        while self.thread_running:
+            self.update()
+            self.wake.wait(self.config.probe_interval)
+            self.wake.clear()
+
+    def is_online(self) -> bool:
+        if time.time() - self.checked > self.config.ttl:
+            self.wake.set()
+        return self.online
+
+    def stop(self):
+        self.thread_running = False
+        self.wake.set()
+
+#Shared connectivity monitor and HTTP session
+monitor = None
+http_session = None
+
+def start_monitor(config) -> ConnectivityMonitor:
+    global monitor
+    if monitor is None:
+        monitor = ConnectivityMonitor(config.Network).start()
+    return monitor
+
 def isConnected():
-    p = subprocess.Popen(['ping', '8.8.8.8', '-n', '-c', '1', '-W', '1'])
-    p.wait()
-    return not (p.poll())
+    '''
+    Cached, non-blocking connectivity state
+    '''
+    if monitor is None:
+        return False
+    return monitor.is_online()
+
+def get_session(pool_size: int = 4):
+    '''
+    One keep-alive session with a connection pool for every request
+    '''
+    global http_session
+    if http_session is None:
+        from requests import Session
+        from requests.adapters import HTTPAdapter
+        from requests.packages.urllib3.util import Retry
+        http_session = Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+                              max_retries=Retry(total=0))
+        http_session.mount('https://', adapter)
+        http_session.mount('http://', adapter)
+    return http_session
 
 def sendReq(url: str, data: json, timeout: int):
     '''
@@ -38,9 +128,8 @@ def sendReq(url: str, data: json, timeout: int):
     '''
     if isConnected():
         try:
-            s = Session()
-            s.mount('https://', HTTPAdapter(max_retries=Retry(total=0)))
-            r = s.post(url, json=data, timeout=timeout)
+            pool_size = monitor.config.http_pool if monitor else 4
+            r = get_session(pool_size).post(url, json=data, timeout=timeout)
             return r
         except:
             print('[ALERT] POST request failed')
@@ -51,44 +140,210 @@ def sendReq(url: str, data: json, timeout: int):
 """
 Boto S3 instance - manages data and utility functions
 """
-class AWSSessionUpload(Thread):
+def object_key(file_path: str, config) -> str:
+    '''
+    location-name/data/[camN/]file under the device folder
+    '''
+    device_folder = config.Device.location + '-' + config.Device.name
+    #Keep the per-camera folder (tmp/camN/) in the key
+    file_timestamp = file_path.split('/')[-1]
+    parent = file_path.split('/')[-2:-1]
+    if parent and parent[0].startswith('cam'):
+        file_timestamp = os.path.join(parent[0], file_timestamp)
+    return os.path.join(device_folder, config.AWS.DATA_FOLDER, file_timestamp)
 
-    def __init__(self, file_path, config):
-        Thread.__init__(self)
-        self.file_path = file_path
+class S3Uploader:
+    '''
+    Long lived upload service: a bounded queue drained by a fixed pool of
+    worker threads sharing one S3 client and its connection pool
+    '''
+
+    POLICIES = ('block', 'drop_new', 'drop_oldest')
+
+    def __init__(self, config, client=None):
         self.config = config.AWS
         self.device = config.Device
+        self.full_config = config
+        if self.config.UPLOAD_POLICY not in self.POLICIES:
+            raise Exception("Unknown upload policy {}".format(self.config.UPLOAD_POLICY))
+        #Built by the first upload, so boto3 is not imported at startup
+        self.client = client
+        self.client_lock = Lock()
+        #Errors worth a retry, narrowed to boto's once the real client is built
+        self.retry_errors = (OSError, Exception)
+        self.queue = Queue(maxsize=self.config.UPLOAD_QUEUE)
+        self.stats_lock = Lock()
+        self.uploaded = 0
+        self.failed = 0
+        self.dropped = 0
+        self.latencies = deque(maxlen=256)
+        self.thread_running = False
+        self.threads = []
+        self.upload_time = metrics.histogram('upload_seconds', 'One upload including retries')
+        metrics.gauge('upload_queue_depth', 'Files waiting for an upload worker', fn=self.queue.qsize)
+        metrics.counter('upload_files_total', 'Files uploaded', fn=lambda: self.uploaded)
+        metrics.counter('upload_failures_total', 'Uploads that failed after all retries', fn=lambda: self.failed)
+        metrics.counter('upload_dropped_total', 'Uploads dropped by the queue policy', fn=lambda: self.dropped)
 
-    def run(self):
+    def get_client(self):
+        with self.client_lock:
+            if self.client is None:
+                self.client = self._client()
+            return self.client
+
+    def _client(self):
+        import boto3
+        from botocore.config import Config
+        from botocore.exceptions import BotoCoreError, ClientError
+        self.retry_errors = (BotoCoreError, ClientError, OSError)
         session_config = Config(
             connect_timeout= self.config.C_TIME, 
             read_timeout= self.config.R_TIME, 
-            retries={'max_attempts':self.config.MAX_RETRIES} #We're gonna declare 0 attempts for now
+            retries={'max_attempts':self.config.MAX_RETRIES}, #Retries are handled by the workers
+            max_pool_connections=max(self.config.UPLOAD_WORKERS, 1)
             )
         session = boto3.session.Session()
         #boto3.set_stream_logger('')
-        self.s3 = session.resource('s3', 
+        return session.client('s3', 
             aws_access_key_id = self.config.key_id,
             aws_secret_access_key = self.config.access_key,
             region_name = self.device.region,
+            endpoint_url = self.config.ENDPOINT_URL,
             config=session_config
             )
-    
-        #if isConnected():
+
+    def start(self):
+        if self.thread_running:
+            raise Exception('Upload workers are already running')
+        self.thread_running = True
+        print("[LOGS] STARTING {} UPLOAD WORKERS".format(self.config.UPLOAD_WORKERS))
+        for _ in range(max(self.config.UPLOAD_WORKERS, 1)):
+            thread = Thread(target=self.work, args=(), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        return self
+
+    def submit(self, file_path: str, key: str = None, callback=None) -> bool:
+        '''
+        Queues file_path for upload, callback(file_path, ok) runs on the
+        worker once it is done. Returns False if the task was dropped
+        '''
+        task = (file_path, key or object_key(file_path, self.full_config), callback, time.time())
+        if self.config.UPLOAD_POLICY == 'block':
+            self.queue.put(task)
+            return True
         try:
-            device_folder = self.device.location + '-' + self.device.name
-            file_timestamp = self.file_path.split('/')[-1]
-            key = os.path.join(device_folder, self.config.DATA_FOLDER, file_timestamp)
-            self.s3.Bucket(self.config.BUCKET_NAME).upload_file(self.file_path, key)
-            #print("[LOGS] Uploaded image {0} to {1}".format(self.file_path, key))
-            return 200 
-    
-        except ClientError as e:
-            print('[ALERT] Boto upload FAILED: ',e)
-            return 400
-    
+            self.queue.put_nowait(task)
+            return True
+        except Full:
+            if self.config.UPLOAD_POLICY == 'drop_new':
+                self._drop(task)
+                return False
+        #drop_oldest: make room by evicting the head of the queue
+        try:
+            self._drop(self.queue.get_nowait())
+        except Empty:
+            pass
+        try:
+            self.queue.put_nowait(task)
+            return True
+        except Full:
+            self._drop(task)
+            return False
+
+    def _drop(self, task):
+        file_path, _, callback, _ = task
+        with self.stats_lock:
+            self.dropped += 1
+        print('[ALERT] Upload queue full, dropped {}'.format(file_path))
+        if callback:
+            callback(file_path, False)
+
+    def upload(self, file_path: str, key: str) -> bool:
+        '''
+        Uploads with exponential backoff, each wait capped at the read timeout
+        '''
+        try:
+            client = self.get_client()
+        except Exception as e:
+            print('[ALERT] Could not create the S3 client: ', e)
+            return False
+        for attempt in range(self.config.UPLOAD_RETRIES + 1):
+            try:
+                client.upload_file(file_path, self.config.BUCKET_NAME, key)
+                #print("[LOGS] Uploaded image {0} to {1}".format(file_path, key))
+                return True
+            except self.retry_errors as e:
+                print('[ALERT] Boto upload FAILED (attempt {}): '.format(attempt + 1), e)
+                if attempt < self.config.UPLOAD_RETRIES:
+                    time.sleep(min(self.config.RETRY_BACKOFF * 2 ** attempt, self.config.R_TIME))
+        return False
+
+    def work(self):
+        while True:
+            task = self.queue.get()
+            if task is None:
+                break
+            file_path, key, callback, queued = task
+            start = time.time()
+            ok = self.upload(file_path, key)
+            self.upload_time.observe(time.time() - start)
+            with self.stats_lock:
+                if ok:
+                    self.uploaded += 1
+                    self.latencies.append(time.time() - start)
+                else:
+                    self.failed += 1
+            if callback:
+                callback(file_path, ok)
+
+    def stats(self) -> dict:
+        with self.stats_lock:
+            latencies = sorted(self.latencies)
+            stats = {
+                'queue_depth': self.queue.qsize(),
+                'uploaded': self.uploaded,
+                'failed': self.failed,
+                'dropped': self.dropped,
+            }
+        if latencies:
+            stats['latency_p50'] = latencies[len(latencies) // 2]
+            stats['latency_p95'] = latencies[min(int(len(latencies) * 0.95), len(latencies) - 1)]
+        return stats
+
+    def stop(self):
+        '''
+        Lets the workers finish what is queued, then joins them
+        '''
+        if not self.thread_running:
+            return
+        self.thread_running = False
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+#Shared by every upload_frame call
+uploader = None
+
+def get_uploader(config) -> S3Uploader:
+    global uploader
+    if uploader is None:
+        uploader = S3Uploader(config).start()
+    return uploader
+
 def upload_frame(frame_file: str, Config):
-    return AWSSessionUpload(frame_file, Config).start()
+    return get_uploader(Config).submit(frame_file)
+
+def stop_uploads():
+    global uploader, monitor
+    if uploader is not None:
+        uploader.stop()
+        uploader = None
+    if monitor is not None:
+        monitor.stop()
+        monitor = None
 
 '''
 Function for going down presigned url path
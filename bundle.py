@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+'''
+Groups negative frames into time-windowed segments, one upload each
+'''
+
+from datetime import datetime, timezone
+import io
+import json
+import os
+import tarfile
+import threading
+import time
+
+import cv2
+
+
+class Segment(object):
+    '''
+    One open bundle: a tar of encoded frames with a timestamp index, or an
+    MJPEG .avi written through cv2.VideoWriter
+    '''
+    def __init__(self, folder, config, encoder):
+        self.config = config
+        self.encoder = encoder
+        self.started = time.time()
+        self.count = 0
+        self.index = []
+        self.closed = False
+        #Set when a frame cannot go into this segment, e.g. a new resolution
+        self.full = False
+        self.lock = threading.Lock()
+        stamp = datetime.fromtimestamp(self.started, tz=timezone.utc).strftime('%Y-%m-%d-%H-%M-%S-%f')
+        if config.format == 'mjpeg':
+            self.path = os.path.join(folder, 'segment-' + stamp + '.avi')
+            self.writer = None
+        else:
+            self.path = os.path.join(folder, 'segment-' + stamp + '.tar')
+            self.tar = tarfile.open(self.path, 'w')
+
+    def expired(self, now) -> bool:
+        return self.full or now - self.started >= self.config.window or \
+            self.count >= self.config.max_frames
+
+    def add(self, image_path, frame, timestamp: float = None) -> bool:
+        '''
+        False once the segment has been closed. timestamp is the capture
+        time that goes into the index, now when unknown
+        '''
+        now = time.time()
+        timestamp = timestamp or now
+        name = os.path.basename(image_path)
+        #1-D frames are the camera's own JPEG bytes, see Camera.passthrough
+        encoded = frame.ndim == 1
+        if self.config.format == 'mjpeg':
+            if encoded:
+                #The clip is transcoded anyway, VideoWriter only takes pixels
+                frame = cv2.imdecode(frame, cv2.IMREAD_COLOR)
+                if frame is None:
+                    raise IOError("Could not decode {}".format(image_path))
+            #VideoWriter encodes internally and needs frames in order
+            with self.lock:
+                if self.closed or self.count >= self.config.max_frames:
+                    return False
+                if self.writer is None:
+                    self.shape = frame.shape
+                    height, width = frame.shape[:2]
+                    self.writer = cv2.VideoWriter(self.path, cv2.VideoWriter_fourcc(*'MJPG'),
+                                                  self.config.fps, (width, height))
+                elif frame.shape != self.shape:
+                    self.full = True
+                    return False
+                self.writer.write(frame)
+                self.index.append({'name': name, 'timestamp': timestamp})
+                self.count += 1
+            return True
+        #Encoding runs on the caller's thread, only the append is serialised
+        if encoded:
+            data = frame.tobytes()
+            info = tarfile.TarInfo(os.path.splitext(name)[0] + '.jpg')
+        else:
+            data = self.encoder.encode(frame).tobytes()
+            info = tarfile.TarInfo(self.encoder.path(name))
+        info.size, info.mtime = len(data), now
+        with self.lock:
+            if self.closed or self.count >= self.config.max_frames:
+                return False
+            self.tar.addfile(info, io.BytesIO(data))
+            self.index.append({'name': info.name, 'timestamp': timestamp})
+            self.count += 1
+        return True
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            if self.config.format == 'mjpeg':
+                if self.writer is not None:
+                    self.writer.release()
+                return
+            #Encoder threads may finish out of order, the index is by capture time
+            self.index.sort(key=lambda entry: entry['timestamp'])
+            data = json.dumps({'frames': self.index}).encode()
+            info = tarfile.TarInfo('index.json')
+            info.size, info.mtime = len(data), time.time()
+            self.tar.addfile(info, io.BytesIO(data))
+            self.tar.close()
+
+class SegmentBundler(object):
+    '''
+    One open segment per output folder (i.e. per camera). Segments close
+    after window seconds or max_frames frames and are handed to listeners,
+    e.g. the outbox, as a single file
+    '''
+    def __init__(self, config, encoder):
+        if config.format not in ('tar', 'mjpeg'):
+            raise Exception("Unknown bundle format {}".format(config.format))
+        self.config = config
+        self.encoder = encoder
+        self.segments = {}
+        self.lock = threading.Lock()
+        #Called with the path of every closed segment
+        self.listeners = []
+
+    def _segment(self, folder) -> Segment:
+        closed = None
+        with self.lock:
+            segment = self.segments.get(folder)
+            if segment is not None and segment.expired(time.time()):
+                closed, segment = segment, None
+            if segment is None:
+                segment = self.segments[folder] = Segment(folder, self.config, self.encoder)
+        if closed is not None:
+            self._close(closed)
+        return segment
+
+    def _close(self, segment):
+        segment.close()
+        if segment.count == 0:
+            if os.path.exists(segment.path):
+                os.remove(segment.path)
+            return
+        print("[LOGS] Bundled {} frames into {}".format(segment.count, segment.path))
+        for listener in self.listeners:
+            listener(segment.path)
+
+    def add(self, image_path, frame, timestamp: float = None):
+        '''
+        Appends a frame to the segment of its folder, returns the segment path
+        '''
+        folder = os.path.dirname(image_path) or '.'
+        segment = self._segment(folder)
+        #The segment may have rolled over while this frame was being encoded
+        while not segment.add(image_path, frame, timestamp):
+            segment = self._segment(folder)
+        return segment.path
+
+    def tick(self):
+        '''
+        Closes segments whose window ran out while no frames arrived
+        '''
+        now = time.time()
+        with self.lock:
+            expired = [folder for folder, segment in self.segments.items() if segment.expired(now)]
+            closed = [self.segments.pop(folder) for folder in expired]
+        for segment in closed:
+            self._close(segment)
+
+    def close(self):
+        with self.lock:
+            closed = list(self.segments.values())
+            self.segments = {}
+        for segment in closed:
+            self._close(segment)
@@ -2,9 +2,17 @@
 An asynchronous camera capture class
 '''
 
+from copy import copy
+from dataclasses import dataclass
 import threading
 import argparse
+import time
+
 import cv2
+import numpy as np
+
+import metrics
+from replay import is_replay, ReplayCapture
 
 #Note to self. We really don't need the argument parsers anymore...
 def add_camera_args(parser):
@@ -18,44 +26,147 @@ def add_camera_args(parser):
                         'also set --filename)',
                         action='store_true')
     parser.add_argument('--filename', dest='filename',
-                        help='video file name, e.g. test.mp4',
+                        help='video file, image directory or glob pattern, '
+                        'e.g. test.mp4 or "footage/*.mp4"',
                         default=None, type=str)
+    parser.add_argument('--realtime', dest='realtime',
+                        help='pace file replay to the recorded frame rate '
+                        'instead of playing as fast as possible',
+                        action='store_true')
+    parser.add_argument('--replay_fps', dest='replay_fps',
+                        help='frame rate of replayed images [10]',
+                        default=10., type=float)
     parser.add_argument('--src', dest='src',
                         help='set source of USB webcam',
                         default=0, type=int)
+    parser.add_argument('--sources', dest='sources',
+                        help='comma separated USB indices or RTSP urls, '
+                        'overrides --src, e.g. 0,1,rtsp://host/stream',
+                        default=None, type=str)
     parser.add_argument('--width', dest='img_width',
                         help='image width [640]',
                         default=640, type=int)
     parser.add_argument('--height', dest='img_height',
                         help='image height [480]',
                         default=480, type=int)
+    parser.add_argument('--ring', dest='ring_size',
+                        help='number of preallocated frame buffers [8]',
+                        default=8, type=int)
+    parser.add_argument('--mjpeg', dest='mjpeg',
+                        help='capture MJPEG and keep the camera\'s JPEG bytes, '
+                        'frames are only decoded once inference needs them',
+                        action='store_true')
     return parser
 
+def is_jpeg(buffer) -> bool:
+    '''
+    A complete JPEG runs from the SOI to the EOI marker, some cameras pad
+    their buffers after it
+    '''
+    data = buffer.reshape(-1)
+    return len(data) > 4 and data[0] == 0xFF and data[1] == 0xD8 and b'\xff\xd9' in data[-64:].tobytes()
+
+@dataclass(frozen=True)
+class Frame:
+    '''
+    Read-only view into a Camera ring slot. The slot is reused once the
+    camera has captured ring_size - 1 newer frames, see Camera.is_valid
+    '''
+    data: np.ndarray
+    seq: int
+    timestamp: float
+    #The camera's JPEG of data in passthrough mode, None otherwise
+    encoded: np.ndarray = None
+    #data is no longer backed by the ring, see Camera.detach
+    detached: bool = False
+
 class Camera:
-    def __init__(self, args):
+    def __init__(self, args, cap=None):
         self.id = 0
         self.src = args.src
+        #cap can be anything VideoCapture-like, e.g. a synthetic source
+        if cap is None and is_replay(self.src):
+            cap = ReplayCapture(self.src, getattr(args, 'realtime', False), getattr(args, 'replay_fps', 10.),
+                                encoded=getattr(args, 'mjpeg', False))
         try: 
-            self.cap = cv2.VideoCapture(self.src)
+            self.cap = cap if cap is not None else cv2.VideoCapture(self.src)
         except: 
             raise Exception("Failed to bring up device {}".format(self.src))
         self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, args.img_width)
         self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, args.img_height)
-        self.grabbed, self.frame = self.cap.read()
+        if getattr(args, 'mjpeg', False):
+            #Ask for the compressed stream as delivered, without the decode
+            self.cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*'MJPG'))
+            self.cap.set(cv2.CAP_PROP_CONVERT_RGB, 0)
+        self.grabbed, first = self.cap.read()
+        if not self.grabbed:
+            raise Exception("Failed to read from device {}".format(self.src))
+        self.ring_size = max(getattr(args, 'ring_size', 8), 2)
+        #In passthrough mode the capture thread only keeps the JPEG bytes and
+        #a slot is decoded once a consumer asks for it, see _frame
+        self.passthrough = first.ndim < 3 and first.dtype == np.uint8 and is_jpeg(first)
+        self.encoded = [None] * self.ring_size
+        self.decoded = [-1] * self.ring_size
+        if self.passthrough:
+            self.encoded[0] = first.reshape(-1)
+            first = cv2.imdecode(self.encoded[0], cv2.IMREAD_COLOR)
+            self.decoded[0] = 0
+            print("[LOGS] CAMERA {} MJPEG PASSTHROUGH".format(self.src))
+        elif getattr(args, 'mjpeg', False):
+            print("[LOGS] CAMERA {} delivers decoded frames, MJPEG passthrough is off".format(self.src))
+
+        #Preallocated ring of frame buffers that grab_img decodes into
+        self.ring = [np.empty_like(first) for _ in range(self.ring_size)]
+        self.ring[0][...] = first
+        self.seq = 0
+        self.timestamp = time.time()
+        self.timestamps = [self.timestamp] * self.ring_size
+        #With hold set the capture thread waits instead of overwriting frames
+        #newer than released, see release()
+        self.hold = False
+        self.released = -1
+
         self.read_lock = threading.Lock()
+        self.new_frame = threading.Condition(self.read_lock)
         self.write_lock = threading.Lock()
+        #cap.set calls waiting for the capture thread, see set()
+        self.pending = []
         self.thread_running = False
+        #Events set on every new frame, see MultiCamera
+        self.listeners = []
 
         self.width = self.cap.get(3)
         self.height = self.cap.get(4)
 
     def set(self, var1, var2):
-        self.cap.set(var1, var2)
+        '''
+        VideoCapture is not thread safe, while the capture thread runs the
+        property is applied by it between two reads
+        '''
+        with self.write_lock:
+            if not self.thread_running:
+                self.cap.set(var1, var2)
+                return
+            self.pending.append((var1, var2))
+
+    def _apply_pending(self):
+        with self.write_lock:
+            pending, self.pending = self.pending, []
+        for var1, var2 in pending:
+            self.cap.set(var1, var2)
+        if pending:
+            self.width = self.cap.get(3)
+            self.height = self.cap.get(4)
 
     def start(self):
         if self.thread_running:
             raise Exception('Camera Thread is already running')
         self.thread_running = True
+        #Looked up here since MultiCamera assigns the id after construction
+        camera = str(self.id)
+        self.read_time = metrics.histogram('camera_read_seconds', 'Time blocked in cap.read', camera=camera)
+        self.read_failures = metrics.counter('camera_read_failures_total', 'Reads that returned no frame', camera=camera)
+        metrics.counter('camera_frames_total', 'Frames captured', fn=lambda: self.seq, camera=camera)
         print("[LOGS] STARTING CAMERA THREAD")
         self.thread = threading.Thread(target=self.grab_img, args=())
         self.thread.start()
@@ -63,20 +174,217 @@ class Camera:
 
     def grab_img(self):
         while self.thread_running:
-            grabbed, frame = self.cap.read()
-            with self.read_lock:
+            #The next slot is never the one handed out by read()
+            seq = self.seq + 1
+            slot = seq % self.ring_size
+            if self.hold:
+                #Writing seq invalidates every frame up to seq + 1 - ring_size
+                with self.new_frame:
+                    self.new_frame.wait_for(lambda: self.released >= seq + 1 - self.ring_size or
+                                            not self.thread_running)
+                if not self.thread_running:
+                    break
+            if self.pending:
+                self._apply_pending()
+            started = time.time()
+            if self.passthrough:
+                grabbed, frame = self.cap.read()
+                if grabbed and frame.ndim < 3 and not is_jpeg(frame):
+                    #Truncated or corrupt JPEG, e.g. a USB hiccup
+                    grabbed = False
+            else:
+                grabbed, frame = self.cap.read(image=self.ring[slot])
+            timestamp = time.time()
+            self.read_time.observe(timestamp - started)
+            if not grabbed:
+                if getattr(self.cap, 'finished', False):
+                    #End of a replayed recording, not a camera hiccup
+                    print("[LOGS] CAMERA {} REPLAY FINISHED after {} frames".format(self.id, self.seq + 1))
+                    with self.new_frame:
+                        self.thread_running = False
+                        self.new_frame.notify_all()
+                    for listener in self.listeners:
+                        listener.set()
+                    break
+                self.read_failures.inc()
+            with self.new_frame:
                 self.grabbed = grabbed
-                self.frame = frame
+                if grabbed:
+                    if self.passthrough and frame.ndim < 3:
+                        self.encoded[slot] = frame.reshape(-1)
+                        self.decoded[slot] = -1
+                    elif self.passthrough:
+                        #e.g. a replayed PNG among JPEGs
+                        self.ring[slot] = frame
+                        self.encoded[slot] = None
+                        self.decoded[slot] = seq
+                    #Decoder allocated a new buffer (e.g. resolution change)
+                    elif frame is not self.ring[slot]:
+                        self.ring[slot] = frame
+                    self.seq = seq
+                    self.timestamp = timestamp
+                    self.timestamps[slot] = timestamp
+                self.new_frame.notify_all()
+            for listener in self.listeners:
+                listener.set()
+
+    def _decode(self, slot: int, seq: int):
+        '''
+        Decodes a passthrough slot, at most once per captured frame. Runs
+        under read_lock, the capture thread keeps reading meanwhile
+        '''
+        frame = cv2.imdecode(self.encoded[slot], cv2.IMREAD_COLOR)
+        if frame is None:
+            print("[ALERT] CAMERA {} could not decode frame {}".format(self.id, seq))
+            frame = np.zeros_like(self.ring[slot])
+        self.ring[slot] = frame
+        self.decoded[slot] = seq
+
+    def _frame(self, seq: int) -> Frame:
+        slot = seq % self.ring_size
+        if self.passthrough and self.decoded[slot] != seq:
+            self._decode(slot, seq)
+        view = self.ring[slot].view()
+        view.flags.writeable = False
+        return Frame(view, seq, self.timestamps[slot], self.encoded[slot])
+
+    def _latest(self) -> Frame:
+        return self._frame(self.seq)
 
     def read(self):
+        '''
+        Returns the latest frame without copying it
+        '''
+        with self.read_lock:
+            return self.grabbed, self._latest()
+
+    def wait_for(self, seq: int, timeout: float = None):
+        '''
+        Blocks until a frame newer than seq has been captured.
+        Returns (False, None) on timeout or once the camera is stopped
+        '''
+        with self.new_frame:
+            ready = self.new_frame.wait_for(
+                lambda: self.seq > seq or not self.thread_running, timeout)
+            if not ready or self.seq <= seq:
+                return False, None
+            return self.grabbed, self._latest()
+
+    def next_frame(self, after: int, policy: str = 'latest', depth: int = 1):
+        '''
+        The frame to process after seq after: the newest one (latest), the
+        next one within the depth newest (drop_oldest) or simply the next
+        one (process_all). Returns the latest frame when nothing is newer
+        '''
+        with self.read_lock:
+            if policy == 'latest' or self.seq <= after:
+                return self.grabbed, self._latest()
+            #Frames older than this may already be half overwritten
+            oldest = self.seq - self.ring_size + 2
+            if policy == 'drop_oldest':
+                oldest = max(oldest, self.seq - depth + 1)
+            return self.grabbed, self._frame(max(after + 1, oldest))
+
+    def release(self, seq: int):
+        '''
+        Frames up to seq are done with and may be overwritten under hold
+        '''
+        with self.new_frame:
+            if seq > self.released:
+                self.released = seq
+                self.new_frame.notify_all()
+
+    def is_valid(self, frame: Frame) -> bool:
+        '''
+        True while the ring slot behind frame has not been recycled
+        '''
+        if frame.detached:
+            return True
         with self.read_lock:
-            frame = self.frame.copy()
-            grabbed = self.grabbed
-        return grabbed, frame
+            return self.seq - frame.seq < self.ring_size - 1
+
+    def detach(self, frame: Frame) -> Frame:
+        '''
+        frame with data the capture thread never overwrites, so it survives
+        inference and persisting at any ring size. None once it was recycled
+        '''
+        with self.read_lock:
+            if self.seq - frame.seq >= self.ring_size - 1:
+                return None
+            #Passthrough slots are decoded into fresh buffers, never in place
+            data = frame.data if self.passthrough else frame.data.copy()
+        data.flags.writeable = False
+        return Frame(data, frame.seq, frame.timestamp, frame.encoded, detached=True)
 
     def stop(self):
         self.thread_running = False
+        with self.new_frame:
+            self.new_frame.notify_all()
         self.thread.join()
 
     def __exit__(self, exec_type, exc_value, traceback):
-        self.cap.release()
\ No newline at end of file
+        self.cap.release()
+
+def parse_sources(args):
+    '''
+    USB indices become ints, anything else (RTSP urls, files) stays a string
+    '''
+    if not getattr(args, 'sources', None):
+        if (getattr(args, 'use_file', False) or getattr(args, 'use_image', False)) and args.filename:
+            return [args.filename]
+        return [args.src]
+    sources = [src.strip() for src in args.sources.split(',') if src.strip()]
+    return [int(src) if src.isdigit() else src for src in sources]
+
+class MultiCamera:
+    '''
+    A set of Camera threads, one per source
+    '''
+
+    def __init__(self, args, captures=None):
+        self.frame_ready = threading.Event()
+        self.cameras = []
+        sources = parse_sources(args)
+        captures = captures or [None] * len(sources)
+        for index, (src, cap) in enumerate(zip(sources, captures)):
+            cam_args = copy(args)
+            cam_args.src = src
+            cam = Camera(cam_args, cap)
+            cam.id = index
+            cam.listeners.append(self.frame_ready)
+            self.cameras.append(cam)
+
+    def __len__(self):
+        return len(self.cameras)
+
+    def __getitem__(self, index) -> Camera:
+        return self.cameras[index]
+
+    def start(self):
+        for cam in self.cameras:
+            cam.start()
+        return self
+
+    def read(self):
+        return [cam.read() for cam in self.cameras]
+
+    def wait_for(self, seqs, timeout: float = None, policy: str = 'latest', depth: int = 1):
+        '''
+        Blocks until any camera has a frame newer than its entry in seqs and
+        returns the (grabbed, Frame) each camera should process next, see
+        Camera.next_frame, or None on timeout
+        '''
+        while True:
+            #Clear before checking so a frame landing in between still wakes us
+            self.frame_ready.clear()
+            if any(cam.seq > seq for cam, seq in zip(self.cameras, seqs)):
+                return [cam.next_frame(seq, policy, depth) for cam, seq in zip(self.cameras, seqs)]
+            if not any(cam.thread_running for cam in self.cameras):
+                return None
+            if not self.frame_ready.wait(timeout):
+                return None
+
+    def stop(self):
+        for cam in self.cameras:
+            cam.stop()
+        self.frame_ready.set()
@@ -52,6 +52,14 @@ class AWSConfig:
     R_TIME: int = 5 #Response timeout
     MAX_RETRIES: int = 0 #Why have this as a param if multi retry fails?
 
+    #Pooled uploader, see boto.S3Uploader
+    ENDPOINT_URL: str = None #Local S3 stand-in (minio, moto) for testing
+    UPLOAD_WORKERS: int = 2
+    UPLOAD_QUEUE: int = 64
+    UPLOAD_POLICY: str = "drop_oldest" #block, drop_new or drop_oldest when the queue is full
+    UPLOAD_RETRIES: int = 3
+    RETRY_BACKOFF: float = 1.0 #Doubles per attempt, capped at R_TIME
+
     def __post_init__(self):
         basepath = os.path.expanduser(self.BASEPATH)
         filepath = os.path.join(self.WORK_FOLDER, self.CONFIG_FOLDER, self.AWS_KEY_PATH)
@@ -114,6 +122,20 @@ class InferenceConfig:
 
         self.default_device = config['settings']['default_device']
         self.fallback_device = config['settings']['fallback_device']
+        #Number of infer requests kept in flight
+        self.num_requests = int(config['settings'].get('num_requests', 2))
+        #ie, dnn, onnx or auto (first of them that loads), see backends.py
+        self.backend = config['settings'].get('backend', 'auto').lower()
+        #Time every candidate backend/device on warm-up frames and keep the fastest
+        self.autotune = config['settings'].getboolean('autotune', fallback=False)
+        self.warmup_frames = int(config['settings'].get('warmup_frames', 10))
+        #Worker processes with a network each, 0 runs inference in this process.
+        #num_requests should be at least workers to keep them all busy
+        self.workers = int(config['settings'].get('workers', 0))
+        self.worker_threads = int(config['settings'].get('worker_threads', 1))
+        self.worker_timeout = float(config['settings'].get('worker_timeout', 10.0))
+        #Compiled networks and autotune results, keyed by model hash. Empty disables
+        self.cache_dir = config['settings'].get('cache_dir', os.path.join(basepath, self.WORK_FOLDER, 'cache'))
 
         self.frame_width = config['settings']['width']
         self.frame_height = config['settings']['height']
@@ -124,21 +146,401 @@ class InferenceConfig:
         model_config = config[self.model_name]
         self.network_file = model_config['path_xml']
         self.weights_file = model_config['path_bin']
+        #Optional ONNX export for onnxruntime, or cv2.dnn builds without IR support
+        self.onnx_file = model_config.get('path_onnx', '')
+        #NCHW, e.g. 1,3,300,300, only needed when the IR cannot be parsed for it
+        self.input_shape = None
+        if 'input_shape' in model_config:
+            self.input_shape = [int(dim) for dim in model_config['input_shape'].split(',')]
 
         self.threshold = float(model_config['human_threshold'])
         if 'non_human_threshold' in model_config: 
             self.non_threshold = float(model_config['non_human_threshold'])
         self.normalize = bool(model_config['normalize'])
+        #Detection post-processing: NMS is off unless an IoU threshold is set
+        self.nms_threshold = float(model_config['nms_threshold']) if 'nms_threshold' in model_config else None
+        self.track_iou = float(model_config.get('track_iou', 0.3))
+        self.track_max_missed = int(model_config.get('track_max_missed', 5))
         if 'width' in model_config and 'height' in model_config: 
             self.frame_width = model_config['width']
             self.frame_height = model_config['height']
 
+#Every section reads the same config.ini, parse it once per change
+_parsed = {}
+
+def read_ini(path: str):
+    '''
+    Parsed config file, None when it cannot be read
+    '''
+    try:
+        key = (path, os.stat(path).st_mtime_ns)
+    except OSError:
+        return None
+    if key not in _parsed:
+        config = configparser.ConfigParser()
+        with open(path, 'r') as f:
+            config.read_file(f)
+        _parsed[key] = config
+    return _parsed[key]
+
+@dataclass
+class IniSection:
+    """
+    Optional section of config.ini, keys that are not set keep their defaults
+    """
+    BASEPATH: str = "~"
+    WORK_FOLDER: str = "blackops"
+    CONFIG_FOLDER: str = "config"
+    MODEL_CONFIG_FILE: str = "config.ini"
+    SECTION: str = "settings"
+
+    def read_section(self):
+        basepath = os.path.expanduser(self.BASEPATH)
+        path = os.path.join(basepath, self.WORK_FOLDER, self.CONFIG_FOLDER, self.MODEL_CONFIG_FILE)
+        config = read_ini(path)
+        if config is None:
+            raise Exception("{} file is missing".format(self.MODEL_CONFIG_FILE))
+        if self.SECTION in config:
+            return config[self.SECTION]
+        return config[config.default_section]
+
+@dataclass
+class MotionConfig(IniSection):
+    """
+    Pre-inference motion gate, [motion] in config.ini
+    """
+    SECTION: str = "motion"
+
+    enabled: bool = False
+    width: int = 160 #Width of the downscaled grayscale copy
+    pixel_threshold: int = 25 #Per pixel difference counted as change
+    min_changed: float = 0.002 #Fraction of changed pixels that counts as motion
+    alpha: float = 0.05 #Background learning rate
+    stride: int = 0 #Infer every Nth static frame, 0 skips them all
+    hold: float = 2.0 #Seconds to keep inferring after motion stops
+    heartbeat: float = 30.0 #Seconds between forced inferences
+
+    def __post_init__(self):
+        section = self.read_section()
+        self.enabled = section.getboolean('enabled', fallback=self.enabled)
+        self.width = section.getint('width', fallback=self.width)
+        self.pixel_threshold = section.getint('pixel_threshold', fallback=self.pixel_threshold)
+        self.min_changed = section.getfloat('min_changed', fallback=self.min_changed)
+        self.alpha = section.getfloat('alpha', fallback=self.alpha)
+        self.stride = section.getint('stride', fallback=self.stride)
+        self.hold = section.getfloat('hold', fallback=self.hold)
+        self.heartbeat = section.getfloat('heartbeat', fallback=self.heartbeat)
+
+@dataclass
+class RoiConfig(IniSection):
+    """
+    Regions of interest and tiled inference, [roi] in config.ini. Regions
+    are set per camera index, e.g. cam0 = rect 0,0.3,1,1; poly 0.1,0.1,0.6,0.1,0.6,0.7
+    in fractions of the frame, cameras without an entry use the whole frame
+    """
+    SECTION: str = "roi"
+
+    enabled: bool = False
+    cols: int = 1 #Tiles across every region
+    rows: int = 1 #Tiles down every region
+    overlap: float = 0.2 #Fraction of a tile shared with its neighbour
+    merge_iou: float = 0.5 #NMS across tiles, boxes cut by a tile border are found twice
+    regions: dict = field(default_factory=dict)
+
+    def __post_init__(self):
+        section = self.read_section()
+        self.enabled = section.getboolean('enabled', fallback=self.enabled)
+        self.cols = section.getint('cols', fallback=self.cols)
+        self.rows = section.getint('rows', fallback=self.rows)
+        self.overlap = section.getfloat('overlap', fallback=self.overlap)
+        self.merge_iou = section.getfloat('merge_iou', fallback=self.merge_iou)
+        self.regions = {int(key[3:]): value for key, value in section.items()
+                        if key.startswith('cam') and key[3:].isdigit()}
+
+@dataclass
+class NetworkConfig(IniSection):
+    """
+    Connectivity probe and HTTP client, [network] in config.ini
+    """
+    SECTION: str = "network"
+
+    probe_host: str = "8.8.8.8"
+    probe_port: int = 53
+    probe_url: str = "" #HTTP(S) url to HEAD instead of a TCP connect
+    probe_timeout: float = 1.0
+    probe_interval: float = 5.0 #Seconds between probes
+    ttl: float = 15.0 #Cached state older than this triggers an early probe
+    http_pool: int = 4 #Keep-alive connections per host for sendReq
+
+    def __post_init__(self):
+        section = self.read_section()
+        self.probe_host = section.get('probe_host', fallback=self.probe_host)
+        self.probe_port = section.getint('probe_port', fallback=self.probe_port)
+        self.probe_url = section.get('probe_url', fallback=self.probe_url)
+        self.probe_timeout = section.getfloat('probe_timeout', fallback=self.probe_timeout)
+        self.probe_interval = section.getfloat('probe_interval', fallback=self.probe_interval)
+        self.ttl = section.getfloat('ttl', fallback=self.ttl)
+        self.http_pool = section.getint('http_pool', fallback=self.http_pool)
+
+@dataclass
+class WriteConfig(IniSection):
+    """
+    Negative frame write queue, [write] in config.ini
+    """
+    SECTION: str = "write"
+
+    backend: str = "local" #local or redis, only descriptors go through it
+    redis_name: str = "io"
+    spool_mb: int = 64 #Hard cap on shared memory held by queued frames
+    overflow: str = "drop_oldest" #block, drop_new or drop_oldest when the spool is full
+    block_timeout: float = 1.0 #Longest enqueue waits under the block policy
+    workers: int = 2 #Encoder threads, cv2 releases the GIL while encoding
+    max_in_flight: int = 0 #Frames being encoded at once, 0 means 2 x workers
+    batch: int = 8 #Descriptors taken off the transport per round trip
+
+    def __post_init__(self):
+        section = self.read_section()
+        self.backend = section.get('backend', fallback=self.backend)
+        self.redis_name = section.get('redis_name', fallback=self.redis_name)
+        self.spool_mb = section.getint('spool_mb', fallback=self.spool_mb)
+        self.overflow = section.get('overflow', fallback=self.overflow)
+        self.block_timeout = section.getfloat('block_timeout', fallback=self.block_timeout)
+        self.workers = section.getint('workers', fallback=self.workers)
+        self.max_in_flight = section.getint('max_in_flight', fallback=self.max_in_flight)
+        self.batch = section.getint('batch', fallback=self.batch)
+
+@dataclass
+class OutboxConfig(IniSection):
+    """
+    Persistent store-and-forward upload spool, [outbox] in config.ini
+    """
+    SECTION: str = "outbox"
+
+    db_file: str = "outbox.db" #Relative to the work folder
+    rate: float = 5.0 #Uploads started per second while draining
+    batch: int = 16 #Rows claimed per database round trip
+    max_in_flight: int = 8
+    max_attempts: int = 10 #Then the row is parked as failed
+    backoff: float = 5.0 #Seconds before the first retry, doubles per attempt
+    max_backoff: float = 600.0
+    keep_days: float = 7.0 #Uploaded rows are pruned after this
+    upload_negatives: bool = False
+
+    def __post_init__(self):
+        section = self.read_section()
+        self.db_file = section.get('db_file', fallback=self.db_file)
+        self.path = os.path.join(os.path.expanduser(self.BASEPATH), self.WORK_FOLDER, self.db_file)
+        self.rate = section.getfloat('rate', fallback=self.rate)
+        self.batch = section.getint('batch', fallback=self.batch)
+        self.max_in_flight = section.getint('max_in_flight', fallback=self.max_in_flight)
+        self.max_attempts = section.getint('max_attempts', fallback=self.max_attempts)
+        self.backoff = section.getfloat('backoff', fallback=self.backoff)
+        self.max_backoff = section.getfloat('max_backoff', fallback=self.max_backoff)
+        self.keep_days = section.getfloat('keep_days', fallback=self.keep_days)
+        self.upload_negatives = section.getboolean('upload_negatives', fallback=self.upload_negatives)
+
+@dataclass
+class StorageConfig(IniSection):
+    """
+    Disk budget of the frame folder, [storage] in config.ini
+    """
+    SECTION: str = "storage"
+
+    enabled: bool = False
+    max_mb: float = 2048.0
+    max_files: int = 50000
+    low_water: float = 0.9 #Eviction stops at this fraction of the quota
+    delete_uploaded: bool = False #Delete files once their upload is confirmed
+    delete_batch: int = 64 #Confirmed uploads deleted in one go
+    interval: float = 5.0 #Seconds between checks when nothing wakes the manager
+
+    def __post_init__(self):
+        section = self.read_section()
+        self.enabled = section.getboolean('enabled', fallback=self.enabled)
+        self.max_mb = section.getfloat('max_mb', fallback=self.max_mb)
+        self.max_files = section.getint('max_files', fallback=self.max_files)
+        self.low_water = section.getfloat('low_water', fallback=self.low_water)
+        self.delete_uploaded = section.getboolean('delete_uploaded', fallback=self.delete_uploaded)
+        self.delete_batch = section.getint('delete_batch', fallback=self.delete_batch)
+        self.interval = section.getfloat('interval', fallback=self.interval)
+
+@dataclass
+class BundleConfig(IniSection):
+    """
+    Negative frame segments uploaded as one object each, [bundle] in config.ini
+    """
+    SECTION: str = "bundle"
+
+    enabled: bool = False
+    format: str = "tar" #tar of encoded frames plus index.json, or mjpeg (.avi)
+    window: float = 60.0 #Seconds covered by one segment
+    max_frames: int = 600
+    fps: float = 5.0 #Nominal frame rate written into mjpeg segments
+
+    def __post_init__(self):
+        section = self.read_section()
+        self.enabled = section.getboolean('enabled', fallback=self.enabled)
+        self.format = section.get('format', fallback=self.format).lower()
+        self.window = section.getfloat('window', fallback=self.window)
+        self.max_frames = section.getint('max_frames', fallback=self.max_frames)
+        self.fps = section.getfloat('fps', fallback=self.fps)
+
+@dataclass
+class EncodingProfileConfig(IniSection):
+    """
+    One image encoding profile, [encoding.negative] or [encoding.human]
+    """
+    SECTION: str = "encoding.negative"
+
+    format: str = "jpeg" #jpeg, png or webp
+    quality: int = 85 #JPEG and WebP quality
+    optimize: bool = False #JPEG Huffman optimisation
+    progressive: bool = False
+    subsampling: str = "420" #JPEG chroma subsampling: 444, 422, 420 or 411
+    png_compression: int = 3
+
+    def __post_init__(self):
+        section = self.read_section()
+        self.format = section.get('format', fallback=self.format).lower()
+        self.quality = section.getint('quality', fallback=self.quality)
+        self.optimize = section.getboolean('optimize', fallback=self.optimize)
+        self.progressive = section.getboolean('progressive', fallback=self.progressive)
+        self.subsampling = section.get('subsampling', fallback=self.subsampling)
+        self.png_compression = section.getint('png_compression', fallback=self.png_compression)
+
+@dataclass
+class EncodingConfig:
+    """
+    Negative archive frames trade quality for size, human evidence frames
+    default to what cv2.imwrite used before (JPEG 95)
+    """
+    negative: EncodingProfileConfig = field(
+        default_factory=lambda: EncodingProfileConfig(SECTION="encoding.negative"))
+    human: EncodingProfileConfig = field(
+        default_factory=lambda: EncodingProfileConfig(SECTION="encoding.human", quality=95))
+
+@dataclass
+class EventsConfig(IniSection):
+    """
+    Event clips instead of per frame human uploads, [events] in config.ini
+    """
+    SECTION: str = "events"
+
+    enabled: bool = False
+    window: int = 10 #Last inferred frames the hysteresis counts over
+    open_hits: int = 3 #Frames with detections in the window that open an event
+    close_hits: int = 0 #At or below this the post-roll starts
+    pre_roll: float = 2.0 #Seconds before the event that go into the clip
+    post_roll: float = 3.0 #Seconds recorded after the detections stop
+    max_seconds: float = 60.0 #Longer events are split
+    fps: float = 5.0 #Nominal clip frame rate, also sizes the pre-roll ring
+
+    def __post_init__(self):
+        section = self.read_section()
+        self.enabled = section.getboolean('enabled', fallback=self.enabled)
+        self.window = section.getint('window', fallback=self.window)
+        self.open_hits = section.getint('open_hits', fallback=self.open_hits)
+        self.close_hits = section.getint('close_hits', fallback=self.close_hits)
+        self.pre_roll = section.getfloat('pre_roll', fallback=self.pre_roll)
+        self.post_roll = section.getfloat('post_roll', fallback=self.post_roll)
+        self.max_seconds = section.getfloat('max_seconds', fallback=self.max_seconds)
+        self.fps = section.getfloat('fps', fallback=self.fps)
+
+@dataclass
+class PipelineConfig(IniSection):
+    """
+    Frame policy and stage queues of the main loop, [pipeline] in config.ini
+    """
+    SECTION: str = "pipeline"
+
+    policy: str = "latest" #latest, drop_oldest or process_all (file replay)
+    depth: int = 4 #Newest frames drop_oldest works through, capped by --ring
+    persist_queue: int = 6 #Results waiting to be written, capped at --ring - 2 unless process_all
+    poll: float = 0.005 #Seconds between result checks while no frame arrives
+
+    def __post_init__(self):
+        section = self.read_section()
+        self.policy = section.get('policy', fallback=self.policy).lower()
+        self.depth = section.getint('depth', fallback=self.depth)
+        self.persist_queue = section.getint('persist_queue', fallback=self.persist_queue)
+        self.poll = section.getfloat('poll', fallback=self.poll)
+
+@dataclass
+class LoadConfig(IniSection):
+    """
+    Adaptive load shedding, [load] in config.ini
+    """
+    SECTION: str = "load"
+
+    enabled: bool = False
+    interval: float = 5.0 #Seconds between decisions
+    latency_budget: float = 2.0 #90th percentile seconds from capture to persisted
+    target_fps: float = 0.0 #Inferred frames per second the stride must keep, 0 no floor
+    write_backlog: int = 64 #Frames waiting for an encoder that count as I/O pressure
+    upload_backlog: int = 500 #Pending outbox uploads that count as I/O pressure
+    max_stride: int = 4 #Infer at most every Nth captured frame
+    min_scale: float = 0.5 #Smallest capture resolution relative to --width/--height
+    scale_step: float = 0.25
+    min_quality: int = 40 #Lowest negative encode quality
+    quality_step: int = 15
+    recover: int = 3 #Healthy intervals in a row before a step is undone
+
+    def __post_init__(self):
+        section = self.read_section()
+        self.enabled = section.getboolean('enabled', fallback=self.enabled)
+        self.interval = section.getfloat('interval', fallback=self.interval)
+        self.latency_budget = section.getfloat('latency_budget', fallback=self.latency_budget)
+        self.target_fps = section.getfloat('target_fps', fallback=self.target_fps)
+        self.write_backlog = section.getint('write_backlog', fallback=self.write_backlog)
+        self.upload_backlog = section.getint('upload_backlog', fallback=self.upload_backlog)
+        self.max_stride = section.getint('max_stride', fallback=self.max_stride)
+        self.min_scale = section.getfloat('min_scale', fallback=self.min_scale)
+        self.scale_step = section.getfloat('scale_step', fallback=self.scale_step)
+        self.min_quality = section.getint('min_quality', fallback=self.min_quality)
+        self.quality_step = section.getint('quality_step', fallback=self.quality_step)
+        self.recover = section.getint('recover', fallback=self.recover)
+
+@dataclass
+class MetricsConfig(IniSection):
+    """
+    Stage timings and counters, [metrics] in config.ini
+    """
+    SECTION: str = "metrics"
+
+    enabled: bool = False #Off means every metric is a shared no-op
+    host: str = "127.0.0.1"
+    port: int = 9108 #Prometheus text on /metrics, 0 disables the endpoint
+    file: str = "" #Also rewrite this file every interval, e.g. for a textfile collector
+    interval: float = 15.0
+
+    def __post_init__(self):
+        section = self.read_section()
+        self.enabled = section.getboolean('enabled', fallback=self.enabled)
+        self.host = section.get('host', fallback=self.host)
+        self.port = section.getint('port', fallback=self.port)
+        self.file = section.get('file', fallback=self.file)
+        self.interval = section.getfloat('interval', fallback=self.interval)
+
 @dataclass
 class Config:
-    print("[LOGS] ---LOADING CONFIGURATION FILES---")
     Device: DeviceConfig = field(default_factory=DeviceConfig)
     AWS: AWSConfig = field(default_factory=AWSConfig)
     Inference: InferenceConfig = field(default_factory=InferenceConfig)
+    Motion: MotionConfig = field(default_factory=MotionConfig)
+    Roi: RoiConfig = field(default_factory=RoiConfig)
+    Network: NetworkConfig = field(default_factory=NetworkConfig)
+    Write: WriteConfig = field(default_factory=WriteConfig)
+    Encoding: EncodingConfig = field(default_factory=EncodingConfig)
+    Outbox: OutboxConfig = field(default_factory=OutboxConfig)
+    Bundle: BundleConfig = field(default_factory=BundleConfig)
+    Storage: StorageConfig = field(default_factory=StorageConfig)
+    Metrics: MetricsConfig = field(default_factory=MetricsConfig)
+    Pipeline: PipelineConfig = field(default_factory=PipelineConfig)
+    Events: EventsConfig = field(default_factory=EventsConfig)
+    Load: LoadConfig = field(default_factory=LoadConfig)
+
+    def __post_init__(self):
+        print("[LOGS] ---CONFIGURATION FILES LOADED---")
 
 
 
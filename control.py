@@ -0,0 +1,161 @@
+'''
+Adaptive load shedding: trades inference stride, capture resolution and
+negative encode quality for a steady frame age when the device falls behind
+'''
+
+import threading
+import time
+
+import cv2
+import numpy as np
+
+import metrics
+from outbox import Outbox
+
+
+class LoadController(threading.Thread):
+    '''
+    Every interval seconds looks at the frame age of persisted frames, the
+    persist and write queues and the upload backlog. Under I/O pressure the
+    negative quality goes down first, under compute pressure the stride goes
+    up while the inferred fps stays above target_fps, then the resolution
+    goes down. Every step is pushed on a stack and undone newest first once
+    recover intervals in a row were healthy
+    '''
+    def __init__(self, config, cameras, scheduler, encoder=None, write_queue=None,
+                 outbox=None, persister=None):
+        threading.Thread.__init__(self, daemon=True)
+        self.config = config
+        self.cameras = cameras
+        self.scheduler = scheduler
+        self.encoder = encoder
+        self.write_queue = write_queue
+        self.outbox = outbox
+        self.persister = persister
+        #Resolution the cameras were opened with, scale is relative to it
+        self.sizes = [(int(cam.width), int(cam.height)) for cam in cameras]
+        self.scale = 1.
+        self.steps = []
+        self.healthy = 0
+        #Logged once per overload, not every interval
+        self.at_limits = False
+        self.ages = []
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        metrics.gauge('load_stride', 'Captured frames per scheduled frame', fn=lambda: scheduler.stride)
+        metrics.gauge('load_scale', 'Capture resolution relative to the configured one', fn=lambda: self.scale)
+        metrics.gauge('load_steps', 'Shedding steps currently applied', fn=lambda: len(self.steps))
+
+    def record(self, age: float):
+        '''
+        Called by the persist stage with capture to persisted seconds
+        '''
+        with self.lock:
+            self.ages.append(age)
+
+    def start(self):
+        threading.Thread.start(self)
+        return self
+
+    def run(self):
+        last = time.time()
+        while not self.stopped.wait(self.config.interval):
+            now = time.time()
+            with self.lock:
+                ages, self.ages = self.ages, []
+            try:
+                self.tick(ages, now - last)
+            except Exception as e:
+                print("[ALERT] Load controller FAILED: {}".format(e))
+            last = now
+
+    def backlog(self):
+        writes = self.write_queue.get_length() if self.write_queue is not None else 0
+        uploads = self.outbox.counts().get(Outbox.PENDING, 0) if self.outbox is not None else 0
+        return writes, uploads
+
+    def tick(self, ages: list, elapsed: float):
+        config = self.config
+        fps = len(ages) / elapsed if elapsed > 0 else 0.
+        age = float(np.percentile(ages, 90)) if ages else 0.
+        writes, uploads = self.backlog()
+        queued = len(self.persister) if self.persister is not None else 0
+        io = writes > config.write_backlog or uploads > config.upload_backlog
+        slow = age > config.latency_budget or (self.persister is not None and queued > self.persister.size // 2)
+        state = "fps {:.1f} age p90 {:.2f}s writes {} uploads {} persist {}".format(fps, age, writes, uploads, queued)
+        if io or slow:
+            self.healthy = 0
+            if not (io and self.lower_quality()) and not self.shed(fps):
+                if not self.at_limits:
+                    print("[ALERT] LOAD AT LIMITS {} ({})".format(self.describe(), state))
+                self.at_limits = True
+                return
+            print("[LOGS] LOAD SHED {} ({})".format(self.describe(), state))
+            return
+        #Half the budget and half the backlog before anything comes back
+        calm = (age <= config.latency_budget / 2 and writes <= config.write_backlog // 2 and
+                uploads <= config.upload_backlog // 2)
+        self.at_limits = False
+        self.healthy = self.healthy + 1 if calm else 0
+        if self.steps and self.healthy >= config.recover:
+            self.healthy = 0
+            self.restore()
+            print("[LOGS] LOAD RESTORED {} ({})".format(self.describe(), state))
+
+    def lower_quality(self) -> bool:
+        if self.encoder is None or self.encoder.quality <= self.config.min_quality:
+            return False
+        self.steps.append(('quality', self.encoder.quality))
+        self.encoder.quality = max(self.encoder.quality - self.config.quality_step, self.config.min_quality)
+        return True
+
+    def shed(self, fps: float) -> bool:
+        '''
+        Raises the stride, or lowers the resolution once another stride step
+        would take the inferred fps below target_fps
+        '''
+        scheduler = self.scheduler
+        #process_all promises every frame, only the pixels can go
+        can_stride = scheduler.policy != 'process_all' and scheduler.stride < self.config.max_stride
+        keeps_target = fps * scheduler.stride / (scheduler.stride + 1) >= self.config.target_fps
+        if can_stride and keeps_target:
+            self.steps.append(('stride', scheduler.stride))
+            scheduler.stride += 1
+            return True
+        if self.scale > self.config.min_scale:
+            self.steps.append(('scale', self.scale))
+            self.resize(max(self.scale - self.config.scale_step, self.config.min_scale))
+            return True
+        if can_stride:
+            self.steps.append(('stride', scheduler.stride))
+            scheduler.stride += 1
+            return True
+        return False
+
+    def restore(self):
+        knob, value = self.steps.pop()
+        if knob == 'quality':
+            self.encoder.quality = value
+        elif knob == 'stride':
+            self.scheduler.stride = value
+        else:
+            self.resize(value)
+
+    def resize(self, scale: float):
+        self.scale = scale
+        for cam, (width, height) in zip(self.cameras, self.sizes):
+            #Most drivers only offer a few modes, keep the request aligned
+            cam.set(cv2.CAP_PROP_FRAME_WIDTH, max(int(width * scale) // 8 * 8, 8))
+            cam.set(cv2.CAP_PROP_FRAME_HEIGHT, max(int(height * scale) // 8 * 8, 8))
+
+    def describe(self) -> str:
+        quality = self.encoder.quality if self.encoder is not None else '-'
+        return "stride {} scale {:.2f} quality {}".format(self.scheduler.stride, self.scale, quality)
+
+    def stop(self):
+        self.stopped.set()
+        if self.is_alive():
+            self.join()
+        #Leave the cameras the way they were opened
+        if self.scale != 1.:
+            self.resize(1.)
@@ -1,30 +1,25 @@
 #!/usr/bin/env python3
 
 from argparse import ArgumentParser
+from collections import deque
 from copy import deepcopy
 from dataclasses import dataclass, field
 from datetime import datetime
 from enum import Enum
-import random
 import os
 import sys
 import time
 from threading import Thread
-from typing import Dict, List
+from typing import Any, Dict, Iterator, List, Tuple
 
-import cv2 
 import numpy as np
 
-DLDT = False
-try: 
-    from armv7l.openvino.inference_engine import IEPlugin, IENetwork
-    print('success')
-except ImportError: 
-    try: 
-        from openvino.inference_engine import IEPlugin, IENetwork
-    except ImportError: 
-        from cv2 import dnn
-        DLDT = True
+import backends
+import metrics
+from preprocess import Preprocessor
+from track import IoUTracker, nms
+import workers
+
 
 def softmax(vector: list):
     '''
@@ -50,6 +45,32 @@ class Detection:
     def __post_init__(self):
         self.color = (min(self.class_id * 5, 255), min(self.class_id * 12, 255), min(self.class_id * 7, 255))
 
+@dataclass
+class Detections:
+    '''
+    Array backed detections for one frame, boxes are (N, 4) pixel
+    xmin, ymin, xmax, ymax rows. track_ids stay -1 until a tracker has run
+    '''
+    boxes: np.ndarray
+    scores: np.ndarray
+    track_ids: np.ndarray = None
+    label: str = 'human'
+    time: float = 0.
+
+    def __post_init__(self):
+        if self.track_ids is None:
+            self.track_ids = np.full(len(self.boxes), -1, dtype=np.int32)
+
+    def __len__(self):
+        return len(self.boxes)
+
+    def __iter__(self):
+        for box, track_id in zip(self.boxes.tolist(), self.track_ids.tolist()):
+            yield Detection(Box(*box), track_id, self.label, self.time, None)
+
+    def select(self, index):
+        return Detections(self.boxes[index], self.scores[index], self.track_ids[index], self.label, self.time)
+
 @dataclass 
 class Classification: 
     human: float
@@ -58,98 +79,306 @@ class Classification:
 
 class OpenVino:
 
-    def __init__(self, config):
-
-        #Numbers to keep track of process ID
-        self.curr = 0
-        self.next = 1
-        self.width, self.height = config.frame_width, config.frame_height
-        
-        try:
-            self.plugin = IEPlugin(device=config.default_device)
-            self.net = IENetwork(model=config.network_file, weights=config.weights_file)
-        
-        except RuntimeError:
-            print("We're probably dealing with a mac here, do some cpu target stuff")
-            self.plugin = IEPlugin(device=config.fallback_device)
-            self.net = IENetwork(model=config.network_file, weights=config.weights_file)
-            supported_layers = self.plugin.get_supported_layers(self.net)
-            not_supported_layers = [l for l in self.net.layers.keys() if l not in supported_layers]
-            
-            if len(not_supported_layers) != 0:
-                raise Exception("Some layers in the mdoel are not supported by the CPU - figure this out")
+    def __init__(self, config, batch_size: int = None):
+
+        #Infer requests in flight, oldest first: (request id, tag, start
+        #time, submit time, frames, batched, (width, height) of each frame)
+        self.num_requests = max(int(getattr(config, 'num_requests', 2)), 1)
+        self.in_flight = deque()
+        self.submitted = 0
+        self.preprocess_time = metrics.histogram('inference_preprocess_seconds', 'Resize and layout into the input blob')
+        self.infer_time = metrics.histogram('inference_request_seconds', 'Request submit to result collected')
+        self.postprocess_time = metrics.histogram('inference_postprocess_seconds', 'Output parsing')
+        self.infer_failures = metrics.counter('inference_failures_total', 'Requests that completed with an error')
+        metrics.counter('inference_requests_total', 'Requests submitted', fn=lambda: self.submitted)
+        metrics.gauge('inference_in_flight', 'Requests running on the device', fn=lambda: len(self.in_flight))
+        self.width, self.height = float(config.frame_width), float(config.frame_height)
+
+        net, self.exec_net = self.load(config, batch_size)
     
         #Get sizes for image pre-processing
-        self.input_blob = next(iter(self.net.inputs))
-        self.output_blob = next(iter(self.net.outputs))
-        self.n, self.c, self.h, self.w = self.net.inputs[self.input_blob].shape
+        self.input_blob = next(iter(net.inputs))
+        self.output_blob = next(iter(net.outputs))
+        self.n, self.c, self.h, self.w = net.inputs[self.input_blob].shape
         self.threshold = config.threshold
         if config.mode == 'classify':
             self.threshold = [config.threshold, config.non_threshold]
         self.normalize = config.normalize
+        self.preprocessor = Preprocessor(self.n, self.c, self.h, self.w, self.normalize)
+
+    def load(self, config, batch_size: int = None):
+        '''
+        Loads the model on the configured backend, see backends.load. Returns
+        the network, only used for its input/output names and shapes, and
+        the executable one
+        '''
+        if getattr(config, 'workers', 0) > 0:
+            self.backend, net, exec_net = workers.load(config, batch_size, self.num_requests)
+        else:
+            self.backend, net, exec_net = backends.load(config, batch_size, self.num_requests)
+        return net, exec_net
+
+    def close(self):
+        '''
+        Stops worker processes, if any
+        '''
+        close = getattr(self.exec_net, 'close', None)
+        if close is not None:
+            close()
+
+    def postprocess(self, outputs, elapsed: float, sizes: list) -> list:
+        '''
+        Returns one result per batch slot, sizes holds the (width, height)
+        of the frame submitted in each slot
+        '''
+        raise NotImplementedError
+
+    def _collect(self) -> Tuple[Any, Any]:
+        '''
+        Blocks on the oldest request in flight and parses its outputs
+        '''
+        request_id, tag, start, submitted, count, batched, sizes = self.in_flight.popleft()
+        request = self.exec_net.requests[request_id]
+        results = [None] * count
+        if request.wait(-1) == 0:
+            done = time.time()
+            self.infer_time.observe(done - submitted)
+            results = self.postprocess(request.outputs[self.output_blob], done - start, sizes)[:count]
+            self.postprocess_time.observe(time.time() - done)
+        else:
+            self.infer_failures.inc()
+        return tag, results if batched else results[0]
+
+    def _ready(self) -> bool:
+        request_id = self.in_flight[0][0]
+        return self.exec_net.requests[request_id].wait(0) == 0
+
+    def _start(self, frames, tag, batched: bool) -> List[Tuple[Any, Any]]:
+        start = time.time()
+        inputs = self.preprocessor(frames)
+        self.preprocess_time.observe(time.time() - start)
+        completed = []
+        if len(self.in_flight) == self.num_requests:
+            completed.append(self._collect())
+        request_id = self.submitted % self.num_requests
+        self.exec_net.requests[request_id].async_infer(inputs={self.input_blob: inputs})
+        sizes = [(frame.shape[1], frame.shape[0]) for frame in frames]
+        self.in_flight.append((request_id, tag, start, time.time(), len(frames), batched, sizes))
+        self.submitted += 1
+        completed.extend(self.completed())
+        return completed
+
+    def submit(self, frame, tag=None) -> List[Tuple[Any, Any]]:
+        '''
+        Starts inference on frame without waiting for it. Requests are
+        recycled round-robin, so once all of them are busy this blocks on
+        the oldest one. Returns the (tag, result) pairs that completed, in
+        submission order
+        '''
+        return self._start([frame], tag, batched=False)
+
+    def submit_batch(self, frames, tag=None) -> List[Tuple[Any, Any]]:
+        '''
+        Same as submit but packs up to n frames into one request. The
+        result for a batch is a list with one entry per frame
+        '''
+        return self._start(frames, tag, batched=True)
+
+    def completed(self, block: bool = False) -> Iterator[Tuple[Any, Any]]:
+        '''
+        Yields finished (tag, result) pairs in submission order, stopping at
+        the first request still running unless block is set
+        '''
+        while self.in_flight and (block or self._ready()):
+            yield self._collect()
+
+    def drain(self) -> List[Tuple[Any, Any]]:
+        return list(self.completed(block=True))
+
+    def run(self, frame):
+        '''
+        Synchronous inference on a single frame, only with nothing in
+        flight so no submitted result is lost
+        '''
+        if self.in_flight:
+            raise Exception("run() with {} requests in flight, collect them first".format(len(self.in_flight)))
+        self.submit(frame)
+        return self.drain()[-1][1]
+
+    def warmup(self, frames: int = 1) -> float:
+        '''
+        Runs blank frames through the whole path so lazy allocations on the
+        device happen before the first real frame. Returns the seconds the
+        last one took
+        '''
+        blank = np.zeros((int(self.height), int(self.width), self.c), dtype=np.uint8)
+        for _ in range(max(frames, 1)):
+            start = time.time()
+            self.run(blank)
+        return time.time() - start
 
-        self.exec_net = self.plugin.load(network=self.net)
-        #Do we need this? 
-        del self.net
-        
 
 class OpenVinoClassifierAsync(OpenVino):
     
-    def __init__(self, InferenceConfig):
-        super().__init__(InferenceConfig)
+    def __init__(self, InferenceConfig, batch_size: int = None):
+        super().__init__(InferenceConfig, batch_size)
     
-    def run(self, frame)->bool:
-        start = time.time()
-        #Image resizing - need to normalize the frame
-        frame = cv2.resize(frame, (self.w, self.h))
-        frame = frame.transpose((2,0,1))
-        frame = frame.reshape((self.n, self.c, self.h, self.w))
-        if self.normalize: 
-            frame = frame.astype(np.uint8)/255.
-        #Start request 
-        self.exec_net.requests[self.curr].async_infer(inputs={self.input_blob: frame})
-        if self.exec_net.requests[self.curr].wait(-1) == 0: 
-            classification_time = time.time() - start
-            predictions = Classification(
-                        self.exec_net.requests[self.curr].outputs[self.output_blob][0][0], 
-                        self.exec_net.requests[self.curr].outputs[self.output_blob][0][1],
-                        'human')
-            #print(classification_time)
-            if predictions.human > self.threshold[0] and \
-                predictions.no_human < self.threshold[1]: 
-                return True
+    def postprocess(self, outputs, elapsed: float, sizes: list) -> List[bool]:
+        results = []
+        for output in outputs:
+            predictions = Classification(output[0], output[1], 'human')
+            #print(elapsed)
+            results.append(bool(predictions.human > self.threshold[0] and \
+                predictions.no_human < self.threshold[1]))
+        return results
 
             
     
 class OpenVinoDetectorAsync(OpenVino): 
 
-    def __init__(self, InferenceConfig): 
-        OpenVino.__init__(self, InferenceConfig)
-
-    def run(self, frame) -> List[Detection]:
-        start = time.time() 
-        #Image resizing
-        frame = cv2.resize(frame, (self.w, self.h))
-        frame = frame.transpose((2,0,1))
-        frame = frame.reshape((self.n, self.c, self.h, self.w))
-        self.exec_net.requests[self.curr].async_infer(inputs={self.input_blob: frame})
-        #detections = self.exec_net.infer(inputs={self.input_blob: frame})
+    def __init__(self, InferenceConfig, batch_size: int = None): 
+        OpenVino.__init__(self, InferenceConfig, batch_size)
+        #The detection models take raw pixel values
+        self.preprocessor = Preprocessor(self.n, self.c, self.h, self.w)
+        self.nms_threshold = InferenceConfig.nms_threshold
+        self.track_iou = InferenceConfig.track_iou
+        self.track_max_missed = InferenceConfig.track_max_missed
+
+    def postprocess(self, outputs, elapsed: float, sizes: list) -> List[Detections]:
+        #Rows are [image_id, label, conf, xmin, ymin, xmax, ymax], a negative
+        #image_id terminates the list
+        rows = outputs[0][0]
+        end = np.flatnonzero(rows[:, 0] < 0)
+        if len(end):
+            rows = rows[:end[0]]
+        rows = rows[rows[:, 2] > self.threshold]
+        image_ids = rows[:, 0].astype(np.int32)
+        boxes = rows[:, 3:7].astype(np.float32)
+        scores = rows[:, 2].astype(np.float32)
+
         confirmed_detections = []
-        if self.exec_net.requests[self.curr].wait(-1) == 0: 
-            detection_time = time.time() - start
-            #Get results and look at probability
-            detections = self.exec_net.requests[self.curr].outputs[self.output_blob]
-            for detection in detections[0][0]:
-                if detection[2] > self.threshold: 
-                    box_posn = Box(
-                        detection[3] * self.width, 
-                        detection[4] * self.height, 
-                        detection[5] * self.width, 
-                        detection[6] * self.height
-                    )
-                    id = random.randint(1,40)
-                    confirmed_detection = Detection(box_posn, id, 'human', detection_time, None)
-                    confirmed_detections.append(confirmed_detection)
-        #self.curr, self.next  = self.next, self.curr
+        for image_id in range(self.n):
+            mask = image_ids == image_id
+            #Normalized coordinates to pixels of the frame actually submitted,
+            #which need not be the configured frame size (crops, tiles, rescaling)
+            width, height = sizes[image_id] if image_id < len(sizes) else (self.width, self.height)
+            scale = np.array([width, height, width, height], dtype=np.float32)
+            detections = Detections(boxes[mask] * scale, scores[mask], time=elapsed)
+            if self.nms_threshold is not None and len(detections) > 1:
+                detections = detections.select(nms(detections.boxes, detections.scores, self.nms_threshold))
+            confirmed_detections.append(detections)
         return confirmed_detections
 
+
+class BatchScheduler:
+    '''
+    Feeds the latest frame of every camera in a MultiCamera through one
+    detector loaded with batch_size = number of cameras. With per camera
+    roi.Tilers each camera fills one batch slot per window instead, and the
+    window results are merged back into one full frame result
+    '''
+
+    POLICIES = ('latest', 'drop_oldest', 'process_all')
+
+    def __init__(self, cameras, detector: OpenVino, gates=None, policy: str = 'latest',
+                 depth: int = 1, poll: float = 0.005, tilers=None):
+        self.tilers = tilers or [None] * len(cameras)
+        #Batch slots of each camera, in camera order
+        self.slots = [len(tiler) if tiler is not None else 1 for tiler in self.tilers]
+        if detector.n < sum(self.slots):
+            raise Exception("Detector batch {} is smaller than {} slots for {} cameras".format(
+                detector.n, sum(self.slots), len(cameras)))
+        if policy not in self.POLICIES:
+            raise Exception("Unknown frame policy {}".format(policy))
+        self.cameras = cameras
+        self.detector = detector
+        #Which captured frames get inferred, see Camera.next_frame
+        self.policy = policy
+        #Half the ring is kept for frames captured while requests are in
+        #flight, reaching further back gets frames recycled before persisting
+        ring_size = min(cam.ring_size for cam in cameras)
+        self.depth = max(min(depth, ring_size // 2 - detector.num_requests), 1)
+        #Wait used while requests are in flight so their results still come
+        #back when no new frame arrives, e.g. under process_all backpressure
+        self.poll = poll
+        #Only every stride-th captured frame is scheduled, see control.LoadController
+        self.stride = 1
+        self.seqs = [-1] * len(cameras)
+        #Optional per camera callables deciding whether a frame needs inference
+        self.gates = gates or [None] * len(cameras)
+        self.gated = metrics.counter('scheduler_gated_frames_total', 'Frames that skipped inference')
+        self.skipped = metrics.counter('scheduler_skipped_frames_total', 'Captured frames never scheduled')
+        #Track ids are per camera, so each one gets its own tracker
+        self.trackers = [None] * len(cameras)
+        if isinstance(detector, OpenVinoDetectorAsync):
+            self.trackers = [IoUTracker(detector.track_iou, detector.track_max_missed)
+                             for _ in range(len(cameras))]
+
+    def _results(self, completed) -> List[Tuple[int, Any, Any]]:
+        '''
+        Splits batched results back out per camera, skipping padded slots
+        '''
+        per_camera = []
+        for frames, results in completed:
+            offset = 0
+            for index, frame in enumerate(frames):
+                windows = results[offset:offset + self.slots[index]]
+                offset += self.slots[index]
+                if frame is None:
+                    continue
+                tiler = self.tilers[index]
+                result = tiler.merge(windows, frame.data.shape) if tiler is not None else windows[0]
+                if self.trackers[index] is not None and result is not None:
+                    result.track_ids = self.trackers[index].update(result.boxes)
+                per_camera.append((index, frame, result))
+        return per_camera
+
+    def step(self, timeout: float = None) -> List[Tuple[int, Any, Any]]:
+        '''
+        Waits for at least one camera to produce a new frame and submits a
+        batch holding the next frame of each camera under the frame policy,
+        the newest one by default. Cameras without a new
+        frame keep their slot but their result is dropped. Frames turned
+        down by their camera's gate are returned straight away with a None
+        result, everything else as completed (camera index, Frame, result)
+        triples in capture order
+        '''
+        if self.detector.in_flight:
+            timeout = self.poll if timeout is None else min(timeout, self.poll)
+        after = [seq + self.stride - 1 if seq >= 0 else seq for seq in self.seqs]
+        latest = self.cameras.wait_for(after, timeout, self.policy, self.depth)
+        if latest is None:
+            return self._results(self.detector.completed())
+        batch, frames, skipped = [], [], []
+        for index, (grabbed, frame) in enumerate(latest):
+            fresh = grabbed and frame.seq > after[index]
+            if fresh and not self.cameras[index].hold:
+                #Nothing holds the ring slot until the result is persisted
+                frame = self.cameras[index].detach(frame) or frame
+            if fresh:
+                if frame.seq > self.seqs[index] + 1 and self.seqs[index] >= 0:
+                    self.skipped.inc(frame.seq - self.seqs[index] - 1)
+                self.seqs[index] = frame.seq
+                gate = self.gates[index]
+                if gate is not None and not gate(frame.data, frame.timestamp):
+                    skipped.append((index, frame, None))
+                    fresh = False
+            tiler = self.tilers[index]
+            batch.extend(tiler.crops(frame.data) if tiler is not None else [frame.data])
+            frames.append(frame if fresh else None)
+        if skipped:
+            self.gated.inc(len(skipped))
+        if not any(frames):
+            return skipped + self._results(self.detector.completed())
+        return skipped + self._results(self.detector.submit_batch(batch, tag=frames))
+
+    def exhausted(self) -> bool:
+        '''
+        True once every camera has stopped, e.g. at the end of a replay, and
+        all of its frames were scheduled
+        '''
+        return all(not cam.thread_running and cam.seq <= seq + self.stride - 1
+                   for cam, seq in zip(self.cameras, self.seqs))
+
+    def drain(self) -> List[Tuple[int, Any, Any]]:
+        return self._results(self.detector.drain())
@@ -0,0 +1,67 @@
+'''
+Image encoders built from the [encoding.*] profiles in config.ini
+'''
+
+import os
+
+import cv2
+import numpy as np
+
+
+EXTENSIONS = {'jpeg': '.jpg', 'png': '.png', 'webp': '.webp'}
+
+SUBSAMPLING = {
+    '444': 'IMWRITE_JPEG_SAMPLING_FACTOR_444',
+    '422': 'IMWRITE_JPEG_SAMPLING_FACTOR_422',
+    '420': 'IMWRITE_JPEG_SAMPLING_FACTOR_420',
+    '411': 'IMWRITE_JPEG_SAMPLING_FACTOR_411',
+}
+
+class Encoder:
+    '''
+    Turns a profile into cv2 imwrite flags. quality can be changed at
+    runtime, e.g. by the load controller
+    '''
+
+    def __init__(self, profile):
+        if profile.format not in EXTENSIONS:
+            raise Exception("Unknown image format {}".format(profile.format))
+        self.profile = profile
+        self.ext = EXTENSIONS[profile.format]
+        self.quality = profile.quality
+
+    @property
+    def params(self) -> list:
+        profile = self.profile
+        if profile.format == 'png':
+            return [cv2.IMWRITE_PNG_COMPRESSION, profile.png_compression]
+        if profile.format == 'webp':
+            return [cv2.IMWRITE_WEBP_QUALITY, self.quality]
+        params = [cv2.IMWRITE_JPEG_QUALITY, self.quality,
+                  cv2.IMWRITE_JPEG_OPTIMIZE, int(profile.optimize),
+                  cv2.IMWRITE_JPEG_PROGRESSIVE, int(profile.progressive)]
+        #Sampling factors need OpenCV 4.5.5+
+        if hasattr(cv2, 'IMWRITE_JPEG_SAMPLING_FACTOR') and profile.subsampling in SUBSAMPLING:
+            params += [cv2.IMWRITE_JPEG_SAMPLING_FACTOR, getattr(cv2, SUBSAMPLING[profile.subsampling])]
+        return params
+
+    def path(self, image_path: str) -> str:
+        '''
+        image_path with the extension of this profile's format
+        '''
+        return os.path.splitext(image_path)[0] + self.ext
+
+    def encode(self, frame) -> np.ndarray:
+        ok, buffer = cv2.imencode(self.ext, frame, self.params)
+        if not ok:
+            raise IOError("Could not encode frame as {}".format(self.profile.format))
+        return buffer
+
+    def write(self, image_path: str, frame) -> str:
+        '''
+        Writes frame and returns the path actually used
+        '''
+        image_path = self.path(image_path)
+        if not cv2.imwrite(image_path, frame, self.params):
+            raise IOError("Could not write {}".format(image_path))
+        return image_path
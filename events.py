@@ -0,0 +1,196 @@
+'''
+Event level capture: N-of-M hysteresis over per frame detections, one clip,
+thumbnail and JSON summary per event instead of one upload per frame
+'''
+
+from collections import deque
+from datetime import datetime, timezone
+import json
+import math
+import os
+
+import cv2
+import numpy as np
+
+import metrics
+from outbox import Outbox
+
+
+class Event:
+    '''
+    One open event: an MJPEG clip written as frames arrive plus what the
+    summary needs. The best scoring frame is kept for the thumbnail
+    '''
+    def __init__(self, folder: str, camera: int, started: float, fps: float):
+        self.camera = camera
+        self.started = self.ended = started
+        stamp = datetime.fromtimestamp(started, tz=timezone.utc).strftime('%Y-%m-%d-%H-%M-%S-%f')
+        self.base = os.path.join(folder, 'event-' + stamp)
+        self.fps = fps
+        self.writer = None
+        self.size = None
+        self.frames = 0
+        self.hits = 0
+        self.best_score = -1.
+        self.best = None
+        self.best_timestamp = None
+        self.best_boxes = []
+        self.tracks = set()
+        #Set once the hits drop to close_hits, the post-roll runs from here
+        self.closing = None
+
+    def add(self, frame, timestamp: float, detections=None):
+        if self.writer is None:
+            height, width = frame.shape[:2]
+            self.size = (width, height)
+            self.writer = cv2.VideoWriter(self.base + '.avi', cv2.VideoWriter_fourcc(*'MJPG'),
+                                          self.fps, self.size)
+        elif frame.shape[1::-1] != self.size:
+            #The load controller may rescale capture mid event
+            frame = cv2.resize(frame, self.size)
+        self.writer.write(frame)
+        self.frames += 1
+        self.ended = timestamp
+        if not detections:
+            return
+        self.hits += 1
+        scores = getattr(detections, 'scores', None)
+        score = float(scores.max()) if scores is not None and len(scores) else 1.
+        if score > self.best_score:
+            self.best_score = score
+            self.best = frame.copy()
+            self.best_timestamp = timestamp
+            self.best_boxes = getattr(detections, 'boxes', np.zeros((0, 4))).astype(np.int32).tolist()
+        track_ids = getattr(detections, 'track_ids', None)
+        if track_ids is not None:
+            self.tracks.update(int(track_id) for track_id in track_ids if track_id >= 0)
+
+    def finish(self, encoder) -> list:
+        '''
+        Closes the clip and writes the thumbnail and summary, returns the
+        paths to upload
+        '''
+        paths = []
+        if self.writer is not None:
+            self.writer.release()
+            paths.append(self.base + '.avi')
+        summary = {
+            'camera': self.camera,
+            'started': self.started,
+            'ended': self.ended,
+            'duration': self.ended - self.started,
+            'frames': self.frames,
+            'hit_frames': self.hits,
+            'max_score': self.best_score,
+            'tracks': sorted(self.tracks),
+            'clip': os.path.basename(paths[0]) if paths else None,
+            'thumbnail': None,
+        }
+        if self.best is not None:
+            for xmin, ymin, xmax, ymax in self.best_boxes:
+                cv2.rectangle(self.best, (xmin, ymin), (xmax, ymax), (25, 25, 255), 2)
+            thumbnail = encoder.write(self.base + '.jpg', self.best)
+            summary.update(thumbnail=os.path.basename(thumbnail), best_timestamp=self.best_timestamp,
+                           boxes=self.best_boxes)
+            paths.append(thumbnail)
+        #Written through a temp file so the outbox never picks up half of it
+        with open(self.base + '.json.tmp', 'w') as f:
+            json.dump(summary, f)
+        os.replace(self.base + '.json.tmp', self.base + '.json')
+        paths.append(self.base + '.json')
+        return paths
+
+
+class EventRecorder:
+    '''
+    Per camera state machine. An event opens once open_hits of the last
+    window results had a detection and starts with the pre_roll seconds
+    kept in a preallocated ring. Once the hits fall to close_hits it keeps
+    recording for post_roll seconds, a new hit in that time continues the
+    event. Events longer than max_seconds are split
+    '''
+    def __init__(self, config, folder: str, encoder, outbox=None, camera: int = 0):
+        self.config = config
+        self.folder = folder
+        self.encoder = encoder
+        self.outbox = outbox
+        self.camera = camera
+        self.results = deque(maxlen=max(config.window, 1))
+        #Allocated on the first frame, reallocated when the resolution changes
+        self.ring = None
+        self.ring_size = max(int(math.ceil(config.pre_roll * config.fps)), 0)
+        self.ring_times = [0.] * self.ring_size
+        self.ring_results = [None] * self.ring_size
+        self.ring_count = 0
+        self.event = None
+        self.events = 0
+        metrics.counter('events_total', 'Events recorded', fn=lambda: self.events, camera=str(camera))
+
+    def _remember(self, frame, timestamp: float, detections):
+        if not self.ring_size:
+            return
+        if self.ring is None or self.ring.shape[1:] != frame.shape:
+            self.ring = np.empty((self.ring_size,) + frame.shape, dtype=frame.dtype)
+            self.ring_count = 0
+        slot = self.ring_count % self.ring_size
+        self.ring[slot][...] = frame
+        self.ring_times[slot] = timestamp
+        self.ring_results[slot] = detections
+        self.ring_count += 1
+
+    def _pre_roll(self, now: float):
+        '''
+        Remembered frames of the last pre_roll seconds, oldest first
+        '''
+        for count in range(max(self.ring_count - self.ring_size, 0), self.ring_count):
+            slot = count % self.ring_size
+            if now - self.ring_times[slot] <= self.config.pre_roll:
+                yield self.ring[slot], self.ring_times[slot], self.ring_results[slot]
+        self.ring_count = 0
+
+    def update(self, frame, timestamp: float, detections) -> bool:
+        '''
+        Feeds one inferred frame in capture order. True when the frame went
+        into an event clip, False when it is outside any event
+        '''
+        self.results.append(bool(detections))
+        hits = sum(self.results)
+        if self.event is None:
+            if hits < self.config.open_hits:
+                self._remember(frame, timestamp, detections)
+                return False
+            self.event = Event(self.folder, self.camera, timestamp, self.config.fps)
+            for previous, previous_time, previous_result in self._pre_roll(timestamp):
+                self.event.started = min(self.event.started, previous_time)
+                self.event.add(previous, previous_time, previous_result)
+            print("[LOGS] EVENT STARTED {}".format(self.event.base))
+        event = self.event
+        event.add(frame, timestamp, detections)
+        if hits > self.config.close_hits:
+            event.closing = None
+        elif event.closing is None:
+            event.closing = timestamp
+        if (event.closing is not None and timestamp - event.closing >= self.config.post_roll) or \
+                timestamp - event.started >= self.config.max_seconds:
+            self.close()
+        return True
+
+    def close(self):
+        '''
+        Finishes the open event, if any, and queues its files for upload
+        '''
+        event, self.event = self.event, None
+        if event is None:
+            return
+        try:
+            paths = event.finish(self.encoder)
+        except (IOError, OSError, cv2.error) as e:
+            print("[ALERT] Event {} could not be written: {}".format(event.base, e))
+            return
+        self.events += 1
+        self.results.clear()
+        print("[LOGS] EVENT FINISHED {} ({} frames, {} with detections, {:.1f}s)".format(
+            event.base, event.frames, event.hits, event.ended - event.started))
+        if self.outbox is not None:
+            for path in paths:
+                self.outbox.add(path, Outbox.HUMAN)
@@ -0,0 +1,243 @@
+'''
+Per-stage timings and counters in Prometheus text format, served over
+local HTTP and/or written to a metrics file
+'''
+
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import os
+import threading
+import time
+
+
+#Seconds, from sub-millisecond preprocessing up to multi-second uploads
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1., 2.5, 5., 10.)
+
+def _labels(labels: dict, extra: str = '') -> str:
+    items = ['{}="{}"'.format(key, value) for key, value in sorted(labels.items())]
+    if extra:
+        items.append(extra)
+    return '{' + ','.join(items) + '}' if items else ''
+
+def _number(value) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class NullMetric:
+    '''
+    Handed out while metrics are disabled, every call is a no-op
+    '''
+    def observe(self, value):
+        pass
+
+    def inc(self, amount=1):
+        pass
+
+    def set(self, value):
+        pass
+
+NULL = NullMetric()
+
+
+class Histogram:
+    '''
+    Fixed buckets, observe() is a bisect and two additions under a lock
+    '''
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels, buckets=LATENCY_BUCKETS):
+        self.name, self.help, self.labels = name, help, labels
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.
+        self.lock = threading.Lock()
+
+    def observe(self, value: float):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def render(self) -> list:
+        with self.lock:
+            counts, total = list(self.counts), self.sum
+        lines, cumulative = [], 0
+        for bound, count in zip(self.buckets + ('+Inf',), counts):
+            cumulative += count
+            le = 'le="{}"'.format(bound if bound == '+Inf' else repr(float(bound)))
+            lines.append('{}_bucket{} {}'.format(self.name, _labels(self.labels, le), cumulative))
+        lines.append('{}_sum{} {}'.format(self.name, _labels(self.labels), repr(total)))
+        lines.append('{}_count{} {}'.format(self.name, _labels(self.labels), cumulative))
+        return lines
+
+
+class Counter:
+    '''
+    Monotonic count. With fn the value is read from the owner at scrape
+    time instead, so the hot path pays nothing
+    '''
+    kind = 'counter'
+
+    def __init__(self, name, help, labels, fn=None):
+        self.name, self.help, self.labels = name, help, labels
+        self.fn = fn
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def render(self) -> list:
+        value = self.fn() if self.fn is not None else self.value
+        return ['{}{} {}'.format(self.name, _labels(self.labels), _number(value))]
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def set(self, value):
+        self.value = value
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def register(self, cls, name, help, labels, **kwargs):
+        '''
+        Returns the existing metric for the same name and labels, e.g. when
+        a component is rebuilt
+        '''
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            metric = self.metrics.get(key)
+            if metric is None:
+                metric = self.metrics[key] = cls(name, help, labels, **kwargs)
+            elif 'fn' in kwargs:
+                metric.fn = kwargs['fn']
+        return metric
+
+    def render(self) -> str:
+        with self.lock:
+            metrics = sorted(self.metrics.values(), key=lambda metric: metric.name)
+        lines, described = [], set()
+        for metric in metrics:
+            if metric.name not in described:
+                described.add(metric.name)
+                lines.append('# HELP {} {}'.format(metric.name, metric.help))
+                lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                #A gauge whose owner has gone away must not break the scrape
+                print("[ALERT] Metric {} failed: {}".format(metric.name, e))
+        return '\n'.join(lines) + '\n'
+
+
+#None while disabled, set by configure()
+registry = None
+
+def configure(config):
+    '''
+    Must run before the instrumented components are built, they look their
+    metrics up once at construction
+    '''
+    global registry
+    registry = Registry() if config.enabled else None
+    return registry
+
+def enabled() -> bool:
+    return registry is not None
+
+def histogram(name: str, help: str, buckets=LATENCY_BUCKETS, **labels):
+    if registry is None:
+        return NULL
+    return registry.register(Histogram, name, help, labels, buckets=buckets)
+
+def counter(name: str, help: str, fn=None, **labels):
+    if registry is None:
+        return NULL
+    return registry.register(Counter, name, help, labels, fn=fn)
+
+def gauge(name: str, help: str, fn=None, **labels):
+    if registry is None:
+        return NULL
+    return registry.register(Gauge, name, help, labels, fn=fn)
+
+
+class MetricsExporter(threading.Thread):
+    '''
+    Serves /metrics on host:port and/or rewrites file every interval
+    seconds, atomically so a node_exporter textfile collector never sees a
+    partial file
+    '''
+    def __init__(self, config, registry: Registry):
+        threading.Thread.__init__(self, daemon=True)
+        self.config = config
+        self.registry = registry
+        self.server = None
+        self.stopped = threading.Event()
+
+    def _serve(self):
+        registry = self.registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((self.config.host, self.config.port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        print("[LOGS] METRICS ON http://{}:{}/metrics".format(self.config.host, self.config.port))
+
+    def write_file(self):
+        path = os.path.expanduser(self.config.file)
+        temp = path + '.tmp'
+        with open(temp, 'w') as f:
+            f.write(self.registry.render())
+        os.replace(temp, path)
+
+    def start(self):
+        if self.config.port:
+            self._serve()
+        threading.Thread.start(self)
+        return self
+
+    def run(self):
+        while self.config.file and not self.stopped.wait(self.config.interval):
+            try:
+                self.write_file()
+            except OSError as e:
+                print("[ALERT] Could not write metrics file: ", e)
+
+    def stop(self):
+        self.stopped.set()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+        if self.is_alive():
+            self.join()
+        if self.config.file:
+            self.write_file()
+
+def start(config):
+    '''
+    Configures the registry and starts the exporter, None when disabled
+    '''
+    if configure(config) is None:
+        return None
+    return MetricsExporter(config, registry).start()
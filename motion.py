@@ -0,0 +1,73 @@
+'''
+Cheap motion detection used to skip inference on static scenes
+'''
+
+import time
+
+import cv2
+import numpy as np
+
+
+class MotionGate:
+    '''
+    Keeps a running-average background of a downscaled grayscale copy of
+    the frame. Frames with enough changed pixels go to inference, static
+    ones only every stride-th frame or once the heartbeat expires
+    '''
+
+    def __init__(self, config):
+        self.config = config
+        self.shape = None
+        self.static_frames = 0
+        self.last_motion = 0.
+        self.last_inference = 0.
+        self.changed = 0.
+
+    def _allocate(self, frame):
+        height, width = frame.shape[:2]
+        scale = min(self.config.width / float(width), 1.)
+        self.size = (max(int(width * scale), 1), max(int(height * scale), 1))
+        self.small = np.empty((self.size[1], self.size[0]) + frame.shape[2:], dtype=np.uint8)
+        self.gray = np.empty((self.size[1], self.size[0]), dtype=np.uint8)
+        self.diff = np.empty_like(self.gray)
+        self.mask = np.empty_like(self.gray)
+        self.background = None
+        self.shape = frame.shape
+
+    def changed_fraction(self, frame) -> float:
+        '''
+        Fraction of pixels that differ from the background, also updates it
+        '''
+        if frame.shape != self.shape:
+            self._allocate(frame)
+        cv2.resize(frame, self.size, dst=self.small, interpolation=cv2.INTER_AREA)
+        if self.small.ndim == 3:
+            cv2.cvtColor(self.small, cv2.COLOR_BGR2GRAY, dst=self.gray)
+        else:
+            self.gray[...] = self.small
+        if self.background is None:
+            self.background = self.gray.astype(np.float32)
+            return 1.
+        cv2.absdiff(self.gray, cv2.convertScaleAbs(self.background), dst=self.diff)
+        cv2.threshold(self.diff, self.config.pixel_threshold, 255, cv2.THRESH_BINARY, dst=self.mask)
+        cv2.accumulateWeighted(self.gray, self.background, self.config.alpha)
+        return cv2.countNonZero(self.mask) / float(self.mask.size)
+
+    def __call__(self, frame, timestamp: float = None) -> bool:
+        '''
+        True when frame should go through inference
+        '''
+        now = time.time() if timestamp is None else timestamp
+        self.changed = self.changed_fraction(frame)
+        if self.changed >= self.config.min_changed:
+            self.last_motion = now
+            self.static_frames = 0
+        else:
+            self.static_frames += 1
+
+        infer = now - self.last_motion <= self.config.hold or \
+            now - self.last_inference >= self.config.heartbeat or \
+            (self.config.stride > 0 and self.static_frames % self.config.stride == 0)
+        if infer:
+            self.last_inference = now
+        return infer
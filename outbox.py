@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+'''
+Disk backed store-and-forward spool of pending uploads
+'''
+
+import os
+import sqlite3
+import threading
+import time
+
+import metrics
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS uploads (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    key TEXT,
+    priority INTEGER NOT NULL,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt REAL NOT NULL DEFAULT 0,
+    created REAL NOT NULL,
+    updated REAL NOT NULL,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS pending_uploads ON uploads (state, priority, next_attempt, created);
+'''
+
+class Outbox(threading.Thread):
+    '''
+    SQLite index of files to upload. Rows move pending -> uploading -> done,
+    failed attempts go back to pending with exponential backoff and are
+    parked as failed after max_attempts. Human frames drain before
+    negatives, at most rate uploads per second, and only while online
+    '''
+    PENDING, UPLOADING, DONE, FAILED = 'pending', 'uploading', 'done', 'failed'
+    HUMAN, NEGATIVE = 0, 1
+
+    def __init__(self, config, uploader, monitor=None):
+        threading.Thread.__init__(self, daemon=True)
+        self.config = config
+        self.uploader = uploader
+        self.monitor = monitor
+        self.db_lock = threading.Lock()
+        self.db = sqlite3.connect(config.path, check_same_thread=False, isolation_level=None)
+        #WAL keeps the index consistent across power loss without an fsync per frame
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(SCHEMA)
+        #Anything that was uploading when we died is retried
+        recovered = self.db.execute('UPDATE uploads SET state = ? WHERE state = ?',
+                                    (self.PENDING, self.UPLOADING)).rowcount
+        if recovered:
+            print("[LOGS] OUTBOX recovered {} interrupted uploads".format(recovered))
+        self.in_flight = 0
+        self.closed = False
+        self.wake = threading.Event()
+        self.thread_running = False
+        #Called with (path, ok) after every upload attempt
+        self.listeners = []
+        #Called with (path, priority) for every added row
+        self.added = []
+        metrics.gauge('outbox_in_flight', 'Outbox uploads handed to the uploader', fn=lambda: self.in_flight)
+        for state in (self.PENDING, self.FAILED):
+            metrics.gauge('outbox_rows', 'Outbox rows by state',
+                          fn=lambda state=state: self.counts().get(state, 0), state=state)
+        if monitor is not None:
+            monitor.listeners.append(self.network_changed)
+
+    def add(self, path: str, priority: int = NEGATIVE, key: str = None):
+        now = time.time()
+        with self.db_lock:
+            self.db.execute(
+                'INSERT OR IGNORE INTO uploads (path, key, priority, state, created, updated) '
+                'VALUES (?, ?, ?, ?, ?, ?)', (path, key, priority, self.PENDING, now, now))
+        for listener in self.added:
+            listener(path, priority)
+        self.wake.set()
+
+    def network_changed(self, online: bool):
+        if online:
+            self.wake.set()
+
+    def online(self) -> bool:
+        return self.monitor is None or self.monitor.is_online()
+
+    def claim(self, limit: int):
+        '''
+        Marks up to limit due rows as uploading, best priority first
+        '''
+        now = time.time()
+        with self.db_lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            rows = self.db.execute(
+                'SELECT id, path, key FROM uploads WHERE state = ? AND next_attempt <= ? '
+                'ORDER BY priority, created LIMIT ?', (self.PENDING, now, limit)).fetchall()
+            self.db.executemany('UPDATE uploads SET state = ?, updated = ? WHERE id = ?',
+                                [(self.UPLOADING, now, row[0]) for row in rows])
+            self.db.execute('COMMIT')
+            self.in_flight += len(rows)
+        return rows
+
+    def finished(self, row_id: int, path: str, ok: bool, error: str = None, final: bool = False):
+        now = time.time()
+        with self.db_lock:
+            #Rows finishing after stop() stay uploading and are retried next boot
+            if self.closed:
+                return
+            self.in_flight -= 1
+            if ok:
+                self.db.execute('UPDATE uploads SET state = ?, updated = ?, error = NULL WHERE id = ?',
+                                (self.DONE, now, row_id))
+            else:
+                attempts = self.db.execute('SELECT attempts FROM uploads WHERE id = ?',
+                                           (row_id,)).fetchone()[0] + 1
+                state = self.FAILED if final or attempts >= self.config.max_attempts else self.PENDING
+                delay = min(self.config.backoff * 2 ** (attempts - 1), self.config.max_backoff)
+                self.db.execute(
+                    'UPDATE uploads SET state = ?, attempts = ?, next_attempt = ?, updated = ?, error = ? '
+                    'WHERE id = ?', (state, attempts, now + delay, now, error or 'upload failed', row_id))
+        for listener in self.listeners:
+            listener(path, ok)
+        self.wake.set()
+
+    def _submit(self, row):
+        row_id, path, key = row
+        if not os.path.exists(path):
+            #Retrying cannot bring the file back
+            self.finished(row_id, path, False, 'missing', final=True)
+            return
+        callback = lambda _, ok: self.finished(row_id, path, ok)
+        self.uploader.submit(path, key, callback)
+
+    def drain(self):
+        '''
+        Starts as many due uploads as the in-flight cap allows, paced to rate
+        '''
+        interval = 1. / self.config.rate if self.config.rate > 0 else 0.
+        while self.thread_running and self.online():
+            room = self.config.max_in_flight - self.in_flight
+            if room <= 0:
+                return
+            rows = self.claim(min(room, self.config.batch))
+            if not rows:
+                return
+            for row in rows:
+                self._submit(row)
+                if interval:
+                    time.sleep(interval)
+
+    def prune(self):
+        cutoff = time.time() - self.config.keep_days * 86400
+        with self.db_lock:
+            self.db.execute('DELETE FROM uploads WHERE state = ? AND updated < ?', (self.DONE, cutoff))
+
+    def start(self):
+        self.thread_running = True
+        threading.Thread.start(self)
+        return self
+
+    def run(self):
+        print("[LOGS] STARTING OUTBOX")
+        last_prune = 0.
+        while self.thread_running:
+            self.drain()
+            if time.time() - last_prune > 3600:
+                self.prune()
+                last_prune = time.time()
+            #Woken by new rows, finished uploads or the network coming back,
+            #otherwise poll for rows whose backoff expired
+            self.wake.wait(1.0)
+            self.wake.clear()
+
+    def pending(self) -> dict:
+        '''
+        {path: priority} of every row not uploaded yet
+        '''
+        with self.db_lock:
+            return dict(self.db.execute('SELECT path, priority FROM uploads WHERE state IN (?, ?)',
+                                        (self.PENDING, self.UPLOADING)).fetchall())
+
+    def counts(self) -> dict:
+        with self.db_lock:
+            return dict(self.db.execute('SELECT state, COUNT(*) FROM uploads GROUP BY state').fetchall())
+
+    def stop(self):
+        self.thread_running = False
+        self.wake.set()
+        if self.is_alive():
+            self.join()
+        with self.db_lock:
+            self.closed = True
+            self.db.close()
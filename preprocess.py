@@ -0,0 +1,57 @@
+'''
+Preallocated NCHW input buffers for the inference engine
+'''
+
+import cv2
+import numpy as np
+
+
+class Preprocessor:
+    '''
+    Resizes frames straight into a reusable HWC buffer and transposes (and
+    optionally normalizes) them into a persistent NCHW blob. The blob is
+    overwritten on every call, which is safe because async_infer copies its
+    inputs into the infer request
+    '''
+
+    def __init__(self, n: int, c: int, h: int, w: int, normalize: bool = False):
+        self.n, self.c, self.h, self.w = n, c, h, w
+        self.normalize = normalize
+        dtype = np.float32 if normalize else np.uint8
+        self.blob = np.zeros((n, c, h, w), dtype=dtype)
+        self.resized = np.empty((h, w, c), dtype=np.uint8)
+        #HWC -> CHW goes through cv2.split into per-channel views, uint8 slots
+        #are split into directly and normalized ones through a scratch plane
+        self.chw = self.blob if not normalize else np.empty((1, c, h, w), dtype=np.uint8)
+        self.planes = [[plane for plane in batch] for batch in self.chw]
+        #Slots written by the previous call, so padding is only cleared once
+        self.filled = 0
+
+    def fill(self, index: int, frame):
+        '''
+        Writes frame into batch slot index
+        '''
+        if frame.shape[:2] == (self.h, self.w):
+            resized = frame
+        else:
+            resized = cv2.resize(frame, (self.w, self.h), dst=self.resized)
+        slot = self.blob[index]
+        if not self.normalize:
+            cv2.split(resized, self.planes[index])
+        else:
+            cv2.split(resized, self.planes[0])
+            np.multiply(self.chw[0], np.float32(1 / 255.), out=slot)
+        return slot
+
+    def __call__(self, frames):
+        '''
+        Returns the NCHW blob holding frames, unused batch slots are zeroed
+        '''
+        if len(frames) > self.n:
+            raise Exception("{} frames do not fit a batch of {}".format(len(frames), self.n))
+        for index, frame in enumerate(frames):
+            self.fill(index, frame)
+        if self.filled > len(frames):
+            self.blob[len(frames):self.filled] = 0
+        self.filled = len(frames)
+        return self.blob
@@ -0,0 +1,180 @@
+'''
+Offline replay of recorded footage: video files, image directories and glob
+patterns behind a VideoCapture-like interface, decoded ahead on a thread
+'''
+
+import glob
+import os
+import queue
+import threading
+import time
+
+import cv2
+import numpy as np
+
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.webp', '.tif', '.tiff')
+
+def is_replay(source) -> bool:
+    '''
+    True for an existing file or directory and for glob patterns
+    '''
+    if not isinstance(source, str) or '://' in source:
+        return False
+    return os.path.exists(source) or glob.has_magic(source)
+
+def expand(source: str) -> list:
+    '''
+    Files to play in order: a directory's images sorted by name, the
+    matches of a glob pattern sorted, or the file itself
+    '''
+    if os.path.isdir(source):
+        return sorted(os.path.join(source, name) for name in os.listdir(source)
+                      if name.lower().endswith(IMAGE_EXTENSIONS))
+    if glob.has_magic(source):
+        return sorted(path for path in glob.glob(source) if os.path.isfile(path))
+    return [source]
+
+
+class ReplayCapture:
+    '''
+    Plays the files of source one after the other. A thread decodes up to
+    prefetch frames ahead, read() never skips one. With realtime set reads
+    are paced to the video's frame rate, or fps for images, otherwise they
+    return as fast as the consumer takes them. read() returns False once
+    everything was played and finished is set. With encoded set JPEG files
+    and MJPEG videos are returned as their compressed bytes, like a camera
+    in MJPEG passthrough mode
+    '''
+    def __init__(self, source: str, realtime: bool = False, fps: float = 10., prefetch: int = 16,
+                 loop: bool = False, encoded: bool = False):
+        self.paths = expand(source)
+        if not self.paths:
+            raise Exception("Nothing to replay in {}".format(source))
+        self.realtime = realtime
+        self.default_fps = fps
+        self.loop = loop
+        self.encoded = encoded
+        self.frames = queue.Queue(maxsize=max(prefetch, 1))
+        self.finished = False
+        self.count = 0
+        self.fps = fps
+        self.next_frame = None
+        #The first frame is decoded here so get() can report the size
+        self.thread_running = True
+        self.thread = threading.Thread(target=self.decode, daemon=True)
+        self.thread.start()
+        self.first = self.frames.get()
+        if self.first is None:
+            raise Exception("Could not decode {}".format(source))
+        first = self.first[0]
+        if first.ndim < 3:
+            first = cv2.imdecode(first, cv2.IMREAD_COLOR)
+        self.shape = first.shape
+
+    def _frames(self):
+        '''
+        Yields (frame, fps) over all files, unreadable files are skipped
+        '''
+        for path in self.paths:
+            if not self.thread_running:
+                return
+            if path.lower().endswith(IMAGE_EXTENSIONS):
+                if self.encoded and path.lower().endswith(('.jpg', '.jpeg')):
+                    frame = np.fromfile(path, dtype=np.uint8)
+                    frame = frame if len(frame) else None
+                else:
+                    frame = cv2.imread(path, cv2.IMREAD_COLOR)
+                if frame is None:
+                    print("[ALERT] Could not read {}".format(path))
+                    continue
+                yield frame, self.default_fps
+                continue
+            cap = cv2.VideoCapture(path)
+            if not cap.isOpened():
+                print("[ALERT] Could not open {}".format(path))
+                continue
+            fps = cap.get(cv2.CAP_PROP_FPS) or self.default_fps
+            if self.encoded and int(cap.get(cv2.CAP_PROP_FOURCC)) == cv2.VideoWriter_fourcc(*'MJPG'):
+                #Demuxed packets without decoding, each one a JPEG
+                cap.set(cv2.CAP_PROP_FORMAT, -1)
+            try:
+                while self.thread_running:
+                    grabbed, frame = cap.read()
+                    if not grabbed:
+                        break
+                    yield frame, fps
+            finally:
+                cap.release()
+
+    def decode(self):
+        while self.thread_running:
+            played = False
+            for item in self._frames():
+                played = True
+                #Blocks while prefetch frames are waiting, the consumer sets the pace
+                while self.thread_running:
+                    try:
+                        self.frames.put(item, timeout=0.5)
+                        break
+                    except queue.Full:
+                        continue
+            if not (self.loop and played):
+                break
+        self.frames.put(None)
+
+    def isOpened(self):
+        return True
+
+    def set(self, prop, value):
+        #Like a VideoCapture on a file, the recorded size is what it is
+        return False
+
+    def get(self, prop):
+        if prop == cv2.CAP_PROP_FRAME_WIDTH:
+            return float(self.shape[1])
+        if prop == cv2.CAP_PROP_FRAME_HEIGHT:
+            return float(self.shape[0])
+        if prop == cv2.CAP_PROP_FPS:
+            return float(self.fps)
+        if prop == cv2.CAP_PROP_POS_FRAMES:
+            return float(self.count)
+        return 0.
+
+    def _pace(self):
+        now = time.time()
+        if self.next_frame is None or now - self.next_frame > 1.:
+            #First frame, or the consumer stalled: don't race to catch up
+            self.next_frame = now
+        elif self.next_frame > now:
+            time.sleep(self.next_frame - now)
+        self.next_frame += 1. / self.fps
+
+    def read(self, image=None):
+        if self.finished:
+            return False, None
+        if self.first is not None:
+            item, self.first = self.first, None
+        else:
+            item = self.frames.get()
+        if item is None:
+            self.finished = True
+            return False, None
+        frame, self.fps = item
+        if self.realtime:
+            self._pace()
+        self.count += 1
+        if image is not None and image.shape == frame.shape:
+            np.copyto(image, frame)
+            return True, image
+        return True, frame
+
+    def release(self):
+        self.thread_running = False
+        #Unblocks a decoder waiting on a full queue
+        while not self.frames.empty():
+            try:
+                self.frames.get_nowait()
+            except queue.Empty:
+                break
+        self.thread.join(timeout=1.)
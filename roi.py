@@ -0,0 +1,143 @@
+'''
+Regions of interest and tile grids: which parts of a frame go to the
+detector, and mapping the boxes found there back onto the full frame
+'''
+
+from dataclasses import dataclass
+from typing import List, Tuple
+
+import cv2
+import numpy as np
+
+from detect import Detections
+from track import nms
+
+
+@dataclass(frozen=True)
+class Region:
+    '''
+    Bounds as fractions of the frame, so they survive resolution changes.
+    A polygon region only keeps boxes whose center lies inside it
+    '''
+    rect: Tuple[float, float, float, float]
+    polygon: np.ndarray = None
+
+def parse_regions(text: str) -> List[Region]:
+    '''
+    "rect 0,0.3,1,1; poly 0.1,0.1,0.6,0.1,0.6,0.7", coordinates are x,y
+    fractions of the frame width and height
+    '''
+    regions = []
+    for entry in filter(None, (entry.strip() for entry in text.split(';'))):
+        kind, _, values = entry.partition(' ')
+        values = [float(value) for value in values.replace(' ', '').split(',') if value]
+        if kind == 'rect' and len(values) == 4:
+            x0, y0, x1, y1 = values
+            regions.append(Region((min(x0, x1), min(y0, y1), max(x0, x1), max(y0, y1))))
+        elif kind == 'poly' and len(values) >= 6 and len(values) % 2 == 0:
+            points = np.array(values, dtype=np.float32).reshape(-1, 2)
+            x0, y0 = points.min(axis=0)
+            x1, y1 = points.max(axis=0)
+            regions.append(Region((float(x0), float(y0), float(x1), float(y1)), points))
+        else:
+            raise Exception("Bad region {}".format(entry))
+    return regions
+
+def grid(rect, cols: int, rows: int, overlap: float) -> list:
+    '''
+    cols x rows tiles covering rect, neighbours share overlap of a tile
+    '''
+    x0, y0, x1, y1 = rect
+    tiles = []
+    width = (x1 - x0) / (cols - (cols - 1) * overlap)
+    height = (y1 - y0) / (rows - (rows - 1) * overlap)
+    for row in range(rows):
+        for col in range(cols):
+            left = x0 + col * width * (1 - overlap)
+            top = y0 + row * height * (1 - overlap)
+            tiles.append((left, top, left + width, top + height))
+    return tiles
+
+
+class Tiler:
+    '''
+    Cuts one camera's frames into the windows of its regions, each window a
+    batch slot, and merges the per window detections back into one full
+    frame Detections. The window count never changes, so batch layouts stay
+    fixed while the capture resolution does not
+    '''
+    def __init__(self, regions: List[Region] = None, cols: int = 1, rows: int = 1,
+                 overlap: float = 0.2, merge_iou: float = 0.5):
+        self.regions = regions or [Region((0., 0., 1., 1.))]
+        self.merge_iou = merge_iou
+        cols, rows = max(cols, 1), max(rows, 1)
+        overlap = min(max(overlap, 0.), 0.9)
+        #(region index, normalized window)
+        self.windows = [(index, tile) for index, region in enumerate(self.regions)
+                        for tile in grid(region.rect, cols, rows, overlap)]
+
+    def __len__(self):
+        return len(self.windows)
+
+    @staticmethod
+    def _pixels(rect, shape) -> Tuple[int, int, int, int]:
+        height, width = shape[:2]
+        x0, y0, x1, y1 = rect
+        left, top = int(round(x0 * width)), int(round(y0 * height))
+        return (min(max(left, 0), width - 1), min(max(top, 0), height - 1),
+                min(max(int(round(x1 * width)), left + 1), width),
+                min(max(int(round(y1 * height)), top + 1), height))
+
+    def crops(self, frame) -> list:
+        '''
+        Views into frame, the preprocessor resizes them into the blob
+        '''
+        crops = []
+        for _, rect in self.windows:
+            x0, y0, x1, y1 = self._pixels(rect, frame.shape)
+            crops.append(frame[y0:y1, x0:x1])
+        return crops
+
+    def merge(self, results: list, shape):
+        '''
+        Per window results, in window pixels, to one full frame result. Boxes
+        cut by a tile border are found twice, NMS keeps the better one
+        '''
+        found = [result for result in results if result is not None]
+        if not found:
+            return None
+        if not hasattr(found[0], 'boxes'):
+            #Classifier: a human in any window is a human in the frame
+            return any(found)
+        height, width = shape[:2]
+        boxes, scores = [], []
+        for (index, rect), result in zip(self.windows, results):
+            if result is None or not len(result):
+                continue
+            x0, y0, _, _ = self._pixels(rect, shape)
+            shifted = result.boxes + np.array([x0, y0, x0, y0], dtype=np.float32)
+            keep = np.ones(len(shifted), dtype=bool)
+            polygon = self.regions[index].polygon
+            if polygon is not None:
+                outline = polygon * np.array([width, height], dtype=np.float32)
+                for row, box in enumerate(shifted.tolist()):
+                    center = ((box[0] + box[2]) / 2, (box[1] + box[3]) / 2)
+                    keep[row] = cv2.pointPolygonTest(outline, center, False) >= 0
+            boxes.append(shifted[keep])
+            scores.append(result.scores[keep])
+        if not boxes:
+            return found[0].select(np.zeros(0, dtype=np.int64))
+        merged = Detections(np.concatenate(boxes), np.concatenate(scores),
+                            label=found[0].label, time=max(result.time for result in found))
+        if len(merged) > 1 and len(self.windows) > 1:
+            merged = merged.select(nms(merged.boxes, merged.scores, self.merge_iou))
+        return merged
+
+def build_tilers(config, count: int):
+    '''
+    One Tiler per camera from [roi], None while disabled
+    '''
+    if not config.enabled:
+        return None
+    return [Tiler(parse_regions(config.regions.get(index, '')), config.cols, config.rows,
+                  config.overlap, config.merge_iou) for index in range(count)]
@@ -1,18 +1,30 @@
 #!/usr/bin/env python3
 
 from argparse import ArgumentParser
-from copy import deepcopy
 from datetime import datetime, timezone
 import os
 import time
+#Before the heavy imports, for the time to first inference report
+STARTED = time.time()
 
 import cv2
 import numpy as np
 
-from boto import upload_frame
-from cam import add_camera_args, Camera
+from boto import get_uploader, start_monitor, stop_uploads
+from bundle import SegmentBundler
+from cam import add_camera_args, MultiCamera
 from config import Config
-from detect import OpenVinoDetectorAsync, OpenVinoClassifierAsync
+from control import LoadController
+from detect import BatchScheduler, OpenVinoDetectorAsync, OpenVinoClassifierAsync
+from encode import Encoder
+from events import EventRecorder
+import metrics
+from motion import MotionGate
+from outbox import Outbox
+from replay import ReplayCapture
+from roi import build_tilers
+from stages import Stage
+from storage import StorageManager
 from write import WriteQueue
 
 
@@ -32,6 +44,64 @@ def parse_args():
     args = parser.parse_args()
     return args
 
+#Bound by bind_metrics once the registry is configured
+FRAME_AGE = PERSIST_TIME = RECYCLED = metrics.NULL
+
+def bind_metrics():
+    global FRAME_AGE, PERSIST_TIME, RECYCLED
+    FRAME_AGE = metrics.histogram('pipeline_frame_age_seconds', 'Capture to persisted')
+    PERSIST_TIME = metrics.histogram('pipeline_persist_seconds', 'process_result for one frame')
+    RECYCLED = metrics.counter('pipeline_recycled_frames_total', 'Frames overwritten before their result came back')
+
+def annotate(frame, detections):
+    '''
+    Copy of frame with the detection boxes and a HUMAN banner
+    '''
+    frame = frame.copy()
+    #Boxes are in pixels of this frame, classifier results have none
+    for xmin, ymin, xmax, ymax in getattr(detections, 'boxes', np.zeros((0, 4))).astype(np.int32).tolist():
+        cv2.rectangle(frame, (xmin, ymin), (xmax, ymax), (25, 25, 255), 2)
+    cv2.putText(frame,'HUMAN',(10,400), cv2.FONT_HERSHEY_SIMPLEX, 4,(25,25,255),2,cv2.LINE_AA)
+    return frame
+
+def process_result(cam, captured, detections, outbox, write_queue, encoder, folder='tmp/', events=None):
+    '''
+    Persists a frame once its inference result is back, returns the
+    annotated copy of human frames. With an events.EventRecorder human
+    frames go into event clips instead of one upload each
+    '''
+    start = time.time()
+    #Read-only, detached from the ring by the scheduler unless the camera holds it
+    frame = captured.data
+    if not captured.detached and not cam.hold and cam.is_valid(captured):
+        #Unless the camera holds it the slot can be reused while this frame
+        #is written, a copy taken while the slot is still valid is not
+        frame = frame.copy()
+    if not cam.is_valid(captured):
+        RECYCLED.inc()
+        print("[ALERT] Frame {} was recycled before its result came back".format(captured.seq))
+        return None
+    timestamp = datetime.fromtimestamp(captured.timestamp, tz=timezone.utc).strftime('%Y-%m-%d-%H-%M-%S-%f')
+    path = folder + timestamp + '.jpg'
+    if events is not None:
+        #Frames outside events, including lone false positives, are negatives
+        if not events.update(frame, captured.timestamp, detections):
+            write_queue.enqueue(path, frame, encoded=captured.encoded, timestamp=captured.timestamp)
+        frame = annotate(frame, detections) if detections else None
+    elif detections:
+        frame = annotate(frame, detections)
+        path = encoder.write(path, frame)
+        #Survives outages and reboots, human frames go out first
+        outbox.add(path, Outbox.HUMAN)
+    else: 
+        #add to upload queue, as the camera's JPEG when there is one
+        write_queue.enqueue(path, frame, encoded=captured.encoded, timestamp=captured.timestamp)
+        frame = None
+    done = time.time()
+    PERSIST_TIME.observe(done - start)
+    FRAME_AGE.observe(done - captured.timestamp)
+    return frame
+
 def main(): 
     '''
     Main loop that initializes camera and other 
@@ -40,54 +110,144 @@ def main():
     args = parse_args()
 
     config = Config()
+    exporter = metrics.start(config.Metrics)
+    bind_metrics()
+    monitor = start_monitor(config)
+    outbox = Outbox(config.Outbox, get_uploader(config), monitor).start()
 
-    #Start Camera async class    
-    cam = Camera(args)
-    cam.start()
+    #Start Camera async classes, one per source
+    cameras = MultiCamera(args)
+    #Each camera writes to its own folder once there is more than one
+    folders = ['tmp/']
+    if len(cameras) > 1:
+        folders = ['tmp/cam{}/'.format(cam.id) for cam in cameras]
+    for folder in folders:
+        os.makedirs(folder, exist_ok=True)
+    #Keeps the SD card from filling up, files are indexed as they are written
+    storage = None
+    if config.Storage.enabled:
+        storage = StorageManager(config.Storage, 'tmp/', outbox)
+        storage.scan()
+        storage.start()
+    #Decided before the cameras start, a replay must not run ahead while the model loads
+    policy = config.Pipeline.policy
+    #Fast replay must not skip frames, the files wait for the pipeline instead
+    if policy != 'process_all' and any(isinstance(cam.cap, ReplayCapture) and not cam.cap.realtime
+                                       for cam in cameras):
+        print("[LOGS] REPLAYING AS FAST AS POSSIBLE, frame policy {} -> process_all".format(policy))
+        policy = 'process_all'
+    #process_all never overwrites a frame before it has been persisted
+    for cam in cameras:
+        cam.hold = policy == 'process_all'
+    cameras.start()
 
     #Start io writing queue
-    write_queue = WriteQueue()
+    negative_encoder = Encoder(config.Encoding.negative)
+    bundler = None
+    if config.Bundle.enabled:
+        #Negatives leave the device as one object per segment
+        bundler = SegmentBundler(config.Bundle, negative_encoder)
+        bundler.listeners.append(lambda path: outbox.add(path, Outbox.NEGATIVE))
+    write_queue = WriteQueue(config.Write, negative_encoder, bundler)
+    if storage is not None:
+        write_queue.listeners.append(storage.written)
+    human_encoder = Encoder(config.Encoding.human)
+    if config.Outbox.upload_negatives and bundler is None:
+        write_queue.listeners.append(lambda path, ok: ok and outbox.add(path, Outbox.NEGATIVE))
     write_queue.start()
+    #A single model instance serves every camera, one batch slot each
+    #With [roi] every window of every camera takes a slot
+    tilers = build_tilers(config.Roi, len(cameras))
+    slots = sum(len(tiler) for tiler in tilers) if tilers else len(cameras)
+    batch_size = slots if slots > 1 else None
     if config.Inference.mode == 'detect':
         print('Running detection')
-        detector = OpenVinoDetectorAsync(config.Inference)
+        detector = OpenVinoDetectorAsync(config.Inference, batch_size)
     else:
-        detector = OpenVinoClassifierAsync(config.Inference)
-
-    while True: 
-        _,frame = cam.read()
-        start_time = time.time()
-        infer_frame = deepcopy(frame)
-        detections = detector.run(infer_frame)
-        timestamp = datetime.now(tz=timezone.utc).strftime('%Y-%m-%d-%H-%M-%S-%f')
-        path = 'tmp/' + timestamp + '.jpg'
-        if detections:
-            '''
-            Need to fix the bounding box locations
-            for detection in detections:
-                xmin = detection.position.xmin
-                ymin = detection.position.ymin  
-                xmax = detection.position.xmax 
-                ymax = detection.position.ymax 
-                cv2.rectangle(frame, (int(xmin), int(ymin)), (int(xmax), int(ymax)), detection.color, 2)
-            '''
-            cv2.putText(frame,'HUMAN',(10,400), cv2.FONT_HERSHEY_SIMPLEX, 4,(25,25,255),2,cv2.LINE_AA)
-            cv2.imshow('frame', frame)
-            cv2.imwrite(path, frame)
-            #This has to RTT 
-            upload_frame(path, config)
-        else: 
-            #add to upload queue
-            write_queue.enqueue(path, frame)
-        end_time = time.time()
-        print("[LOGS] ---PIPELINE TIME--- **{}**".format(end_time-start_time))
-        if cv2.waitKey(1) & 0xFF == ord('q'):
-            break 
-    cam.stop()
+        detector = OpenVinoClassifierAsync(config.Inference, batch_size)
+    #Lazy device allocations are paid for before the first real frame
+    elapsed = detector.warmup()
+    startup = time.time() - STARTED
+    print("[LOGS] TIME TO FIRST INFERENCE {:.2f}s (warm-up inference {:.3f}s)".format(startup, elapsed))
+    metrics.gauge('startup_seconds', 'Process start to first inference').set(startup)
+    if cameras[0].ring_size <= detector.num_requests + 1:
+        print("[ALERT] --ring should be larger than num_requests + 1")
+    #Static scenes skip inference and are archived as negatives
+    gates = None
+    if config.Motion.enabled:
+        gates = [MotionGate(config.Motion) for _ in range(len(cameras))]
+    scheduler = BatchScheduler(cameras, detector, gates, policy, config.Pipeline.depth, config.Pipeline.poll,
+                               tilers)
+    if policy == 'drop_oldest' and scheduler.depth < config.Pipeline.depth:
+        print("[ALERT] --ring {} caps the drop_oldest depth at {}".format(cameras[0].ring_size, scheduler.depth))
+
+    #One clip per event instead of one upload per human frame
+    recorders = [None] * len(cameras)
+    if config.Events.enabled:
+        recorders = [EventRecorder(config.Events, folders[index], human_encoder, outbox, cam.id)
+                     for index, cam in enumerate(cameras)]
+
+    #capture (camera threads) -> infer (this thread) -> annotate and persist
+    preview = []
+    def persist(item):
+        index, done, detections = item
+        annotated = process_result(cameras[index], done, detections, outbox, write_queue, human_encoder,
+                                   folders[index], recorders[index])
+        cameras[index].release(done.seq)
+        if controller is not None:
+            controller.record(time.time() - done.timestamp)
+        if annotated is not None and args.detect:
+            preview[:] = [annotated]
+    #Queued results must not outlive their ring slots unless the camera holds them
+    persist_queue = config.Pipeline.persist_queue
+    if policy != 'process_all' and persist_queue > cameras[0].ring_size - 2:
+        persist_queue = max(cameras[0].ring_size - 2, 1)
+        print("[ALERT] --ring {} caps the persist queue at {}".format(cameras[0].ring_size, persist_queue))
+    persister = Stage('persist', persist, persist_queue,
+                      on_drop=lambda item: cameras[item[0]].release(item[1].seq))
+    #Degrades stride, resolution and negative quality instead of piling up work
+    controller = None
+    if config.Load.enabled:
+        controller = LoadController(config.Load, cameras, scheduler, negative_encoder,
+                                    write_queue, outbox, persister).start()
+    persister.start()
+
+    def dispatch(results):
+        for index, done, detections in results:
+            #Under load negatives give way, human frames and process_all wait
+            persister.put((index, done, detections), drop=not detections and policy != 'process_all')
+
+    try:
+        while True: 
+            #Wakes on new frames, batch k+1 is submitted while batch k is still being inferred
+            dispatch(scheduler.step(timeout=1.0))
+            if scheduler.exhausted():
+                break
+            if args.detect:
+                if preview:
+                    cv2.imshow('frame', preview.pop())
+                if cv2.waitKey(1) & 0xFF == ord('q'):
+                    break 
+    except KeyboardInterrupt:
+        pass
+    dispatch(scheduler.drain())
+    persister.stop()
+    for recorder in recorders:
+        if recorder is not None:
+            recorder.close()
+    if controller is not None:
+        controller.stop()
+    cameras.stop()
+    detector.close()
     write_queue.stop()
+    outbox.stop()
+    if storage is not None:
+        storage.stop()
+    stop_uploads()
+    if exporter is not None:
+        exporter.stop()
     cv2.destroyAllWindows() 
     
 
 if __name__ == "__main__":
     main()
-
@@ -0,0 +1,113 @@
+'''
+Fixed size frame slots in shared memory, so queues only carry descriptors
+'''
+
+from collections import deque
+from dataclasses import dataclass, field
+from multiprocessing import shared_memory
+import threading
+from typing import Optional, Tuple
+import uuid
+
+import numpy as np
+
+
+@dataclass
+class SpoolDescriptor:
+    '''
+    What goes through a queue instead of the frame bytes
+    '''
+    slot: int
+    shape: Tuple[int, ...]
+    dtype: str
+    path: str = ''
+    id: str = field(default_factory=lambda: str(uuid.uuid4()))
+    #Shared memory name of the spool holding the slot
+    spool: str = ''
+    #Capture time of the frame, 0 when unknown
+    timestamp: float = 0.
+
+
+class FrameSpool:
+    '''
+    slots x slot_bytes of shared memory with a free list. Only the process
+    that created the spool hands out and releases slots, other processes
+    attach by name and read or write the slots they are told about
+    '''
+
+    def __init__(self, slots: int, slot_bytes: int, name: str = None, create: bool = True):
+        if slots < 1 or slot_bytes < 1:
+            raise Exception("Spool needs at least one slot of one byte")
+        self.slots = slots
+        self.slot_bytes = slot_bytes
+        self.owner = create
+        self.shm = shared_memory.SharedMemory(name=name, create=create, size=slots * slot_bytes)
+        self.name = self.shm.name
+        self.free = deque(range(slots)) if create else deque()
+        self.slot_freed = threading.Condition()
+
+    @classmethod
+    def attach(cls, name: str, slots: int, slot_bytes: int) -> 'FrameSpool':
+        return cls(slots, slot_bytes, name=name, create=False)
+
+    @property
+    def capacity(self) -> int:
+        return self.slots * self.slot_bytes
+
+    def available(self) -> int:
+        with self.slot_freed:
+            return len(self.free)
+
+    def acquire(self, timeout: float = 0) -> Optional[int]:
+        '''
+        Takes a free slot, waiting up to timeout seconds (None waits forever).
+        Returns None when the spool stays full
+        '''
+        with self.slot_freed:
+            if timeout != 0 and not self.free:
+                self.slot_freed.wait_for(lambda: self.free, timeout)
+            if not self.free:
+                return None
+            return self.free.popleft()
+
+    def release(self, slot: int):
+        with self.slot_freed:
+            self.free.append(slot)
+            self.slot_freed.notify()
+
+    def view(self, slot: int, shape, dtype) -> np.ndarray:
+        '''
+        Array backed by the slot's memory, no copy is made
+        '''
+        return np.ndarray(shape, dtype=np.dtype(dtype), buffer=self.shm.buf,
+                          offset=slot * self.slot_bytes)
+
+    def write(self, slot: int, frame: np.ndarray, path: str = '') -> SpoolDescriptor:
+        if frame.nbytes > self.slot_bytes:
+            raise Exception("{} byte frame does not fit a {} byte slot".format(frame.nbytes, self.slot_bytes))
+        self.view(slot, frame.shape, frame.dtype)[...] = frame
+        return SpoolDescriptor(slot, tuple(frame.shape), frame.dtype.str, path, spool=self.name)
+
+    def put(self, frame: np.ndarray, path: str = '', timeout: float = 0) -> Optional[SpoolDescriptor]:
+        '''
+        Copies frame into a free slot, None when the spool is full
+        '''
+        slot = self.acquire(timeout)
+        if slot is None:
+            return None
+        try:
+            return self.write(slot, frame, path)
+        except Exception:
+            self.release(slot)
+            raise
+
+    def read(self, descriptor: SpoolDescriptor) -> np.ndarray:
+        return self.view(descriptor.slot, descriptor.shape, descriptor.dtype)
+
+    def close(self):
+        '''
+        Views handed out by view()/read() must be dropped before closing
+        '''
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
@@ -0,0 +1,82 @@
+'''
+Pipeline stages: a worker thread fed through a bounded queue
+'''
+
+from collections import deque
+import threading
+import time
+
+import metrics
+
+
+class Stage(threading.Thread):
+    '''
+    Runs fn on every item put on its queue, in order. Once size items are
+    waiting, put() evicts the oldest droppable item (drop=True) or blocks
+    the caller, so a slow stage pushes back instead of growing without bound
+    '''
+    def __init__(self, name: str, fn, size: int, on_drop=None):
+        threading.Thread.__init__(self, name=name, daemon=True)
+        self.fn = fn
+        self.size = max(size, 1)
+        #Called with every evicted item, e.g. to release its frame
+        self.on_drop = on_drop
+        self.items = deque()
+        self.changed = threading.Condition()
+        self.thread_running = False
+        self.dropped = 0
+        self.wait_time = metrics.histogram('stage_queue_seconds', 'Time items spent queued', stage=name)
+        metrics.gauge('stage_queue_depth', 'Items waiting', fn=lambda: len(self.items), stage=name)
+        metrics.counter('stage_dropped_total', 'Items evicted from a full queue', fn=lambda: self.dropped, stage=name)
+
+    def start(self):
+        self.thread_running = True
+        threading.Thread.start(self)
+        return self
+
+    def _evict(self):
+        for index, (item, droppable, _) in enumerate(self.items):
+            if droppable:
+                del self.items[index]
+                self.dropped += 1
+                return item
+        return None
+
+    def put(self, item, drop: bool = False):
+        evicted = None
+        with self.changed:
+            if len(self.items) >= self.size:
+                evicted = self._evict() if drop else None
+                if evicted is None:
+                    self.changed.wait_for(lambda: len(self.items) < self.size or not self.thread_running)
+            self.items.append((item, drop, time.time()))
+            self.changed.notify_all()
+        if evicted is not None and self.on_drop is not None:
+            self.on_drop(evicted)
+
+    def __len__(self):
+        return len(self.items)
+
+    def run(self):
+        while True:
+            with self.changed:
+                self.changed.wait_for(lambda: self.items or not self.thread_running)
+                if not self.items:
+                    break
+                item, _, queued = self.items.popleft()
+                self.changed.notify_all()
+            self.wait_time.observe(time.time() - queued)
+            try:
+                self.fn(item)
+            except Exception as e:
+                print("[ALERT] Stage {} FAILED: {}".format(self.name, e))
+
+    def stop(self):
+        '''
+        Finishes what is queued, then joins
+        '''
+        with self.changed:
+            self.thread_running = False
+            self.changed.notify_all()
+        if self.is_alive():
+            self.join()
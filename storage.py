@@ -0,0 +1,185 @@
+'''
+Disk budget for the frame folder: an in-memory index of the files written
+there and LRU eviction once a byte or file quota is exceeded
+'''
+
+from collections import OrderedDict
+import os
+import threading
+
+import metrics
+from outbox import Outbox
+
+
+class StorageManager(threading.Thread):
+    '''
+    Files are indexed as they are written or queued for upload, the folder
+    is only scanned once at startup. Over quota the oldest files of the
+    cheapest bucket go first: uploaded negatives (including negatives that
+    are never uploaded), uploaded human files, pending negatives and last
+    pending human files. Deletes run on this thread, never on a writer's
+    '''
+    UPLOADED_NEGATIVE, UPLOADED_HUMAN, PENDING_NEGATIVE, PENDING_HUMAN = range(4)
+
+    def __init__(self, config, folder: str = 'tmp/', outbox=None):
+        threading.Thread.__init__(self, daemon=True)
+        self.config = config
+        self.folder = folder
+        self.outbox = outbox
+        #One {path: size} per bucket in insertion order, i.e. least recent first
+        self.buckets = [OrderedDict() for _ in range(4)]
+        self.where = {}
+        self.bytes = 0
+        self.lock = threading.Lock()
+        #Confirmed uploads waiting for the next batch delete
+        self.deletions = []
+        self.evicted = 0
+        self.deleted = 0
+        self.wake = threading.Event()
+        self.thread_running = False
+        metrics.gauge('storage_bytes', 'Bytes of indexed files', fn=lambda: self.bytes)
+        metrics.gauge('storage_files', 'Indexed files', fn=lambda: len(self.where))
+        metrics.counter('storage_evicted_total', 'Files deleted to stay within quota', fn=lambda: self.evicted)
+        metrics.counter('storage_deleted_total', 'Files deleted after their upload', fn=lambda: self.deleted)
+        if outbox is not None:
+            outbox.added.append(self.queued)
+            outbox.listeners.append(self.uploaded)
+
+    def scan(self):
+        '''
+        Indexes what a previous run left behind, files the outbox still has
+        to upload keep their priority
+        '''
+        pending = self.outbox.pending() if self.outbox is not None else {}
+        for root, _, files in os.walk(self.folder):
+            for name in files:
+                path = os.path.join(root, name)
+                priority = pending.get(path)
+                if priority is None:
+                    self._track(path, self.UPLOADED_NEGATIVE)
+                else:
+                    self._track(path, self.PENDING_HUMAN if priority == Outbox.HUMAN else self.PENDING_NEGATIVE)
+        print("[LOGS] STORAGE {} files, {:.1f} MB in {}".format(len(self.where), self.bytes / 2. ** 20, self.folder))
+
+    def _track(self, path: str, bucket: int, only_new: bool = False):
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            #e.g. a frame that went into a bundle segment
+            return
+        with self.lock:
+            previous = self.where.get(path)
+            if previous is not None:
+                if only_new:
+                    return
+                self.bytes -= self.buckets[previous].pop(path)
+            self.buckets[bucket][path] = size
+            self.where[path] = bucket
+            self.bytes += size
+            over = self.over_quota()
+        if over:
+            self.wake.set()
+
+    def over_quota(self, fill: float = 1.) -> bool:
+        return self.bytes > fill * self.config.max_mb * 2 ** 20 or \
+            len(self.where) > fill * self.config.max_files
+
+    def written(self, path: str, ok: bool):
+        '''
+        WriteQueue listener. A negative queued for upload first keeps its
+        pending bucket
+        '''
+        if ok:
+            self._track(path, self.UPLOADED_NEGATIVE, only_new=True)
+
+    def queued(self, path: str, priority: int):
+        '''
+        Outbox listener for added rows
+        '''
+        self._track(path, self.PENDING_HUMAN if priority == Outbox.HUMAN else self.PENDING_NEGATIVE)
+
+    def uploaded(self, path: str, ok: bool):
+        '''
+        Outbox listener for finished uploads
+        '''
+        if not ok:
+            return
+        with self.lock:
+            bucket = self.where.get(path)
+            if bucket is None:
+                return
+            if self.config.delete_uploaded:
+                self.deletions.append(path)
+                if len(self.deletions) >= self.config.delete_batch:
+                    self.wake.set()
+                return
+            uploaded = self.UPLOADED_HUMAN if bucket == self.PENDING_HUMAN else self.UPLOADED_NEGATIVE
+            self.buckets[uploaded][path] = self.buckets[bucket].pop(path)
+            self.where[path] = uploaded
+
+    def _forget(self, path: str) -> bool:
+        bucket = self.where.pop(path, None)
+        if bucket is None:
+            return False
+        self.bytes -= self.buckets[bucket].pop(path)
+        return True
+
+    def _remove(self, paths):
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def flush(self):
+        '''
+        Deletes the uploaded files collected so far in one go
+        '''
+        with self.lock:
+            deletions, self.deletions = self.deletions, []
+            deletions = [path for path in deletions if self._forget(path)]
+        self._remove(deletions)
+        self.deleted += len(deletions)
+
+    def enforce(self):
+        '''
+        Evicts down to low_water of the quota once it is exceeded
+        '''
+        victims, unsent = [], 0
+        with self.lock:
+            if not self.over_quota():
+                return
+            for index, bucket in enumerate(self.buckets):
+                while bucket and self.over_quota(self.config.low_water):
+                    path, size = bucket.popitem(last=False)
+                    del self.where[path]
+                    self.bytes -= size
+                    victims.append(path)
+                    unsent += index >= self.PENDING_NEGATIVE
+        self._remove(victims)
+        self.evicted += len(victims)
+        if unsent:
+            #The outbox drops their rows as missing
+            print("[ALERT] STORAGE over quota, evicted {} files that were not uploaded yet".format(unsent))
+
+    def start(self):
+        self.thread_running = True
+        threading.Thread.start(self)
+        return self
+
+    def run(self):
+        while self.thread_running:
+            self.wake.wait(self.config.interval)
+            self.wake.clear()
+            try:
+                self.flush()
+                self.enforce()
+            except Exception as e:
+                print("[ALERT] Storage manager FAILED: {}".format(e))
+
+    def stop(self):
+        self.thread_running = False
+        self.wake.set()
+        if self.is_alive():
+            self.join()
+        self.flush()
@@ -0,0 +1,84 @@
+'''
+Array based box utilities: IoU, non-maximum suppression and an IoU tracker
+'''
+
+import numpy as np
+
+
+def iou_matrix(a, b):
+    '''
+    Pairwise IoU between (N, 4) and (M, 4) xmin, ymin, xmax, ymax boxes
+    '''
+    a = np.asarray(a, dtype=np.float32).reshape(-1, 4)
+    b = np.asarray(b, dtype=np.float32).reshape(-1, 4)
+    xmin = np.maximum(a[:, None, 0], b[None, :, 0])
+    ymin = np.maximum(a[:, None, 1], b[None, :, 1])
+    xmax = np.minimum(a[:, None, 2], b[None, :, 2])
+    ymax = np.minimum(a[:, None, 3], b[None, :, 3])
+    inter = np.clip(xmax - xmin, 0, None) * np.clip(ymax - ymin, 0, None)
+    area_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+    area_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    union = area_a[:, None] + area_b[None, :] - inter
+    return np.where(union > 0, inter / np.maximum(union, 1e-9), 0.)
+
+def nms(boxes, scores, iou_threshold: float):
+    '''
+    Greedy non-maximum suppression, returns the indices to keep ordered by
+    descending score
+    '''
+    order = np.argsort(-np.asarray(scores), kind='stable')
+    if len(order) < 2:
+        return order
+    ious = iou_matrix(boxes[order], boxes[order])
+    suppressed = np.zeros(len(order), dtype=bool)
+    for i in range(len(order)):
+        if suppressed[i]:
+            continue
+        #Everything lower scored that overlaps box i too much goes
+        suppressed[i + 1:] |= ious[i, i + 1:] > iou_threshold
+    return order[~suppressed]
+
+
+class IoUTracker:
+    '''
+    Assigns persistent ids to boxes by greedily matching them to the boxes
+    of the previous frame. Tracks survive max_missed frames without a match
+    '''
+
+    def __init__(self, iou_threshold: float = 0.3, max_missed: int = 5):
+        self.iou_threshold = iou_threshold
+        self.max_missed = max_missed
+        self.boxes = np.zeros((0, 4), dtype=np.float32)
+        self.ids = np.zeros(0, dtype=np.int32)
+        self.missed = np.zeros(0, dtype=np.int32)
+        self.next_id = 1
+
+    def update(self, boxes):
+        '''
+        Returns one track id per row of boxes
+        '''
+        boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+        ids = np.full(len(boxes), -1, dtype=np.int32)
+        matched = np.zeros(len(self.ids), dtype=bool)
+
+        if len(boxes) and len(self.ids):
+            ious = iou_matrix(boxes, self.boxes)
+            rows, cols = np.nonzero(ious >= self.iou_threshold)
+            #Best overlaps claim their track first
+            for k in np.argsort(-ious[rows, cols], kind='stable'):
+                row, col = rows[k], cols[k]
+                if ids[row] < 0 and not matched[col]:
+                    ids[row] = self.ids[col]
+                    matched[col] = True
+
+        new = ids < 0
+        ids[new] = np.arange(self.next_id, self.next_id + new.sum(), dtype=np.int32)
+        self.next_id += int(new.sum())
+
+        #Unmatched tracks are kept at their last position until they expire
+        missed = self.missed[~matched] + 1
+        alive = missed <= self.max_missed
+        self.boxes = np.concatenate((boxes, self.boxes[~matched][alive]))
+        self.ids = np.concatenate((ids, self.ids[~matched][alive]))
+        self.missed = np.concatenate((np.zeros(len(boxes), dtype=np.int32), missed[alive]))
+        return ids
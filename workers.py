@@ -0,0 +1,211 @@
+'''
+Inference in a pool of worker processes, each with its own loaded network.
+Input blobs go through shared memory slots, only descriptors and the small
+output tensors are pickled
+'''
+
+from copy import copy
+import multiprocessing
+import os
+import queue
+import threading
+import time
+
+import backends
+from spool import FrameSpool
+
+
+def serve(config, batch_size, tasks, results, threads):
+    '''
+    Worker process: loads the network once, then runs one request per task
+    '''
+    import cv2
+    #Every worker gets a core, don't let each one spread over all of them
+    cv2.setNumThreads(threads)
+    try:
+        backend, net, exec_net = backends.load(config, batch_size, 1)
+    except Exception as e:
+        results.put(('error', os.getpid(), str(e)))
+        return
+    input_name = next(iter(net.inputs))
+    output_name = next(iter(net.outputs))
+    results.put(('ready', os.getpid(), str(backend), input_name,
+                 list(net.inputs[input_name].shape), output_name))
+    request = exec_net.requests[0]
+    spool = None
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        ticket, spool_name, slots, slot_bytes, descriptor = task
+        if spool is None or spool.name != spool_name:
+            spool = FrameSpool.attach(spool_name, slots, slot_bytes)
+        blob = spool.read(descriptor)
+        try:
+            #IE's infer() returns None, the status comes from wait
+            request.async_infer({input_name: blob})
+            status = request.wait(-1)
+            output = request.outputs[output_name] if status == backends.OK else None
+        except Exception as e:
+            print("[ALERT] Worker {} inference FAILED: {}".format(os.getpid(), e))
+            status, output = backends.GENERAL_ERROR, None
+        del blob
+        results.put(('result', ticket, status, output))
+    if spool is not None:
+        spool.close()
+
+
+class ProcessRequest:
+    '''
+    IE style infer request served by whichever worker is free. Request i
+    always uses spool slot i, OpenVino collects a request before reusing it
+    '''
+    def __init__(self, pool, index: int):
+        self.pool = pool
+        self.index = index
+        self.ticket = None
+        #Status of the collected ticket, repeated waits return it until the
+        #next async_infer, e.g. OpenVino polls with wait(0) before wait(-1)
+        self.status = None
+        self.outputs = {}
+
+    def async_infer(self, inputs):
+        blob = next(iter(inputs.values()))
+        self.status = None
+        self.ticket = self.pool.submit(self.index, blob)
+
+    def infer(self, inputs):
+        self.async_infer(inputs)
+        return self.wait(-1)
+
+    def wait(self, timeout):
+        if self.status is not None:
+            return self.status
+        if self.ticket is None:
+            return backends.GENERAL_ERROR
+        result = self.pool.result(self.ticket, block=timeout != 0)
+        if result is None:
+            return backends.RESULT_NOT_READY
+        status, output = result
+        if status == backends.OK:
+            self.outputs = {self.pool.output_name: output}
+        self.status = status
+        return status
+
+class WorkerPool:
+    '''
+    Starts worker processes and waits for their networks to load. Results
+    come back out of order and are parked by ticket until the request that
+    owns them is collected, so at most num_requests results are ever held:
+    that is the reorder window
+    '''
+    def __init__(self, config, batch_size: int = None, num_requests: int = 2):
+        self.config = config
+        #Spawned so workers don't inherit camera and writer threads
+        context = multiprocessing.get_context('spawn')
+        self.tasks = context.Queue()
+        self.results = context.Queue()
+        worker_config = copy(config)
+        worker_config.workers = 0
+        #Timing candidates in N processes at once would measure contention
+        worker_config.autotune = False
+        self.processes = [context.Process(target=serve, daemon=True,
+                                          args=(worker_config, batch_size, self.tasks, self.results,
+                                                config.worker_threads))
+                          for _ in range(config.workers)]
+        for process in self.processes:
+            process.start()
+        self.ready = self._wait_ready(config.worker_timeout * 6)
+
+        self.spool = None
+        self.tickets = 0
+        self.parked = {}
+        self.result_ready = threading.Condition()
+        self.thread_running = True
+        self.thread = threading.Thread(target=self.collect, daemon=True)
+        self.thread.start()
+        self.requests = [ProcessRequest(self, index) for index in range(num_requests)]
+
+    def _wait_ready(self, timeout: float) -> list:
+        ready, errors = [], []
+        deadline = time.time() + timeout
+        while len(ready) + len(errors) < len(self.processes):
+            try:
+                message = self.results.get(timeout=max(deadline - time.time(), 0.1))
+            except queue.Empty:
+                if time.time() > deadline:
+                    break
+                continue
+            if message[0] == 'ready':
+                ready.append(message[1:])
+            else:
+                errors.append(message[2])
+                print("[ALERT] Inference worker {} failed to load: {}".format(message[1], message[2]))
+        if not ready:
+            self.close()
+            raise Exception("No inference worker could load the network: {}".format(errors))
+        print("[LOGS] {} INFERENCE WORKERS on {}".format(len(ready), ready[0][1]))
+        _, self.backend, input_name, shape, self.output_name = ready[0]
+        self.net = backends.NetInfo(input_name, shape, self.output_name)
+        return ready
+
+    def submit(self, index: int, blob) -> int:
+        if self.spool is None or blob.nbytes > self.spool.slot_bytes:
+            #Sized on the first blob, the preprocessor reuses one shape
+            if self.spool is not None:
+                self.spool.close()
+            self.spool = FrameSpool(len(self.requests), blob.nbytes)
+        descriptor = self.spool.write(index, blob)
+        self.tickets += 1
+        self.tasks.put((self.tickets, self.spool.name, self.spool.slots, self.spool.slot_bytes, descriptor))
+        return self.tickets
+
+    def collect(self):
+        while self.thread_running:
+            try:
+                message = self.results.get(timeout=1.0)
+            except (queue.Empty, OSError, EOFError):
+                continue
+            if message[0] != 'result':
+                continue
+            _, ticket, status, output = message
+            with self.result_ready:
+                self.parked[ticket] = (status, output)
+                self.result_ready.notify_all()
+
+    def result(self, ticket: int, block: bool = True):
+        '''
+        (status, output) of ticket, None while it is still running. A ticket
+        whose worker died times out as a failed request
+        '''
+        with self.result_ready:
+            if block:
+                self.result_ready.wait_for(lambda: ticket in self.parked, self.config.worker_timeout)
+                if ticket not in self.parked:
+                    print("[ALERT] Inference ticket {} timed out".format(ticket))
+                    return backends.GENERAL_ERROR, None
+            return self.parked.pop(ticket, None)
+
+    def close(self):
+        for _ in self.processes:
+            self.tasks.put(None)
+        for process in self.processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+        self.thread_running = False
+        if getattr(self, 'thread', None) is not None:
+            self.thread.join()
+        if getattr(self, 'spool', None) is not None:
+            self.spool.close()
+            self.spool = None
+
+def load(config, batch_size: int = None, num_requests: int = 2):
+    '''
+    Same contract as backends.load, the pool doubles as the exec_net
+    '''
+    if num_requests < config.workers:
+        print("[ALERT] num_requests {} keeps only {} of {} workers busy".format(
+            num_requests, num_requests, config.workers))
+    pool = WorkerPool(config, batch_size, num_requests)
+    return pool.backend, pool.net, pool
@@ -1,20 +1,25 @@
 #!/usr/bin/env python3
 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import cv2
 import os
 import pickle
-import redis
 import time
 import threading
 import uuid
 
+import metrics
+from spool import FrameSpool
+
 
 class WriteTask(object):
-    def __init__(self, image_path, frame):
+    def __init__(self, image_path, frame, encoder=None):
         self.id = str(uuid.uuid4())
         self.image_path = image_path
-        self.frame_data = frame 
-    
+        self.frame_data = frame
+        self.encoder = encoder
+
     def write(self):
         '''
         Task function for the multiprocessing queue
@@ -23,51 +28,290 @@ class WriteTask(object):
         #basepath = os.path.join(os.path.expanduser('~'), 'tmp')
         #imagepath = self.image_path.split('/')[-1]
         #writepath = os.path.join(basepath, imagepath)
+        if self.frame_data.ndim == 1:
+            #The camera's own JPEG, see Camera.passthrough
+            with open(self.image_path, 'wb') as f:
+                f.write(self.frame_data)
+            return
+        if self.encoder is not None:
+            self.image_path = self.encoder.write(self.image_path, self.frame_data)
+            return
         #JPEG Image compression flags
         jpeg_quality = [cv2.IMWRITE_JPEG_QUALITY, 100]
-        cv2.imwrite(self.image_path, self.frame_data, jpeg_quality)
+        if not cv2.imwrite(self.image_path, self.frame_data, jpeg_quality):
+            raise IOError("Could not write {}".format(self.image_path))
         #print("[LOGS] {} image saved".format(self.image_path))
 
-class WriteQueue(object): 
+class LocalTransport(object):
+    '''
+    In-process descriptor queue, oldest entries are popped first
+    '''
     def __init__(self):
-        self.redis_conn = redis.Redis()
-        self.name = 'io'
+        self.items = deque()
+        self.not_empty = threading.Condition()
+
+    def push(self, descriptor):
+        with self.not_empty:
+            self.items.appendleft(descriptor)
+            self.not_empty.notify()
+
+    def pop(self, timeout=None):
+        with self.not_empty:
+            self.not_empty.wait_for(lambda: self.items, timeout)
+            return self.items.pop() if self.items else None
+
+    def pop_many(self, count, timeout=None):
+        with self.not_empty:
+            self.not_empty.wait_for(lambda: self.items, timeout)
+            return [self.items.pop() for _ in range(min(count, len(self.items)))]
+
+    def pop_oldest(self):
+        with self.not_empty:
+            return self.items.pop() if self.items else None
+
+    def __len__(self):
+        return len(self.items)
+
+class RedisTransport(object):
+    '''
+    Descriptors pickled onto a Redis list. The frames themselves live in
+    this process's spool, so leftovers from a previous run are discarded
+    '''
+    def __init__(self, name='io', redis_conn=None):
+        if redis_conn is None:
+            import redis
+            redis_conn = redis.Redis()
+        self.redis_conn = redis_conn
+        self.name = name
+        self.redis_conn.delete(self.name)
+
+    def push(self, descriptor):
+        self.redis_conn.lpush(self.name, pickle.dumps(descriptor, protocol=pickle.HIGHEST_PROTOCOL))
+
+    def pop(self, timeout=None):
+        item = self.redis_conn.brpop(self.name, timeout=int(timeout or 0))
+        return pickle.loads(item[1]) if item else None
+
+    def pop_many(self, count, timeout=None):
+        '''
+        One blocking BRPOP, then the rest of the batch in a single pipelined
+        round trip
+        '''
+        first = self.pop(timeout)
+        if first is None:
+            return []
+        pipe = self.redis_conn.pipeline(transaction=False)
+        for _ in range(count - 1):
+            pipe.rpop(self.name)
+        return [first] + [pickle.loads(item) for item in pipe.execute() if item]
+
+    def pop_oldest(self):
+        item = self.redis_conn.rpop(self.name)
+        return pickle.loads(item) if item else None
+
+    def __len__(self):
+        return self.redis_conn.llen(self.name)
+
+class WriteQueue(object):
+    '''
+    Frames are copied once into a shared memory spool and only small
+    descriptors (slot, shape, dtype, path) go through the transport. A pool
+    of encoder threads writes them out, at most max_in_flight at a time
+    '''
+    POLICIES = ('block', 'drop_new', 'drop_oldest')
+
+    def __init__(self, config, encoder=None, bundler=None, transport=None):
+        if config.overflow not in self.POLICIES:
+            raise Exception("Unknown overflow policy {}".format(config.overflow))
+        self.config = config
+        #encode.Encoder for the negative profile, JPEG 100 when unset
+        self.encoder = encoder
+        #bundle.SegmentBundler, frames go into segments instead of one file each
+        self.bundler = bundler
+        self.name = config.redis_name
+        if transport is not None:
+            self.transport = transport
+        elif config.backend == 'redis':
+            self.transport = RedisTransport(self.name)
+        else:
+            self.transport = LocalTransport()
+        #Sized on the first frame and replaced by a larger one when a bigger
+        #frame arrives, see _spool. Replaced spools are closed once drained
+        self.spool = None
+        self.spools = {}
+        self.spool_lock = threading.Lock()
+        self.dropped = 0
+        self.written = 0
+        self.failed = 0
+        #Called with (image_path, ok) after every write
+        self.listeners = []
+        self.callbacks = {}
+        self.workers = max(config.workers, 1)
+        if bundler is not None and bundler.config.format == 'mjpeg' and self.workers > 1:
+            #VideoWriter takes frames in arrival order, one encoder keeps it the capture order
+            print("[LOGS] MJPEG segments, write queue runs 1 encoder instead of {}".format(self.workers))
+            self.workers = 1
+        self.in_flight = threading.BoundedSemaphore(config.max_in_flight or 2 * self.workers)
+        self.pool = None
         self.thread_running = False
         self.queue_lock = threading.Lock()
         self.write_lock = threading.Lock()
+        self.enqueue_time = metrics.histogram('write_enqueue_seconds', 'Copy of a frame into the spool')
+        self.write_time = metrics.histogram('write_encode_seconds', 'Encode and write of one frame')
+        metrics.gauge('write_queue_depth', 'Frames waiting for an encoder', fn=self.get_length)
+        metrics.gauge('write_spool_free_slots', 'Free shared memory slots',
+                      fn=lambda: self.spool.available() if self.spool is not None else 0)
+        metrics.counter('write_frames_total', 'Frames written', fn=lambda: self.written)
+        metrics.counter('write_failures_total', 'Frames that failed to encode or write', fn=lambda: self.failed)
+        metrics.counter('write_dropped_total', 'Frames dropped by the overflow policy', fn=lambda: self.dropped)
+
+    def _spool(self, frame):
+        if self.spool is None or frame.nbytes > self.spool.slot_bytes:
+            #e.g. a second camera at a higher resolution or the load
+            #controller restoring the capture size
+            slots = max((self.config.spool_mb << 20) // frame.nbytes, 1)
+            spool = FrameSpool(slots, frame.nbytes)
+            print("[LOGS] WRITE SPOOL {} slots of {} bytes".format(slots, frame.nbytes))
+            with self.spool_lock:
+                self.spools[spool.name] = spool
+                previous, self.spool = self.spool, spool
+            if previous is not None:
+                self._retire(previous)
+        return self.spool
+
+    def _retire(self, spool):
+        '''
+        Closes a replaced spool once none of its slots is held anymore
+        '''
+        with self.spool_lock:
+            if spool is self.spool or spool.available() < spool.slots:
+                return
+            self.spools.pop(spool.name, None)
+        spool.close()
+
+    def _release(self, descriptor):
+        spool = self.spools[descriptor.spool]
+        spool.release(descriptor.slot)
+        if spool is not self.spool:
+            self._retire(spool)
 
     def start(self):
-        if self.thread_running: 
+        if self.thread_running:
             raise Exception('IO thread is running')
         self.thread_running = True
-        print("[LOGS] STARTING WRITE QUEUE")
+        print("[LOGS] STARTING WRITE QUEUE WITH {} ENCODERS".format(self.workers))
+        self.pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='encoder')
         self.thread = threading.Thread(target=self.dequeue, args=())
         self.thread.start()
         return self
 
-    def enqueue(self, image_path, frame):
+    def _drop(self, descriptor=None):
+        self.dropped += 1
+        if descriptor is not None:
+            self._release(descriptor)
+            self._notify(descriptor, False)
+
+    def _notify(self, descriptor, ok):
+        callback = self.callbacks.pop(descriptor.id, None)
+        if callback:
+            callback(descriptor.path, ok)
+        for listener in self.listeners:
+            listener(descriptor.path, ok)
+
+    def enqueue(self, image_path, frame, callback=None, encoded=None, timestamp: float = 0.):
+        '''
+        Returns the task id, or None when the frame was dropped. callback
+        receives (image_path, ok) once the frame is on disk or has failed.
+        encoded is the camera's JPEG of frame, stored as is instead of
+        encoding frame again. timestamp is the capture time for segment indexes
+        '''
+        start = time.time()
+        if encoded is not None:
+            image_path = os.path.splitext(image_path)[0] + '.jpg'
+        elif self.encoder is not None:
+            image_path = self.encoder.path(image_path)
         with self.write_lock:
-            task = WriteTask(image_path, frame)
-        #print("[LOGS] Received Task {}".format(task.id))
-        serialized_task = pickle.dumps(task, protocol=pickle.HIGHEST_PROTOCOL)
-        self.redis_conn.lpush(self.name, serialized_task)
-        return task.id
+            #Slots are sized for decoded frames, compressed ones always fit
+            spool = self._spool(frame)
+            if encoded is not None:
+                frame = encoded
+            if frame.nbytes > spool.slot_bytes:
+                print("[ALERT] Frame {} is larger than a spool slot, dropped".format(image_path))
+                self._drop()
+                return None
+            timeout = self.config.block_timeout if self.config.overflow == 'block' else 0
+            descriptor = spool.put(frame, image_path, timeout)
+            if descriptor is None and self.config.overflow == 'drop_oldest':
+                oldest = self.transport.pop_oldest()
+                if oldest is not None:
+                    self._drop(oldest)
+                    descriptor = spool.put(frame, image_path)
+            if descriptor is None:
+                #print("[ALERT] Write spool full, dropped {}".format(image_path))
+                self._drop()
+                return None
+        #print("[LOGS] Received Task {}".format(descriptor.id))
+        descriptor.timestamp = timestamp
+        if callback:
+            self.callbacks[descriptor.id] = callback
+        self.transport.push(descriptor)
+        self.enqueue_time.observe(time.time() - start)
+        return descriptor.id
+
+    def write(self, descriptor):
+        start = time.time()
+        if self.bundler is not None:
+            self.bundler.add(descriptor.path, self.spools[descriptor.spool].read(descriptor), descriptor.timestamp)
+        else:
+            task = WriteTask(descriptor.path, self.spools[descriptor.spool].read(descriptor), self.encoder)
+            task.id = descriptor.id
+            task.write()
+        self.write_time.observe(time.time() - start)
+
+    def done(self, descriptor, future):
+        self._release(descriptor)
+        self.in_flight.release()
+        error = future.exception()
+        with self.queue_lock:
+            if error is None:
+                self.written += 1
+            else:
+                self.failed += 1
+        if error is not None:
+            print("[ALERT] Write of {} FAILED: {}".format(descriptor.path, error))
+        self._notify(descriptor, error is None)
 
     def dequeue(self):
         while self.thread_running:
             #print("[LOGS] Dequeuing Task ")
-            #if self.get_length != 0:
-            _, serialized_task = self.redis_conn.brpop(self.name)
-            task = pickle.loads(serialized_task)
-            threading.Thread(task.write(), args=()).start()
+            if self.bundler is not None:
+                self.bundler.tick()
+            for descriptor in self.transport.pop_many(self.config.batch, timeout=1):
+                #Bounded in-flight work, the spool slot stays held until written
+                self.in_flight.acquire()
+                future = self.pool.submit(self.write, descriptor)
+                future.add_done_callback(lambda f, d=descriptor: self.done(d, f))
 
     def get_length(self):
-        return self.redis_conn.llen(self.name)
-    
+        return len(self.transport)
+
+    def stats(self):
+        with self.queue_lock:
+            return {
+                'queue_depth': self.get_length(),
+                'written': self.written,
+                'failed': self.failed,
+                'dropped': self.dropped,
+            }
+
     def stop(self):
         self.thread_running = False
         self.thread.join()
-    
-    def __exit__(self):
-        #Close redis connection
-        del redis_conn
\ No newline at end of file
+        self.pool.shutdown(wait=True)
+        if self.bundler is not None:
+            self.bundler.close()
+        #Release the shared memory, anything still queued is lost
+        for spool in self.spools.values():
+            spool.close()
+        self.spools = {}
+        self.spool = None